@@ -5,9 +5,36 @@ It also handles logging and configuration based on whether the application is ru
 """
 
 import os
+import uuid
 import logging
-from flask import Flask, render_template, request
-from src.story_builder import build_story
+import mimetypes
+from flask import Flask, render_template, request, jsonify, abort, send_file
+from werkzeug.security import safe_join
+from src.story_builder import build_story, format_story, regenerate_part, image_density, parse_image_density
+from src.translate import StoryTranslator, parse_languages, translation_calls, variant_key, variant_story
+from src.usage import StoryUsage, usage_registry
+from src.metrics import metrics
+from src.uploads import upload_store, UnsupportedImageType, UploadTooLarge
+from src.log_config import setup_logging, job_context
+from src.scheduler import StoryScheduler, SchedulerFull, estimate_cost, trusted_proxy
+from src.story_pool import StoryPool, bucket_key
+from src.story_store import story_store
+from src.memory import memory_guard
+from src.job_queue import job_queue_from_env, FAILED, CIRCUIT_OPEN
+from src.circuit_breaker import CircuitOpen
+from src.profiling import profile_job, profile_path, should_profile, token_valid
+from src.http_cache import (
+    IMMUTABLE,
+    REVALIDATE,
+    COMPRESSIBLE_TYPES,
+    asset_versions,
+    choose_encoding,
+    compress,
+    compress_min_bytes,
+    etag,
+    precompress_static,
+    precompressed_file,
+)
 from markupsafe import Markup
 
 app = Flask(__name__)
@@ -24,22 +51,281 @@ else:
     load_dotenv()
     logging.info("Runnning app locally..")
 
-if not os.path.exists("logs"):
-    os.mkdir("logs")
+# maximum size of a request, larger uploads are rejected with 413
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH", 16 * 1024 * 1024))
+
+# records are written to logs/logs.txt by a background thread, the file is rotated by size
+setup_logging()
+
+# the compressed variants of the static files are served as is, the generated images are not compressed
+try:
+    precompress_static(app.static_folder, exclude=("images", "stories", "uploads"))
+except OSError as e:
+    logging.info(f"Static files not precompressed ({e!r})")
 
-if os.path.exists("logs/logs.txt"):
-    os.remove("logs/logs.txt")
+# admits the story jobs within the cost budget of the instance, created once the environment is loaded
+story_scheduler = StoryScheduler()
 
-logging.basicConfig(
-    filename="logs/logs.txt",
-    filemode="a",
-    format="{asctime} - {levelname} - {message}",
-    style="{",
-    datefmt="%Y-%m-%d %H:%M",
-    level=logging.INFO,
+# with JOB_QUEUE=1 the stories are generated by the worker processes of `python -m src.worker`
+job_queue = (
+    job_queue_from_env()
+    if os.getenv("JOB_QUEUE", "0").lower() in ("1", "true", "yes")
+    else None
 )
 
 
+def client_id() -> str:
+    """
+    Identifies the client of the request for the fair scheduling of its jobs.
+
+    Returns:
+        str: The `X-Client-Id` header or the first `X-Forwarded-For` address when they come from a
+            trusted proxy, else the address of the client.
+    """
+    if not trusted_proxy():
+        return request.remote_addr
+    forwarded_for = request.headers.get("X-Forwarded-For", "").split(",")[0].strip()
+    return request.headers.get("X-Client-Id") or forwarded_for or request.remote_addr
+
+
+def requested_languages() -> list:
+    """
+    Returns:
+        list: The languages the story of the request is translated into, from its `languages`
+            parameter e.g. "French,German".
+    """
+    try:
+        return parse_languages(request.args.get("languages"))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def requested_image_density() -> tuple:
+    """
+    Returns:
+        tuple: The most images of the story of the request and the step between two
+            illustrated parts, from its `images` and `image_every` parameters, None for a value
+            not requested.
+    """
+    try:
+        return parse_image_density(request.args.get("images"), request.args.get("image_every"))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def run_story(job_id: str, profile: bool = False, persist: bool = False, **kwargs) -> str:
+    """
+    Generates a story in this process, or with the workers when the job queue is enabled,
+    and records its usage.
+
+    Args:
+        job_id (str): Id of the job.
+        profile (bool, optional): Whether the job is profiled, its profile is then linked from
+            its usage. Defaults to False.
+        persist (bool, optional): Whether the story is saved in the story store under the job id,
+            with its images, so its parts can be regenerated. Defaults to False.
+        **kwargs: The arguments of `build_story`.
+
+    Returns:
+        str: An HTML string representing the generated story.
+
+    Raises:
+        CircuitOpen: If the story models were unavailable to the workers.
+        RuntimeError: If the job failed on all its attempts.
+        TimeoutError: If the workers did not finish the job within `JOB_TIMEOUT_SECONDS`.
+    """
+    if persist:
+        kwargs.setdefault("image_dir", story_store.story_dir(job_id))
+
+    if job_queue is None:
+        usage = StoryUsage()
+        record = {} if persist else None
+        try:
+            with profile_job(job_id, profile):
+                story = build_story(usage=usage, record=record, **kwargs)
+            if persist:
+                story_store.save(job_id, record)
+            return story
+        finally:
+            if profile:
+                usage.profile = f"/profiles/{job_id}"
+            usage_registry.record(job_id, usage)
+
+    if profile:
+        kwargs["profile"] = True
+    if persist:
+        kwargs["persist"] = True
+    job_queue.enqueue("story", kwargs, job_id=job_id)
+    job = job_queue.wait(job_id, timeout=float(os.getenv("JOB_TIMEOUT_SECONDS", 600)))
+    if job["status"] == FAILED:
+        if job["error_kind"] == CIRCUIT_OPEN:
+            raise CircuitOpen("the story models", job["retry_after"] or 1)
+        raise RuntimeError(f"Story job {job_id} failed: {job['error']}")
+    usage_registry.record(job_id, job["result"]["usage"])
+    return job["result"]["story"]
+
+
+def generate_pooled_story(**kwargs) -> str:
+    """
+    Generates a story without context for the story pool.
+
+    Args:
+        **kwargs: The theme, inspiration, number of words and image directory of the story.
+
+    Returns:
+        str: An HTML string representing the generated story.
+    """
+    job_id = uuid.uuid4().hex
+    with job_context(job_id):
+        return run_story(job_id, context=None, **kwargs)
+
+
+# pre-generates stories for the most requested options while the instance is idle
+story_pool = StoryPool(story_scheduler, generate_pooled_story)
+story_pool.start()
+
+
+def pooled_story(context: str, theme: str, inspiration: str, n_words: int, client: str) -> str:
+    """
+    Counts a story request and serves it from the story pool if it has no context.
+
+    Args:
+        context (str): The context of the story.
+        theme (str): The theme of the story.
+        inspiration (str): The inspiration for the story.
+        n_words (int): The requested number of words.
+        client (str): Id of the client.
+
+    Returns:
+        str: The HTML of a pooled story, None if the story must be generated.
+    """
+    if (context or "").strip():
+        return None
+    key = bucket_key(theme, inspiration, n_words)
+    story_pool.record(
+        key, dict(story_theme=theme, story_inspiration=inspiration, n_words=n_words)
+    )
+    return story_pool.take(key, client)
+
+
+@app.url_defaults
+def versioned_static_url(endpoint, values):
+    """
+    Adds the content hash of a static file to its URL, so the URL changes with the file and the
+    file can be cached as immutable.
+    """
+    if endpoint == "static" and "filename" in values:
+        version = asset_versions.version(os.path.join(app.static_folder, values["filename"]))
+        if version:
+            values.setdefault("v", version)
+
+
+def static_file(filename):
+    """
+    Serves a static file, or its precompressed variant when the client accepts it.
+
+    Args:
+        filename (str): Path of the file in the static directory.
+
+    Returns:
+        Response: The file.
+    """
+    path = safe_join(app.static_folder, filename)
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    compressed = precompressed_file(path, encoding) if path else None
+    if compressed is None:
+        return app.send_static_file(filename)
+    response = send_file(
+        os.path.abspath(compressed),
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        conditional=True,
+    )
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+app.view_functions["static"] = static_file
+
+
+@app.after_request
+def http_caching(response):
+    """
+    Sets the caching headers of a response and compresses it.
+
+    Static files requested with the hash of their content are cached as immutable, the others
+    are revalidated. Pages, CSS and JSON get an ETag of their content, a repeated request is
+    answered with `304 Not Modified`, and are compressed with brotli or gzip.
+
+    Args:
+        response (Response): The response.
+
+    Returns:
+        Response: The response with its caching headers, compressed.
+    """
+    if request.endpoint == "static":
+        path = safe_join(app.static_folder, request.view_args.get("filename", ""))
+        version = request.args.get("v")
+        immutable = bool(version) and (version == asset_versions.version(path))
+        response.headers["Cache-Control"] = IMMUTABLE if immutable else REVALIDATE
+        if response.mimetype in COMPRESSIBLE_TYPES:
+            response.vary.add("Accept-Encoding")
+        return response
+
+    if (
+        (request.method != "GET")
+        or (response.status_code != 200)
+        or response.direct_passthrough
+        or response.is_streamed
+        or (response.mimetype not in COMPRESSIBLE_TYPES)
+        or ("Content-Encoding" in response.headers)
+    ):
+        return response
+
+    body = response.get_data()
+    encoding = None
+    if len(body) >= compress_min_bytes():
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag(body, encoding))
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = REVALIDATE
+    response.make_conditional(request)
+    if (response.status_code == 200) and encoding:
+        response.set_data(compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@app.errorhandler(SchedulerFull)
+def story_shed(error):
+    """
+    Rejects story requests when the instance is saturated.
+
+    Returns:
+        tuple: The error message, status code and `Retry-After` header.
+    """
+    return (
+        "Too many stories are being generated, please retry later",
+        503,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+@app.errorhandler(CircuitOpen)
+def model_unavailable(error):
+    """
+    Fails the story requests fast while the language model is unavailable.
+
+    Returns:
+        tuple: The error message, status code and `Retry-After` header.
+    """
+    return (
+        "The story model is unavailable, please retry later",
+        503,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
 @app.route("/")
 def home():
     """
@@ -57,20 +343,42 @@ def success():
     Handles image uploads and renders the image display page.
 
     This function is triggered when a POST request is made to the '/image' route, usually with a file attached.
-    It extracts the uploaded file, saves it to the 'static/images' directory, and renders the 'image.html' template, passing the path of the saved image.
+    It streams the uploaded file to the upload store, and renders the 'image.html' template, passing the path
+    of the saved image and its id.
 
     Returns:
-        str: The rendered HTML content of the image display page with image path passed to the template.
+        str: The rendered HTML content of the image display page with image path and id passed to the template.
     """
     if request.method == "POST":
 
-        f = request.files["file"]
-        ext = f.filename.split(".")[1]
+        f = request.files.get("file")
+        if (f is None) or (not f.filename):
+            abort(400, "No image uploaded")
+
+        try:
+            image_id = upload_store.save(
+                f.stream, max_bytes=app.config["MAX_CONTENT_LENGTH"]
+            )
+        except UnsupportedImageType as e:
+            abort(415, str(e))
+        except UploadTooLarge:
+            abort(413)
+
+        return render_template(
+            "image.html", image=upload_store.path(image_id), image_id=image_id
+        )
 
-        img_path = os.path.join("static", "images", f"upload.{ext}")
-        f.save(img_path)
 
-        return render_template("image.html", image=img_path)
+@app.errorhandler(413)
+def upload_too_large(error):
+    """
+    Rejects requests larger than `MAX_CONTENT_LENGTH`.
+
+    Returns:
+        tuple: The error message and status code.
+    """
+    max_mb = app.config["MAX_CONTENT_LENGTH"] / (1024 * 1024)
+    return f"The image is too large, the maximum size is {max_mb:.1f} MB", 413
 
 
 @app.route("/context")
@@ -101,24 +409,50 @@ def generate_story_from_context():
     n_words = int(request.args.get("n_words"))
     inspiration = request.args.get("inspiration")
     theme = request.args.get("theme")
-
-    story = build_story(
-        context=context,
-        n_words=n_words,
-        story_inspiration=inspiration,
-        story_theme=theme,
+    languages = requested_languages()
+    max_images, image_every = requested_image_density()
+
+    # pooled stories are not saved, so they cannot be translated, and have the default density
+    if not languages and (max_images, image_every) == (None, None):
+        story = pooled_story(context, theme, inspiration, n_words, client_id())
+        if story is not None:
+            save_story(story)
+            return render_template("story.html", story=Markup(story))
+
+    job_id = uuid.uuid4().hex
+    # the images of the default density are configured in the environment
+    images, every = image_density(max_images, image_every)
+    cost = estimate_cost(
+        n_words,
+        from_image=False,
+        n_languages=len(languages),
+        max_images=images,
+        image_every=every,
     )
+    with job_context(job_id), story_scheduler.admit(client_id(), cost):
+        story = run_story(
+            job_id,
+            profile=should_profile(request.headers.get("X-Profile")),
+            persist=True,
+            context=context,
+            n_words=n_words,
+            story_inspiration=inspiration,
+            story_theme=theme,
+            languages=languages,
+            max_images=max_images,
+            image_every=image_every,
+        )
 
     save_story(story)
-    return render_template("story.html")
+    return render_template("story.html", story=Markup(story)), {"X-Story-Id": job_id}
 
 
 @app.route("/imagestory")
 def generate_story_from_image():
     """
-    Generates a story based on a user-provided image file path.
+    Generates a story based on an image uploaded to the `/image` route.
 
-    This function retrieves user inputs (image path, number of words, inspiration, and theme) from the query parameters of the request.
+    This function retrieves user inputs (image id, number of words, inspiration, and theme) from the query parameters of the request.
     It calls the `build_story` function with these parameters to generate a story.
     The generated story is then saved to `templates/story.html` and `templates/story_to_print.html` by `save_story` function
     Finally, it renders the 'story.html' template, which now contains the generated story.
@@ -126,23 +460,238 @@ def generate_story_from_image():
      Returns:
         str: The rendered HTML content of the story display page.
     """
-    img = request.args.get("contextimg")
-
+    img = upload_store.path(request.args.get("image_id"))
+    if img is None:
+        abort(404, "Unknown image")
     n_words = int(request.args.get("n_words"))
     inspiration = request.args.get("inspiration")
     theme = request.args.get("theme")
-
-    story = build_story(
-        image_file=img,
-        n_words=n_words,
-        story_inspiration=inspiration,
-        story_theme=theme,
+    languages = requested_languages()
+    max_images, image_every = requested_image_density()
+
+    job_id = uuid.uuid4().hex
+    # the images of the default density are configured in the environment
+    images, every = image_density(max_images, image_every)
+    cost = estimate_cost(
+        n_words,
+        from_image=True,
+        n_languages=len(languages),
+        max_images=images,
+        image_every=every,
     )
+    with job_context(job_id), story_scheduler.admit(client_id(), cost):
+        story = run_story(
+            job_id,
+            profile=should_profile(request.headers.get("X-Profile")),
+            persist=True,
+            image_file=img,
+            n_words=n_words,
+            story_inspiration=inspiration,
+            story_theme=theme,
+            languages=languages,
+            max_images=max_images,
+            image_every=image_every,
+        )
 
     save_story(story)
+    return render_template("story.html", story=Markup(story)), {"X-Story-Id": job_id}
+
+
+@app.route("/stories/<story_id>")
+def get_saved_story(story_id):
+    """
+    Renders a saved story, with its regenerated parts.
+
+    Args:
+        story_id (str): Identifier of the story, given in the `X-Story-Id` header of the story page.
+
+    Returns:
+        str: The rendered HTML content of the story display page.
+    """
+    record = story_store.load(story_id)
+    if record is None:
+        abort(404)
+    story = format_story(record["story"], record["theme"], record["image_files"])
     return render_template("story.html", story=Markup(story))
 
 
+@app.route("/stories/<story_id>/variants/<language>")
+def get_story_variant(story_id, language):
+    """
+    Renders a saved story in another language, with the images and theme of the story.
+
+    The variants requested with the `languages` parameter of the story are translated while the
+    story is generated. Other languages, and the parts regenerated since, are translated on the
+    first request, in a cheap text call per part.
+
+    Args:
+        story_id (str): Identifier of the story.
+        language (str): The language e.g. "French".
+
+    Returns:
+        str: The rendered HTML content of the story display page.
+    """
+    try:
+        language = parse_languages(language)[0]
+    except (ValueError, IndexError):
+        abort(404)
+    record = story_store.load(story_id)
+    if record is None:
+        abort(404)
+
+    key = variant_key(language)
+    n_calls = len(translation_calls(record["story"], record.get("variants", {}).get(key)))
+    if n_calls:
+        job_id = uuid.uuid4().hex
+        with job_context(job_id), story_scheduler.admit(client_id(), n_calls):
+            with story_store.edit(story_id) as record:
+                if record is None:
+                    abort(404)
+                usage = StoryUsage()
+                try:
+                    record.setdefault("variants", {}).update(
+                        StoryTranslator(usage=usage).translate(
+                            record["story"], [language], record["variants"]
+                        )
+                    )
+                finally:
+                    usage_registry.record(job_id, usage)
+
+    story = format_story(
+        variant_story(record["story"], record["variants"][key]),
+        record["theme"],
+        record["image_files"],
+    )
+    return render_template("story.html", story=Markup(story))
+
+
+@app.route("/stories/<story_id>/parts/<int:n_part>/<target>", methods=["POST"])
+def regenerate_story_part(story_id, n_part, target):
+    """
+    Regenerates the text or the image of a single part of a saved story.
+
+    The other parts, their images and the theme are kept, so this takes a single model call.
+    The reader's wishes for the new text can be given in the `instructions` form field or JSON key.
+
+    Args:
+        story_id (str): Identifier of the story.
+        n_part (int): Number of the part, from 1.
+        target (str): "text" or "image".
+
+    Returns:
+        Response: JSON with the id of the part and its new HTML, which replaces the element with
+            the id of the part in the story page, and the job id of its usage.
+    """
+    if target not in ("text", "image"):
+        abort(404)
+    instructions = request.form.get("instructions") or (
+        request.get_json(silent=True) or {}
+    ).get("instructions")
+    part_id = f"part_{n_part}"
+
+    job_id = uuid.uuid4().hex
+    # a regeneration is a single model call
+    with job_context(job_id), story_scheduler.admit(client_id(), 1):
+        with story_store.edit(story_id) as record:
+            if (record is None) or (part_id not in record["story"]["story"]):
+                abort(404)
+            if target == "image" and not record["story"]["story"][part_id].get("image_prompt"):
+                abort(400, f"{part_id} is not illustrated")
+            usage = StoryUsage()
+            try:
+                html = regenerate_part(record, part_id, target, instructions, usage=usage)
+            finally:
+                usage_registry.record(job_id, usage)
+
+    return jsonify(story_id=story_id, part=part_id, target=target, html=html, job_id=job_id)
+
+
+@app.route("/usage")
+def get_usage():
+    """
+    Returns the aggregate model usage and the usage of the most recent jobs.
+
+    Returns:
+        Response: JSON with the `totals` and `recent` job usage.
+    """
+    try:
+        recent = int(request.args.get("recent", 20))
+    except ValueError:
+        abort(400, "recent must be a number")
+    if recent < 0:
+        abort(400, "recent must be 0 or more")
+    return jsonify(usage_registry.summary(recent=recent))
+
+
+@app.route("/usage/<job_id>")
+def get_job_usage(job_id):
+    """
+    Returns the model usage of a job.
+
+    Args:
+        job_id (str): Identifier of the job.
+
+    Returns:
+        Response: JSON with the tokens, image calls, retries and wall time of the job.
+    """
+    usage = usage_registry.get(job_id)
+    if usage is None:
+        abort(404)
+    return jsonify(usage)
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    """
+    Returns the state of a job of the job queue.
+
+    Args:
+        job_id (str): Identifier of the job.
+
+    Returns:
+        Response: JSON with the status, attempts, worker and error of the job.
+    """
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        abort(404)
+    job.pop("result")
+    return jsonify(job)
+
+
+@app.route("/profiles/<job_id>")
+def get_profile(job_id):
+    """
+    Returns the profile of a profiled job, to open in https://www.speedscope.app.
+
+    The token must be given in the `X-Profile` header or the `token` query parameter, the
+    profiles are not served when `PROFILE_TOKEN` is not set.
+
+    Args:
+        job_id (str): Identifier of the job.
+
+    Returns:
+        Response: The profile in the speedscope JSON format.
+    """
+    if not token_valid(request.headers.get("X-Profile") or request.args.get("token")):
+        abort(403)
+    path = profile_path(job_id)
+    if path is None or not os.path.exists(path):
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype="application/json")
+
+
+@app.route("/metrics")
+def get_metrics():
+    """
+    Returns the application metrics in the Prometheus text format.
+
+    Returns:
+        tuple: The metrics, status code and content type header.
+    """
+    memory_guard.track()
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
 def save_story(story):
     """
     Saves the generated story to HTML files.
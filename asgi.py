@@ -0,0 +1,265 @@
+"""
+ASGI entry point serving the story routes with the async story pipeline.
+
+`/contextstory` and `/imagestory` are served natively on the event loop with `abuild_story`, so a
+single process can hold many stories in flight without a thread per model call. All the other
+routes are served by the Flask application in `app.py`.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+
+import uuid
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from flask import render_template
+from werkzeug.http import parse_etags
+from markupsafe import Markup
+from app import app as flask_app, save_story, story_scheduler, pooled_story, job_queue, run_story
+from src.story_builder import abuild_story, image_density, parse_image_density
+from src.usage import StoryUsage, usage_registry
+from src.uploads import upload_store
+from src.log_config import job_context
+from src.scheduler import SchedulerFull, estimate_cost, trusted_proxy
+from src.circuit_breaker import CircuitOpen
+from src.profiling import profile_job, should_profile
+from src.story_store import story_store
+from src.translate import parse_languages
+from src.http_cache import REVALIDATE, choose_encoding, compress, compress_min_bytes, etag
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def send_response(
+    send, status: int, body, content_type: str = "text/html", headers: dict = None
+):
+    """
+    Sends a complete HTTP response.
+
+    Args:
+        send: The ASGI send callable.
+        status (int): HTTP status code.
+        body (str | bytes): Body of the response, bytes if it is already encoded.
+        content_type (str, optional): Media type of the body. Defaults to "text/html".
+        headers (dict, optional): Additional headers. Defaults to None.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", f"{content_type}; charset=utf-8".encode()),
+                (b"content-length", str(len(body)).encode()),
+            ]
+            + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def client_id(scope) -> str:
+    """
+    Identifies the client of the request for the fair scheduling of its jobs.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+
+    Returns:
+        str: The `X-Client-Id` header or the first `X-Forwarded-For` address when they come from a
+            trusted proxy, else the address of the client.
+    """
+    client = scope.get("client") or ("unknown",)
+    if not trusted_proxy():
+        return client[0]
+    headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+    forwarded_for = headers.get("x-forwarded-for", "").split(",")[0].strip()
+    return headers.get("x-client-id") or forwarded_for or client[0]
+
+
+async def generate_story(scope, send):
+    """
+    Generates a story from the query parameters of a `/contextstory` or `/imagestory` request.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        send: The ASGI send callable.
+    """
+    args = {
+        key: values[0]
+        for key, values in parse_qs(scope["query_string"].decode()).items()
+    }
+
+    image_file = None
+    if scope["path"] == "/imagestory":
+        image_file = upload_store.path(args.get("image_id"))
+        if image_file is None:
+            await send_response(send, 404, "Unknown image", "text/plain")
+            return
+
+    n_words = int(args.get("n_words"))
+    try:
+        languages = parse_languages(args.get("languages"))
+        max_images, image_every = parse_image_density(args.get("images"), args.get("image_every"))
+    except ValueError as e:
+        await send_response(send, 400, str(e), "text/plain")
+        return
+
+    # pooled stories are not saved, so they cannot be translated, and have the default density
+    if (image_file is None) and not languages and (max_images, image_every) == (None, None):
+        story = pooled_story(
+            args.get("context"),
+            args.get("theme"),
+            args.get("inspiration"),
+            n_words,
+            client_id(scope),
+        )
+        if story is not None:
+            await render_story(scope, send, story)
+            return
+
+    job_id = uuid.uuid4().hex
+    usage = StoryUsage()
+    headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+    profile = should_profile(headers.get("x-profile"))
+    images, every = image_density(max_images, image_every)
+    cost = estimate_cost(
+        n_words,
+        from_image=image_file is not None,
+        n_languages=len(languages),
+        max_images=images,
+        image_every=every,
+    )
+    with job_context(job_id):
+        try:
+            async with story_scheduler.aadmit(client_id(scope), cost):
+                # with the job queue the story is generated by the workers
+                if job_queue is not None:
+                    story = await asyncio.to_thread(
+                        run_story,
+                        job_id,
+                        profile=profile,
+                        persist=True,
+                        image_file=image_file,
+                        context=args.get("context"),
+                        n_words=n_words,
+                        story_inspiration=args.get("inspiration"),
+                        story_theme=args.get("theme"),
+                        languages=languages,
+                        max_images=max_images,
+                        image_every=image_every,
+                    )
+                else:
+                    # the event loop thread is sampled with the other requests it serves
+                    record = {}
+                    try:
+                        with profile_job(job_id, profile):
+                            story = await abuild_story(
+                                image_file=image_file,
+                                context=args.get("context"),
+                                n_words=n_words,
+                                story_inspiration=args.get("inspiration"),
+                                story_theme=args.get("theme"),
+                                image_dir=story_store.story_dir(job_id),
+                                usage=usage,
+                                record=record,
+                                languages=languages,
+                                max_images=max_images,
+                                image_every=image_every,
+                            )
+                        await asyncio.to_thread(story_store.save, job_id, record)
+                    finally:
+                        if profile:
+                            usage.profile = f"/profiles/{job_id}"
+                        usage_registry.record(job_id, usage)
+        except SchedulerFull as e:
+            await send_response(
+                send,
+                503,
+                "Too many stories are being generated, please retry later",
+                "text/plain",
+                {"Retry-After": str(e.retry_after)},
+            )
+            return
+        except CircuitOpen as e:
+            await send_response(
+                send,
+                503,
+                "The story model is unavailable, please retry later",
+                "text/plain",
+                {"Retry-After": str(e.retry_after)},
+            )
+            return
+        except Exception:
+            logging.exception("Story generation failed")
+            await send_response(send, 500, "Story generation failed", "text/plain")
+            return
+
+    await render_story(scope, send, story, job_id)
+
+
+async def render_story(scope, send, story: str, story_id: str = None):
+    """
+    Saves a story and sends its page.
+
+    Like the `http_caching` hook of the Flask application, the page gets an ETag of its content,
+    a repeated request is answered with `304 Not Modified`, and it is compressed with brotli or
+    gzip.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        send: The ASGI send callable.
+        story (str): The HTML of the story.
+        story_id (str, optional): Id of the story in the story store, sent in the `X-Story-Id`
+            header. Defaults to None for a story which is not saved.
+    """
+    await asyncio.to_thread(save_story, story)
+    # render_template needs a request context for url_for in the base template
+    with flask_app.test_request_context(
+        scope["path"], query_string=scope["query_string"].decode()
+    ):
+        html = render_template("story.html", story=Markup(story))
+
+    headers = {"Cache-Control": REVALIDATE, "Vary": "Accept-Encoding"}
+    if story_id:
+        headers["X-Story-Id"] = story_id
+    body = html.encode("utf-8")
+    request_headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+    encoding = None
+    if len(body) >= compress_min_bytes():
+        encoding = choose_encoding(request_headers.get("accept-encoding"))
+    tag = etag(body, encoding)
+    headers["ETag"] = f'"{tag}"'
+    if parse_etags(request_headers.get("if-none-match")).contains_weak(tag):
+        await send_response(send, 304, b"", headers=headers)
+        return
+    if encoding:
+        body = await asyncio.to_thread(compress, body, encoding)
+        headers["Content-Encoding"] = encoding
+    await send_response(send, 200, body, headers=headers)
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        receive: The ASGI receive callable.
+        send: The ASGI send callable.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    elif scope["type"] == "http" and scope["path"] in ("/contextstory", "/imagestory"):
+        await generate_story(scope, send)
+    else:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1,321 @@
+"""
+Command line entry point for generating stories in bulk.
+
+Reads a JSONL or CSV file of story requests, drives `build_story` with a pool of workers
+under a global rate limit and checkpoints every finished row, so an interrupted run can be
+resumed without regenerating the stories that are already done.
+
+Each input row may contain the following fields:
+    id: Unique identifier of the row, letters, digits, - and _ (defaults to the row number).
+    context: Text context for the story.
+    image: Path to an image to use as the story context instead of the text.
+    n_words: Maximum number of words of the story (defaults to 200).
+    inspiration: Additional context e.g. visual style, inspiration.
+    theme: Theme of the story.
+    images: Most images of the story, 0 for text only (defaults to `IMAGES_PER_STORY`).
+    image_every: Every k-th part is illustrated (defaults to `IMAGE_EVERY_K`).
+
+Usage:
+    python -m src.batch requests.jsonl --output-dir batch_output --workers 4 --rate 10
+"""
+
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.story_builder import build_story, format_story, parse_image_density
+from src.usage import StoryUsage
+from src.log_config import setup_logging, job_context
+
+RESULTS_FILE = "results.jsonl"
+TIMINGS_FILE = "timings.csv"
+
+
+class RateLimiter:
+    """
+    A thread safe token bucket limiting how many stories are started per minute.
+
+    Attributes:
+        rate (float): Number of stories allowed to start per minute.
+        capacity (float): Maximum number of tokens the bucket can hold.
+        tokens (float): Currently available tokens.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Initializes the RateLimiter.
+
+        Args:
+            rate (float): Number of stories allowed to start per minute.
+            burst (int, optional): Number of stories which can start back to back. Defaults to 1.
+        """
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and consumes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate / 60
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * 60 / self.rate
+            time.sleep(wait)
+
+
+def read_rows(input_file: str) -> list:
+    """
+    Reads the story requests from a JSONL or CSV file.
+
+    Args:
+        input_file (str): Path to the input file, format is chosen by the file extension.
+
+    Returns:
+        list: The rows as dictionaries, each with an `id`.
+
+    Raises:
+        ValueError: If two rows share the same id, or an id is not a safe directory name.
+    """
+    with open(input_file, newline="", encoding="utf-8") as f:
+        if input_file.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    ids = set()
+    for idx, row in enumerate(rows, start=1):
+        row["id"] = str(row.get("id") or f"row_{idx}")
+        # the id is the name of the directory of the row, it must stay within the output directory
+        if not row["id"].replace("-", "").replace("_", "").isalnum():
+            raise ValueError(f"Row id must be letters, digits, - and _: {row['id']!r}")
+        if row["id"] in ids:
+            raise ValueError(f"Duplicate row id: {row['id']}")
+        ids.add(row["id"])
+
+    return rows
+
+
+def read_checkpoint(output_dir: str) -> dict:
+    """
+    Reads the results of the previous runs.
+
+    Args:
+        output_dir (str): Directory containing the results file.
+
+    Returns:
+        dict: Latest result per row id.
+    """
+    results = {}
+    results_file = os.path.join(output_dir, RESULTS_FILE)
+    if os.path.exists(results_file):
+        with open(results_file, encoding="utf-8") as f:
+            for line in f:
+                # a run killed while writing leaves a partial last line
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                results[result["id"]] = result
+    return results
+
+
+def generate_row(row: dict, output_dir: str, rate_limiter: RateLimiter = None) -> dict:
+    """
+    Generates and saves the story for a single row.
+
+    Args:
+        row (dict): The story request.
+        output_dir (str): Directory where the story of each row is saved in its own folder.
+        rate_limiter (RateLimiter, optional): Limits how often stories are started.
+
+    Returns:
+        dict: The result of the row with its status and timings.
+    """
+    if rate_limiter:
+        rate_limiter.acquire()
+
+    row_dir = os.path.join(output_dir, row["id"])
+    os.makedirs(row_dir, exist_ok=True)
+    story_file = os.path.join(row_dir, "story.html")
+    started = time.time()
+    result = {"id": row["id"], "started": started}
+    usage = StoryUsage()
+
+    record = {}
+    with job_context(row["id"]):
+        try:
+            max_images, image_every = parse_image_density(row.get("images"), row.get("image_every"))
+            story = build_story(
+                image_file=row.get("image") or None,
+                context=row.get("context") or None,
+                story_theme=row.get("theme") or "General",
+                story_inspiration=row.get("inspiration") or "General",
+                n_words=int(row.get("n_words") or 200),
+                image_dir=os.path.join(row_dir, "images"),
+                usage=usage,
+                record=record,
+                max_images=max_images,
+                image_every=image_every,
+            )
+            # the page of the app loads the images from the app root, the file from its directory
+            story = format_story(
+                record["story"], record["theme"], record["image_files"], page_dir=row_dir
+            )
+            with open(story_file, "w", encoding="utf-8") as f:
+                f.write(f"<html>{story}</html>")
+            result.update(status="ok", output=story_file)
+        except Exception as e:
+            logging.exception(f"Story generation failed for {row['id']}")
+            result.update(status="error", error=str(e))
+
+    usage.finish()
+    result["seconds"] = round(time.time() - started, 3)
+    result["usage"] = usage.to_dict()
+    return result
+
+
+def write_timings(output_dir: str, results: dict):
+    """
+    Writes the per row timing report as CSV.
+
+    Args:
+        output_dir (str): Directory where the report is saved.
+        results (dict): Latest result per row id.
+    """
+    with open(os.path.join(output_dir, TIMINGS_FILE), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["id", "status", "seconds", "started", "total_tokens", "image_calls"]
+        )
+        for result in results.values():
+            usage = result.get("usage", {})
+            writer.writerow(
+                [
+                    result["id"],
+                    result["status"],
+                    result["seconds"],
+                    result["started"],
+                    usage.get("total_tokens"),
+                    usage.get("image_calls"),
+                ]
+            )
+
+
+def run_batch(
+    input_file: str,
+    output_dir: str,
+    workers: int = 4,
+    rate: float = None,
+    retry_failed: bool = True,
+) -> dict:
+    """
+    Generates the stories of all rows which are not already finished.
+
+    Args:
+        input_file (str): Path to the JSONL or CSV file with the story requests.
+        output_dir (str): Directory for the stories, results and timing report.
+        workers (int, optional): Number of stories generated concurrently. Defaults to 4.
+        rate (float, optional): Maximum number of stories started per minute. Defaults to no limit.
+        retry_failed (bool, optional): Whether rows that failed in a previous run are generated again.
+            Defaults to True.
+
+    Returns:
+        dict: Latest result per row id.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rows = read_rows(input_file)
+    results = read_checkpoint(output_dir)
+
+    done = {
+        id
+        for id, result in results.items()
+        if result["status"] == "ok" or not retry_failed
+    }
+    pending = [row for row in rows if row["id"] not in done]
+    logging.info(
+        f"{len(rows)} rows, {len(rows) - len(pending)} already done, {len(pending)} to generate"
+    )
+
+    rate_limiter = RateLimiter(rate, burst=workers) if rate else None
+    lock = threading.Lock()
+
+    with open(os.path.join(output_dir, RESULTS_FILE), "a", encoding="utf-8") as f:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(generate_row, row, output_dir, rate_limiter)
+                for row in pending
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                with lock:
+                    f.write(json.dumps(result) + "\n")
+                    f.flush()
+                    results[result["id"]] = result
+                logging.info(
+                    f"{result['id']}: {result['status']} in {result['seconds']}s"
+                )
+
+    write_timings(output_dir, results)
+    return results
+
+
+def main(argv=None):
+    """
+    Parses the command line arguments and runs the batch.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to `sys.argv`.
+    """
+    parser = argparse.ArgumentParser(description="Generate stories in bulk.")
+    parser.add_argument("input_file", help="JSONL or CSV file with the story requests")
+    parser.add_argument(
+        "--output-dir", default="batch_output", help="Directory for the results"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of concurrent stories"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=None, help="Maximum stories started per minute"
+    )
+    parser.add_argument(
+        "--skip-failed",
+        action="store_true",
+        help="Do not retry rows which failed in a previous run",
+    )
+    args = parser.parse_args(argv)
+
+    if "K_REVISION" not in os.environ:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+
+    setup_logging(log_file=None)
+
+    results = run_batch(
+        input_file=args.input_file,
+        output_dir=args.output_dir,
+        workers=args.workers,
+        rate=args.rate,
+        retry_failed=not args.skip_failed,
+    )
+    failed = [id for id, result in results.items() if result["status"] != "ok"]
+    logging.info(f"Finished: {len(results) - len(failed)} ok, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
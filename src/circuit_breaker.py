@@ -0,0 +1,203 @@
+"""
+Module providing circuit breakers for the model endpoints.
+
+A breaker watches the recent calls of an endpoint. When too many of them fail or are slow, it
+opens and the calls fail immediately with `CircuitOpen` instead of waiting on a degraded
+endpoint, so the stories fall back at once to another model, the caches or the local theming.
+After a cool down the breaker lets a probe call through (half open): it closes if the probe
+succeeds and opens again otherwise.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from src.metrics import metrics
+
+metrics.describe("model_breaker_trips_total", "Model circuit breakers opened")
+metrics.describe("model_breaker_rejections_total", "Model calls failed fast by an open breaker")
+metrics.describe("model_breakers_open", "Model circuit breakers currently open")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(RuntimeError):
+    """
+    The call was not made as the breaker of the endpoint is open.
+
+    Attributes:
+        retry_after (int): Seconds before the breaker lets a probe call through.
+    """
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit breaker of {name} is open")
+        self.retry_after = max(int(retry_after + 0.999), 1)
+
+
+class CircuitBreaker:
+    """
+    Breaker of a single endpoint.
+
+    The thresholds are read from the environment when the breaker is created:
+
+        - `BREAKER_WINDOW` (default 20): number of recent calls the rates are computed on.
+        - `BREAKER_MIN_CALLS` (default 10): calls in the window before the breaker may open.
+        - `BREAKER_ERROR_RATE` (default 0.5): share of failed calls which opens the breaker.
+        - `BREAKER_SLOW_RATE` (default 0.5): share of slow calls which opens the breaker.
+        - `BREAKER_OPEN_SECONDS` (default 30): cool down before a probe call is let through.
+
+    Attributes:
+        name (str): Name of the endpoint.
+        slow_seconds (float): Latency above which a call counts as slow.
+        state (str): "closed", "open" or "half_open".
+        calls (deque): (failed, slow) of the recent calls.
+        opened_at (float): Time the breaker last opened.
+    """
+
+    open_breakers = set()
+
+    def __init__(self, name: str, slow_seconds: float):
+        """
+        Initializes the CircuitBreaker, closed.
+
+        Args:
+            name (str): Name of the endpoint.
+            slow_seconds (float): Latency above which a call counts as slow.
+        """
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self.min_calls = int(os.getenv("BREAKER_MIN_CALLS", 10))
+        self.error_rate = float(os.getenv("BREAKER_ERROR_RATE", 0.5))
+        self.slow_rate = float(os.getenv("BREAKER_SLOW_RATE", 0.5))
+        self.open_seconds = float(os.getenv("BREAKER_OPEN_SECONDS", 30))
+        self.calls = deque(maxlen=int(os.getenv("BREAKER_WINDOW", 20)))
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def available(self) -> bool:
+        """
+        Returns:
+            bool: Whether the breaker is closed, or its cool down has passed.
+        """
+        with self.lock:
+            return (self.state == CLOSED) or (
+                time.time() - self.opened_at >= self.open_seconds
+            )
+
+    def acquire(self) -> bool:
+        """
+        Checks whether a call may be made.
+
+        Returns:
+            bool: True if the call is a half open probe.
+
+        Raises:
+            CircuitOpen: If the breaker is open, or a probe is already in flight.
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return False
+            remaining = self.opened_at + self.open_seconds - time.time()
+            if (remaining <= 0) and not self.probing:
+                self.state = HALF_OPEN
+                self.probing = True
+                return True
+        metrics.inc("model_breaker_rejections_total")
+        raise CircuitOpen(self.name, max(remaining, 0))
+
+    def record(self, probe: bool, failed: bool, latency: float):
+        """
+        Records the outcome of a call and opens or closes the breaker.
+
+        Args:
+            probe (bool): Whether the call was a half open probe.
+            failed (bool): Whether the call raised an error.
+            latency (float): Seconds taken by the call.
+        """
+        slow = latency > self.slow_seconds
+        with self.lock:
+            if probe:
+                self.probing = False
+                if failed or slow:
+                    self.trip(f"probe {'failed' if failed else 'slow'}")
+                else:
+                    self.state = CLOSED
+                    self.calls.clear()
+                    CircuitBreaker.open_breakers.discard(self.name)
+                    logging.info(f"Circuit breaker of {self.name} closed")
+                metrics.set("model_breakers_open", len(CircuitBreaker.open_breakers))
+                return
+            if self.state != CLOSED:
+                return
+
+            self.calls.append((failed, slow))
+            if len(self.calls) < self.min_calls:
+                return
+            errors = sum(failed for failed, _ in self.calls) / len(self.calls)
+            slows = sum(slow for _, slow in self.calls) / len(self.calls)
+            if errors >= self.error_rate:
+                self.trip(f"{errors:.0%} of the calls failed")
+            elif slows >= self.slow_rate:
+                self.trip(f"{slows:.0%} of the calls slower than {self.slow_seconds}s")
+            metrics.set("model_breakers_open", len(CircuitBreaker.open_breakers))
+
+    def release(self, probe: bool):
+        """
+        Frees the probe slot of a call which was cancelled before it finished.
+        """
+        if probe:
+            with self.lock:
+                self.probing = False
+
+    def trip(self, reason: str):
+        """
+        Opens the breaker. Called with the lock held.
+        """
+        self.state = OPEN
+        self.opened_at = time.time()
+        self.calls.clear()
+        CircuitBreaker.open_breakers.add(self.name)
+        metrics.inc("model_breaker_trips_total")
+        logging.info(f"Circuit breaker of {self.name} opened, {reason}")
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Makes a call through the breaker.
+
+        Raises:
+            CircuitOpen: If the breaker is open.
+        """
+        probe = self.acquire()
+        started = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(probe, True, time.time() - started)
+            raise
+        except BaseException:
+            self.release(probe)
+            raise
+        self.record(probe, False, time.time() - started)
+        return result
+
+    async def acall(self, fn, *args, **kwargs):
+        """
+        Async version of `call`, `fn` is a coroutine function. A cancelled call is not recorded.
+        """
+        probe = self.acquire()
+        started = time.time()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            self.record(probe, True, time.time() - started)
+            raise
+        except BaseException:
+            self.release(probe)
+            raise
+        self.record(probe, False, time.time() - started)
+        return result
@@ -0,0 +1,112 @@
+"""
+Module providing a cache of the descriptions generated for the images a story is based on.
+
+Users often submit the same image again with another theme or word count. The description
+of the image does not depend on those, so it is looked up by the perceptual hash of the
+image instead of sending the image to the image to text model again.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from src.image_hash import hamming_distance
+from src.metrics import metrics
+
+metrics.describe(
+    "image_context_cache_hits_total", "Image descriptions found in the cache"
+)
+metrics.describe(
+    "image_context_cache_misses_total", "Image descriptions generated by the model"
+)
+metrics.describe("image_context_cache_entries", "Image descriptions in the cache")
+
+
+class ImageContextCache:
+    """
+    A bounded LRU cache of image descriptions, looked up by the perceptual hash of the image.
+
+    Attributes:
+        max_entries (int): Maximum number of cached descriptions.
+        max_distance (int): Maximum number of differing hash bits for two images to match.
+        entries (OrderedDict): Description by model name and image hash, least recently used first.
+    """
+
+    def __init__(self, max_entries: int = None, max_distance: int = None):
+        """
+        Initializes the ImageContextCache.
+
+        Args:
+            max_entries (int, optional): Maximum number of cached descriptions.
+                Defaults to `IMAGE_CONTEXT_CACHE_SIZE` from the environment or 500.
+            max_distance (int, optional): Maximum number of differing bits of the 64 bit hashes.
+                Defaults to `IMAGE_CONTEXT_CACHE_MAX_DISTANCE` from the environment or 4.
+        """
+        self.max_entries = (
+            max_entries
+            if max_entries is not None
+            else int(os.getenv("IMAGE_CONTEXT_CACHE_SIZE", 500))
+        )
+        self.max_distance = (
+            max_distance
+            if max_distance is not None
+            else int(os.getenv("IMAGE_CONTEXT_CACHE_MAX_DISTANCE", 4))
+        )
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def find(self, model_name: str, image_hash: int) -> str:
+        """
+        Finds the description of the closest cached image.
+
+        Args:
+            model_name (str): Name of the model the description should come from.
+            image_hash (int): Perceptual hash of the image.
+
+        Returns:
+            str: The cached description, None if no image is close enough.
+        """
+        best_key, best_distance = None, self.max_distance + 1
+
+        with self.lock:
+            if (model_name, image_hash) in self.entries:
+                best_key, best_distance = (model_name, image_hash), 0
+            else:
+                for key in self.entries:
+                    if key[0] != model_name:
+                        continue
+                    distance = hamming_distance(key[1], image_hash)
+                    if distance < best_distance:
+                        best_key, best_distance = key, distance
+
+            if best_key is None:
+                metrics.inc("image_context_cache_misses_total")
+                return None
+            self.entries.move_to_end(best_key)
+            context = self.entries[best_key]
+
+        metrics.inc("image_context_cache_hits_total")
+        logging.info(f"Image description found in the cache, distance {best_distance}")
+        return context
+
+    def add(self, model_name: str, image_hash: int, context: str):
+        """
+        Adds the description of an image to the cache.
+
+        Args:
+            model_name (str): Name of the model which generated the description.
+            image_hash (int): Perceptual hash of the image.
+            context (str): The description.
+        """
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[(model_name, image_hash)] = context
+            self.entries.move_to_end((model_name, image_hash))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            metrics.set("image_context_cache_entries", len(self.entries))
+
+
+context_cache = ImageContextCache()
@@ -0,0 +1,452 @@
+"""
+Module providing a local, deterministic model backend used instead of the Google models.
+
+Selected with `MODEL_BACKEND=fake`, it lets the whole application run offline e.g. for load
+tests, CI or staging, without credentials or cost.
+
+    - `FakeLLM`: LangChain LLM returning templated story and theme JSON.
+    - `FakeVisionTextModel`: returns image descriptions, color palettes and improved prompts.
+    - `FakeImageGenerationModel`: renders procedural PNG images from the colors of the prompt.
+
+The outputs only depend on the prompt and `FAKE_MODEL_SEED`. Every call waits for
+`FAKE_MODEL_LATENCY_MS` (a fixed value e.g. "200" or a range e.g. "100-400") and fails with
+a `FakeModelError` with probability `FAKE_MODEL_ERROR_RATE`.
+"""
+
+import io
+import os
+import json
+import re
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from types import SimpleNamespace
+from typing import Any, List, Optional
+from PIL import Image, ImageDraw
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import Generation, LLMResult
+
+HEX_COLOR = re.compile(r"#[0-9a-fA-F]{6}\b")
+STORY_PARTS = re.compile(r"Divide the story into a (\d+) number of parts")
+STORY_WORDS = re.compile(r"must not exceed a (\d+)\s+word count")
+PART_WORDS = re.compile(r"Keep about (\d+) words")
+TARGET_LANGUAGE = re.compile(r"TARGET_LANGUAGE: (.+)")
+ILLUSTRATED_PARTS = re.compile(r"image prompt only for the story parts ((?:part_\d+(?:, )?)+)")
+
+NOUNS = ["lantern", "river", "fox", "garden", "clock", "lighthouse", "kite", "forest", "map", "train"]
+ADJECTIVES = ["quiet", "golden", "curious", "ancient", "bright", "hidden", "gentle", "windy"]
+VERBS = ["found", "followed", "painted", "repaired", "remembered", "discovered", "shared"]
+FONTS = ["Georgia", "Arial", "Verdana", "Times New Roman"]
+
+
+class FakeModelError(RuntimeError):
+    """
+    Error injected in a fake model call.
+    """
+
+
+class FakeCallSettings:
+    """
+    Latency and error injection shared by the fake models.
+
+    Attributes:
+        latency (tuple): Minimum and maximum latency of a call in seconds.
+        error_rate (float): Probability of a call failing.
+        seed (int): Seed of the outputs and of the injected latencies and errors.
+        random (random.Random): Generator of the injected latencies and errors.
+    """
+
+    def __init__(self):
+        """
+        Initializes the FakeCallSettings from `FAKE_MODEL_LATENCY_MS`, `FAKE_MODEL_ERROR_RATE`
+        and `FAKE_MODEL_SEED` in the environment.
+        """
+        latency = os.getenv("FAKE_MODEL_LATENCY_MS", "0").split("-")
+        self.latency = (float(latency[0]) / 1000, float(latency[-1]) / 1000)
+        self.error_rate = float(os.getenv("FAKE_MODEL_ERROR_RATE", 0))
+        self.seed = int(os.getenv("FAKE_MODEL_SEED", 0))
+        self.random = random.Random(self.seed)
+        self.lock = threading.Lock()
+
+    def next_call(self, call: str) -> float:
+        """
+        Draws the latency of the next call and raises the injected errors.
+
+        Args:
+            call (str): Name of the call, used in the error message.
+
+        Returns:
+            float: Latency of the call in seconds.
+
+        Raises:
+            FakeModelError: If the call should fail.
+        """
+        with self.lock:
+            latency = self.random.uniform(*self.latency)
+            failed = self.random.random() < self.error_rate
+        if failed:
+            raise FakeModelError(f"Injected error in fake {call} call")
+        return latency
+
+    def call(self, call: str):
+        """
+        Waits for the latency of a blocking call.
+        """
+        time.sleep(self.next_call(call))
+
+    async def acall(self, call: str):
+        """
+        Waits for the latency of an async call.
+        """
+        await asyncio.sleep(self.next_call(call))
+
+    def rng(self, *keys) -> random.Random:
+        """
+        Args:
+            keys: Values the outputs depend on e.g. the prompt.
+
+        Returns:
+            random.Random: Generator seeded from the keys and the seed.
+        """
+        digest = hashlib.sha256(repr((self.seed,) + keys).encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def count_tokens(text: str) -> int:
+    """
+    Approximates the number of tokens of a text, 4 characters per token.
+    """
+    return max(len(text) // 4, 1)
+
+
+def random_palette(rng: random.Random) -> list:
+    """
+    Args:
+        rng (random.Random): The generator.
+
+    Returns:
+        list: Four shades of a random color, from the darkest to the lightest, as hex codes.
+    """
+    base = [rng.randint(40, 215) for _ in range(3)]
+
+    def mix(target: int, amount: float) -> str:
+        return "#" + "".join(f"{round(c + (target - c) * amount):02X}" for c in base)
+
+    return [mix(0, 0.6), mix(0, 0.2), mix(255, 0.5), mix(255, 0.9)]
+
+
+def json_dumps(value) -> str:
+    """
+    Serializes the value as the models do, in a fenced JSON block.
+    """
+    return "```json\n" + json.dumps(value, indent=2) + "\n```"
+
+
+def story_text(rng: random.Random, n_words: int) -> str:
+    """
+    Generates sentences until the text has about `n_words` words.
+    """
+    sentences = []
+    words = 0
+    while words < n_words:
+        sentence = (
+            f"The {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {rng.choice(VERBS)} "
+            f"the {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}."
+        )
+        sentences.append(sentence)
+        words += len(sentence.split())
+    return " ".join(sentences)
+
+
+class FakeLLM(LLM):
+    """
+    Fake language model, answering the theme prompts with a theme, the part rewrites with a part,
+    the translations with the tagged texts and any other prompt with a story.
+    """
+
+    model_name: str = "fake"
+    settings: Any = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.settings = self.settings or FakeCallSettings()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def respond(self, prompt: str) -> str:
+        """
+        Generates the response to a prompt.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The theme or story JSON.
+        """
+        rng = self.settings.rng(self.model_name, prompt)
+        if "THEMES_CONTEXT" in prompt:
+            return self.theme_response(prompt, rng)
+        if "PART_TO_REWRITE" in prompt:
+            return self.part_response(prompt, rng)
+        if "TEXTS_TO_TRANSLATE" in prompt:
+            return self.translation_response(prompt)
+        return self.story_response(prompt, rng)
+
+    def theme_response(self, prompt: str, rng: random.Random) -> str:
+        """
+        Picks the lightest and darkest colors of the palette in the prompt as the theme.
+        """
+        palette = HEX_COLOR.findall(prompt.split("COLOR_PALETTE:")[-1]) or random_palette(rng)
+        palette = sorted(palette, key=lambda color: sum(int(color[i : i + 2], 16) for i in (1, 3, 5)))
+        return (
+            f'{{"BackgroundColor": "{palette[-1]}", "FontColor": "{palette[0]}", '
+            f'"FontFamily": "{rng.choice(FONTS)}"}}'
+        )
+
+    def part_response(self, prompt: str, rng: random.Random) -> str:
+        """
+        Rewrites a story part with the number of words asked in the prompt.
+        """
+        words = PART_WORDS.search(prompt)
+        words = int(words.group(1)) if words else 100
+        return json_dumps({"story": story_text(rng, words)})
+
+    def translation_response(self, prompt: str) -> str:
+        """
+        "Translates" the texts in the prompt by tagging them with the target language.
+        """
+        language = TARGET_LANGUAGE.search(prompt).group(1).strip()
+        texts = json.loads(prompt.split("TEXTS_TO_TRANSLATE:")[-1])
+        return json_dumps({key: f"[{language}] {text}" for key, text in texts.items()})
+
+    def story_response(self, prompt: str, rng: random.Random) -> str:
+        """
+        Generates a story with the number of parts and words asked in the prompt, and an image
+        prompt for the parts to illustrate.
+        """
+        parts = STORY_PARTS.search(prompt)
+        parts = max(int(parts.group(1)), 1) if parts else 1
+        words = STORY_WORDS.search(prompt)
+        words = int(words.group(1)) if words else 200
+        palette = ", ".join(random_palette(rng)[:3])
+        illustrated = ILLUSTRATED_PARTS.search(prompt)
+        illustrated = illustrated.group(1).split(", ") if illustrated else None
+        if "image prompt for no story part" in prompt:
+            illustrated = []
+
+        story = {}
+        for i in range(1, parts + 1):
+            story[f"part_{i}"] = {"story": story_text(rng, words // parts)}
+            if (illustrated is None) or (f"part_{i}" in illustrated):
+                story[f"part_{i}"]["image_prompt"] = (
+                    f"A {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} near a {rng.choice(NOUNS)}, "
+                    f"light background, Color pallete to be used {palette}. 1/3 corner free for text."
+                )
+        title = f"The {rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS).title()}"
+        return json_dumps(
+            {
+                "style": {
+                    "background-color": "#FFFFFF",
+                    "font-color": "#333333",
+                    "font-family": rng.choice(FONTS),
+                },
+                "title": title,
+                "introduction": story_text(rng, 50),
+                "theme": f"A calm story, color pallete which will suit this story might be {palette}.",
+                "story": story,
+            }
+        )
+
+    def generation(self, prompt: str, text: str) -> List[Generation]:
+        """
+        Wraps the response with its token usage, as reported by the Google models.
+        """
+        return [
+            Generation(
+                text=text,
+                generation_info={
+                    "usage_metadata": {
+                        "prompt_token_count": count_tokens(prompt),
+                        "candidates_token_count": count_tokens(text),
+                    }
+                },
+            )
+        ]
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        self.settings.call("text")
+        return self.respond(prompt)
+
+    def _generate(self, prompts: List[str], stop=None, run_manager=None, **kwargs) -> LLMResult:
+        generations = []
+        for prompt in prompts:
+            self.settings.call("text")
+            generations.append(self.generation(prompt, self.respond(prompt)))
+        return LLMResult(generations=generations)
+
+    async def _agenerate(self, prompts: List[str], stop=None, run_manager=None, **kwargs) -> LLMResult:
+        generations = []
+        for prompt in prompts:
+            await self.settings.acall("text")
+            generations.append(self.generation(prompt, self.respond(prompt)))
+        return LLMResult(generations=generations)
+
+
+class FakeVisionTextModel:
+    """
+    Fake multimodal model, with the interface of `google.generativeai.GenerativeModel`.
+
+    Attributes:
+        model_name (str): Name of the model, part of the seed of the outputs.
+        settings (FakeCallSettings): Latency and error injection.
+    """
+
+    def __init__(self, model_name: str = "fake", settings: FakeCallSettings = None):
+        """
+        Initializes the FakeVisionTextModel.
+
+        Args:
+            model_name (str, optional): Name of the model. Defaults to "fake".
+            settings (FakeCallSettings, optional): Defaults to the settings from the environment.
+        """
+        self.model_name = model_name
+        self.settings = settings or FakeCallSettings()
+
+    def respond(self, contents):
+        """
+        Generates the response to a prompt, with an image or not.
+
+        Args:
+            contents: A prompt, or a list of prompts and PIL images.
+
+        Returns:
+            SimpleNamespace: The response, with the generated `text` and its `usage_metadata`.
+        """
+        contents = contents if isinstance(contents, list) else [contents]
+        prompt = "\n".join(item for item in contents if isinstance(item, str))
+        images = [item for item in contents if isinstance(item, Image.Image)]
+        rng = self.settings.rng(
+            self.model_name, prompt, *(image.resize((4, 4)).tobytes() for image in images)
+        )
+
+        if '"fourth"' in prompt:
+            colors = random_palette(rng)
+            text = json_dumps(dict(zip(["first", "second", "third", "fourth"], colors)))
+        elif "ORIGINAL_IMAGE_PROMPT" in prompt:
+            original = prompt.split("ORIGINAL_IMAGE_PROMPT:")[-1].strip()
+            text = f"A family friendly illustration of {original}"
+        else:
+            text = (
+                f"A digital illustration with a {rng.choice(ADJECTIVES)} mood, showing a "
+                f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} beside a {rng.choice(NOUNS)}. "
+                + story_text(rng, 60)
+            )
+
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=count_tokens(prompt) + 258 * len(images),
+                candidates_token_count=count_tokens(text),
+            ),
+        )
+
+    def generate_content(self, contents):
+        self.settings.call("vision to text")
+        return self.respond(contents)
+
+    async def generate_content_async(self, contents):
+        await self.settings.acall("vision to text")
+        return self.respond(contents)
+
+
+class FakeGeneratedImage:
+    """
+    Generated image, with the interface of `vertexai.vision_models.GeneratedImage`.
+    """
+
+    def __init__(self, image: Image.Image):
+        self._pil_image = image
+
+    @property
+    def _image_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        self._pil_image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def save(self, location: str, include_generation_parameters: bool = True):
+        self._pil_image.save(location, format="PNG")
+
+
+class FakeImageGenerationModel:
+    """
+    Fake image generation model, with the interface of `vertexai.vision_models.ImageGenerationModel`.
+
+    Attributes:
+        model_name (str): Name of the model, part of the seed of the images.
+        settings (FakeCallSettings): Latency and error injection.
+        size (tuple): Width and height of the images.
+    """
+
+    def __init__(self, model_name: str = "fake", settings: FakeCallSettings = None, size: tuple = (512, 512)):
+        """
+        Initializes the FakeImageGenerationModel.
+
+        Args:
+            model_name (str, optional): Name of the model. Defaults to "fake".
+            settings (FakeCallSettings, optional): Defaults to the settings from the environment.
+            size (tuple, optional): Width and height of the images. Defaults to (512, 512).
+        """
+        self.model_name = model_name
+        self.settings = settings or FakeCallSettings()
+        self.size = size
+
+    def render(self, prompt: str, index: int) -> Image.Image:
+        """
+        Renders a gradient of the prompt colors with a few shapes.
+
+        Args:
+            prompt (str): The image prompt.
+            index (int): Index of the image among the images of the call.
+
+        Returns:
+            Image.Image: The image.
+        """
+        rng = self.settings.rng(self.model_name, prompt, index)
+        colors = [
+            tuple(int(color[i : i + 2], 16) for i in (1, 3, 5))
+            for color in HEX_COLOR.findall(prompt) or random_palette(rng)
+        ]
+        top, bottom = rng.sample(colors, 2) if len(colors) > 1 else (colors[0], (255, 255, 255))
+
+        width, height = self.size
+        image = Image.new("RGB", self.size)
+        draw = ImageDraw.Draw(image)
+        for y in range(height):
+            ratio = y / max(height - 1, 1)
+            draw.line(
+                [(0, y), (width, y)],
+                fill=tuple(round(t + (b - t) * ratio) for t, b in zip(top, bottom)),
+            )
+        for _ in range(rng.randint(3, 7)):
+            x, y = rng.randrange(width), rng.randrange(height)
+            radius = rng.randint(width // 20, width // 5)
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=rng.choice(colors))
+        return image
+
+    def generate_images(self, prompt: str, number_of_images: int = 1, **kwargs) -> list:
+        """
+        Generates images from the prompt.
+
+        Args:
+            prompt (str): The image prompt.
+            number_of_images (int, optional): Number of images to generate. Defaults to 1.
+
+        Returns:
+            list: The generated images.
+        """
+        self.settings.call("image generation")
+        return [FakeGeneratedImage(self.render(prompt, i)) for i in range(number_of_images)]
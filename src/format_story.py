@@ -15,9 +15,10 @@ class FormatStory:
         font_color (str): The font color for the text in the story.
         font_family (str): The font family for the text in the story.
         story_parts (str): A string containing the HTML for all the story parts.
+        image_prefix (str): Prefix of the image paths in the HTML.
     """
 
-    def __init__(self, background_color, font_color, font_family):
+    def __init__(self, background_color, font_color, font_family, image_prefix="../"):
         """
         Initializes a new FormatStory object.
 
@@ -25,7 +26,10 @@ class FormatStory:
             background_color (str): The background color of the story.
             font_color (str): The font color for the text in the story.
             font_family (str): The font family for the text in the story.
+            image_prefix (str, optional): Prefix of the image paths, "../" for the pages served by
+                the app. Defaults to "../".
         """
+        self.image_prefix = image_prefix
         self.background_color = background_color
         self.font_color = font_color
         self.font_family = font_family
@@ -59,28 +63,62 @@ class FormatStory:
 
         """
 
-    def add_part(self, image_path, story, section, back_color, font_color):
+    def add_part(self, image_path, story, section, back_color, font_color, image_left=None):
         """
         Adds a part (section) to the story.
 
+        Args:
+            image_path (str): The path to the image for this part, None for a text only part.
+            story (str): The text content for this part.
+            section (int): The section number (used to alternate layout).
+            back_color (str): The background color of this section.
+            font_color (str): The font color of the text in this section.
+            image_left (bool, optional): Whether the image is on the left, defaults to the
+                alternation by section number.
+        """
+        part = self.format_part(image_path, story, section, back_color, font_color, image_left)
+        self.story_parts = self.story_parts + "\n" + part
+
+    def format_part(self, image_path, story, section, back_color, font_color, image_left=None):
+        """
+        Formats a part (section) of the story.
+
         Each part includes an image and text. The layout alternates between
         having the image on the left or right based on whether the section number is even or odd.
+        Parts without an image are rendered as text only, and a story illustrating only some of
+        its parts passes `image_left` to alternate the sides of its images. The part is wrapped in a `<div>` with
+        the id of the part e.g. "part_1", so a regenerated part can replace it in the page.
 
         Args:
-            image_path (str): The path to the image for this part.
+            image_path (str): The path to the image for this part, None for a text only part.
             story (str): The text content for this part.
             section (int): The section number (used to alternate layout).
             back_color (str): The background color of this section.
             font_color (str): The font color of the text in this section.
+            image_left (bool, optional): Whether the image is on the left, defaults to the
+                alternation by section number.
+
+        Returns:
+            str: The HTML of the part.
         """
 
-        if section % 2 == 0:
+        if image_left is None:
+            image_left = section % 2 == 0
+
+        if image_path is None:
+            part = f"""
+            <div style="height: 10px"></div>
+            <div style="background-color: {back_color};  margin: auto; box-shadow: 2px 2px 3px 3px {font_color}; border-radius: 25px;">
+                <div style="color: {font_color}; line-height: 1.3; text-align: center; font-size: 20px; padding: 24px 32px 24px 32px;">{story}</div>
+            </div>
+            """
+        elif image_left:
             part = f"""
             <div style="height: 10px"></div>
             <div style="background-color: {back_color};  margin: auto; box-shadow: 2px 2px 3px 3px {font_color}; border-radius: 25px;">
                 <table style="margin: auto; color: {font_color}; table-layout: fixed; width: 980px; height: 300px; padding: 0px 0px 0px 0px; margin-left: 0px;">
                 <tr style="margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;">
-                <td style="margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;"><img src="../{image_path}" style="display:block; height: 300px; border-radius: 24px 0px 0px 24px; margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;" width="100%" ></td>
+                <td style="margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;"><img src="{self.image_prefix}{image_path}" style="display:block; height: 300px; border-radius: 24px 0px 0px 24px; margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;" width="100%" ></td>
                 <td><div style="line-height: 1.3; text-align: left; font-size: 20px; margin-left: 16px;">{story}</div></td>
         
                 </tr>
@@ -94,14 +132,14 @@ class FormatStory:
                 <table style="margin: auto; color: {font_color}; table-layout: fixed; width: 980px; height: 300px; padding: 0px 0px 0px 0px; margin-right: 0px;">
                 <tr style="margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;">
                 <td><div style="line-height: 1.3; text-align: right; font-size: 20px; margin-right: 16px;">{story}</div></td>
-                <td style="margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;"><img src="../{image_path}" style="display:block; height: 300px; border-radius: 0px 24px 24px 0px; margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;" width="100%" ></td>
+                <td style="margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;"><img src="{self.image_prefix}{image_path}" style="display:block; height: 300px; border-radius: 0px 24px 24px 0px; margin: 0px 0px 0px 0px; padding: 0px 0px 0px 0px;" width="100%" ></td>
                 
                 </tr>
                 </table>
             </div>
 
             """
-        self.story_parts = self.story_parts + "\n" + part
+        return f'<div id="part_{section}">{part}</div>'
 
     def compile_story(self):
         """
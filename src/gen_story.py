@@ -7,11 +7,13 @@ Description:
 
 import os
 import logging
-import google.generativeai as genai
-from langchain_google_genai import GoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from pydantic import BaseModel, Field
+from src.usage import StoryUsage
+from src.model_adapters import get_text_model, get_vision_text_model
+from src.image_hash import dhash
+from src.context_cache import context_cache
 
 
 class Story(BaseModel):
@@ -43,6 +45,36 @@ class Story(BaseModel):
     )
 
 
+def illustrated_parts(n_parts: int, image_every: int = 1, max_images: int = None) -> list:
+    """
+    Picks the parts of a story which are illustrated.
+
+    Args:
+        n_parts (int): Number of parts of the story.
+        image_every (int, optional): Every k-th part is illustrated, from the first. Defaults to 1.
+        max_images (int, optional): Most illustrated parts, spread evenly over the story.
+            Defaults to None (no limit).
+
+    Returns:
+        list: Numbers of the illustrated parts, from 1.
+    """
+    parts = list(range(1, n_parts + 1, max(image_every, 1)))
+    if (max_images is None) or (len(parts) <= max_images):
+        return parts
+    return [parts[(n * len(parts)) // max_images] for n in range(max(max_images, 0))]
+
+
+class StoryPart(BaseModel):
+    """
+    Data model representing a regenerated story part.
+
+    Attributes:
+        story (str): The new text of the part.
+    """
+
+    story: str = Field(..., title="Story", description="The new text of the story part")
+
+
 class StoryGenerator:
     """
     A class to generate stories using a language model.
@@ -51,13 +83,16 @@ class StoryGenerator:
     It can generate a story from a text context or from an image, leveraging a language model.
 
     Attributes:
-        language_model: The language model used for generating text content.
-        image_to_text_model: The language model used for processing image content.
-        llm: Langchain wrapper around the Gemini model.
+        image_to_text_model (VisionTextModel): The model used for processing image content.
+        image_to_text_model_name (str): Name of the image to text model.
+        llm (TextModel): The language model used for generating the story.
         story_theme (str): The theme of the story (e.g., "General", "Fantasy").
         story_inspiration (str): The inspiration for the story
             (e.g., "General", "Historical event").
         n_words (int): The desired total word count for the story.
+        image_every (int): Every k-th part is illustrated.
+        max_images (int): The maximum number of illustrated parts, None for no limit.
+        usage (StoryUsage): Records the tokens used by the model calls.
     """
 
     def __init__(
@@ -65,6 +100,9 @@ class StoryGenerator:
         story_theme: str = "General",
         story_inspiration: str = "General",
         n_words: int = 200,
+        usage: StoryUsage = None,
+        image_every: int = 1,
+        max_images: int = None,
     ):
         """
         Initializes the StoryGenerator with model, theme, inspiration, and word count.
@@ -74,16 +112,21 @@ class StoryGenerator:
             story_inspiration (str, optional): The inspiration for the story.
                 Defaults to "General".
             n_words (int, optional): The desired word count for the story. Defaults to 200.
+            usage (StoryUsage, optional): Records the tokens used by the model calls.
+                Defaults to a new `StoryUsage`.
+            image_every (int, optional): Every k-th part is illustrated. Defaults to 1.
+            max_images (int, optional): The maximum number of illustrated parts.
+                Defaults to None (no limit).
         """
-        genai.configure()
-        self.language_model = genai.GenerativeModel(os.getenv("LANGUAGE_MODEL"))
-        self.image_to_text_model = genai.GenerativeModel(
-            os.getenv("IMAGE_TO_TEXT_MODEL")
-        )
-        self.llm = GoogleGenerativeAI(model=os.getenv("LANGUAGE_MODEL"))
+        self.image_to_text_model_name = os.getenv("IMAGE_TO_TEXT_MODEL")
+        self.image_to_text_model = get_vision_text_model(self.image_to_text_model_name)
+        self.llm = get_text_model(os.getenv("LANGUAGE_MODEL"))
         self.story_theme = story_theme
         self.story_inspiration = story_inspiration
         self.n_words = n_words
+        self.image_every = image_every
+        self.max_images = max_images
+        self.usage = usage or StoryUsage()
         self.story_instructions()
 
     def set_context(self, context: str = None) -> str:
@@ -99,6 +142,7 @@ class StoryGenerator:
         """
 
         self.context = context
+        self.topic = None
 
         if context:
             self.context = context
@@ -125,14 +169,62 @@ class StoryGenerator:
         Sets the context for generating a story from the given image by generating a text
         description of the image.
 
+        The description of a similar image, by perceptual hash, is reused from the cache
+        instead of calling the image to text model again.
+
         Args:
             img: The image file to be used as context.
 
         Returns:
            str: The generated description of image.
         """
+        image_hash = dhash(img)
+        context = context_cache.find(self.image_to_text_model_name, image_hash)
+        if context is None:
+            response = self.image_to_text_model.generate_content(
+                self.image_context_prompt(img)
+            )
+            context = self.image_description(response, image_hash)
+        return self.set_image_description(context)
+
+    async def aset_image_context(self, img) -> str:
+        """
+        Async version of `set_image_context`.
+        """
+        image_hash = dhash(img)
+        context = context_cache.find(self.image_to_text_model_name, image_hash)
+        if context is None:
+            response = await self.image_to_text_model.agenerate_content(
+                self.image_context_prompt(img)
+            )
+            context = self.image_description(response, image_hash)
+        return self.set_image_description(context)
+
+    def image_description(self, response, image_hash: int) -> str:
+        """
+        Records the usage of the image to text call and caches the generated description.
+
+        Args:
+            response: The response of the image to text model.
+            image_hash (int): Perceptual hash of the image.
 
-        self.image = img
+        Returns:
+            str: The generated description of image.
+        """
+        self.usage.record_response("set_image_context", response)
+        context_cache.add(self.image_to_text_model_name, image_hash, response.text)
+        return response.text
+
+    def image_context_prompt(self, img) -> list:
+        """
+        Builds the prompt asking the image to text model for a description of the image.
+
+        Args:
+            img: The image file to be used as context.
+
+        Returns:
+            list: The prompt and the image.
+        """
 
         prompt = """
             **Objective:** Generate a comprehensive and detailed description of the provided image, focusing on aspects that will be useful for subsequent story generation.
@@ -203,8 +295,19 @@ class StoryGenerator:
 
         """
 
-        self.image_prompt = [prompt, self.image]
-        self.context = self.image_to_text_model.generate_content(self.image_prompt).text
+        return [prompt, img]
+
+    def set_image_description(self, context: str) -> str:
+        """
+        Sets the generated description of the image as the context of the story.
+
+        Args:
+            context (str): The description of the image.
+
+        Returns:
+           str: The generated description of image.
+        """
+        self.context = context
         self.prompt_template = """
             Generate a story based on the context provide in the STORY_CONTEXT section 
             - Follow the instructions from INSTRUCTIONS section
@@ -216,6 +319,7 @@ class StoryGenerator:
             {context_placeholder}
         """
         self.input_variables = ["instructions_placeholder", "context_placeholder"]
+        return self.context
 
     def generate_response(self) -> str:
         """
@@ -232,46 +336,130 @@ class StoryGenerator:
         try:
 
             logging.info("Generating story ...")
-
-            # Set up a parser + inject instructions into the prompt template.
-            parser = JsonOutputParser(pydantic_object=Story)
-
-            self.prompt = PromptTemplate(
-                template=self.prompt_template,
-                input_variables=self.input_variables,
-                partial_variables={
-                    "format_instructions": parser.get_format_instructions()
-                },
-            )
-            if "context_placeholder" in self.input_variables:
-                chain = self.prompt | self.llm | parser
-
-                self.response = chain.invoke(
-                    {
-                        "instructions_placeholder": self.instrucitons,
-                        "context_placeholder": self.context,
-                    },
-                )
-            else:
-                if self.topic is None:
-                    self.topic = "Random"
-
-                chain = self.prompt | self.llm | parser
-                self.response = chain.invoke(
-                    {
-                        "instructions_placeholder": self.instrucitons,
-                        "TOPIC": self.topic,
-                    },
-                )
-
+            self.response = self.llm.invoke_chain(*self.response_chain())
             logging.info("story generated ...")
-            logging.info(f"Story: {self.response}")
+            logging.info("Story: %s", self.response, extra={"payload": True})
 
             return self.response
 
         except Exception as e:
             raise e
 
+    async def agenerate_response(self) -> str:
+        """
+        Async version of `generate_response`.
+        """
+        logging.info("Generating story ...")
+        self.response = await self.llm.ainvoke_chain(*self.response_chain())
+        logging.info("story generated ...")
+        logging.info("Story: %s", self.response, extra={"payload": True})
+
+        return self.response
+
+    def response_chain(self) -> tuple:
+        """
+        Builds the prompt, parser, inputs and callbacks of the story generation chain.
+
+        Returns:
+            tuple: The arguments of `TextModel.invoke_chain`.
+        """
+        # Set up a parser + inject instructions into the prompt template.
+        parser = JsonOutputParser(pydantic_object=Story)
+
+        self.prompt = PromptTemplate(
+            template=self.prompt_template,
+            input_variables=self.input_variables,
+            partial_variables={"format_instructions": parser.get_format_instructions()},
+        )
+        if "context_placeholder" in self.input_variables:
+            inputs = {
+                "instructions_placeholder": self.instrucitons,
+                "context_placeholder": self.context,
+            }
+        else:
+            if self.topic is None:
+                self.topic = "Random"
+
+            inputs = {
+                "instructions_placeholder": self.instrucitons,
+                "TOPIC": self.topic,
+            }
+
+        return self.prompt, parser, inputs, [self.usage.callback("generate_response")]
+
+    def regenerate_part(self, story: dict, part_id: str, instructions: str = None) -> str:
+        """
+        Rewrites the text of a single part of a generated story in one model call.
+
+        The title, introduction and neighbouring parts are given as context, and the image
+        prompt of the part so the text stays consistent with the characters of its image.
+
+        Args:
+            story (dict): The generated story.
+            part_id (str): Id of the part e.g. "part_2".
+            instructions (str, optional): What the reader wants changed. Defaults to None.
+
+        Returns:
+            str: The new text of the part.
+        """
+        parts = story.get("story")
+        ids = list(parts)
+        n_part = ids.index(part_id)
+        previous_part = parts[ids[n_part - 1]].get("story") if n_part > 0 else "(none)"
+        next_part = parts[ids[n_part + 1]].get("story") if n_part + 1 < len(ids) else "(none)"
+        part = parts[part_id]
+
+        parser = JsonOutputParser(pydantic_object=StoryPart)
+        prompt = PromptTemplate(
+            template="""
+                Rewrite the part of the story given in PART_TO_REWRITE, keeping it in the same story.
+                - Keep about {n_words} words, the same characters, setting and tone.
+                - It must follow from PREVIOUS_PART and lead to NEXT_PART.
+                - The characters must match their description in IMAGE_PROMPT.
+                - The story theme is {theme} and its inspiration is {inspiration}.
+                - Follow the READER_INSTRUCTIONS.
+
+                TITLE: {title}
+
+                INTRODUCTION: {introduction}
+
+                PREVIOUS_PART: {previous_part}
+
+                PART_TO_REWRITE: {part}
+
+                NEXT_PART: {next_part}
+
+                IMAGE_PROMPT: {image_prompt}
+
+                READER_INSTRUCTIONS: {instructions}
+
+                {format_instructions}
+            """,
+            input_variables=[
+                "n_words", "theme", "inspiration", "title", "introduction",
+                "previous_part", "part", "next_part", "image_prompt", "instructions",
+            ],
+            partial_variables={"format_instructions": parser.get_format_instructions()},
+        )
+        inputs = {
+            "n_words": len(part.get("story", "").split()),
+            "theme": self.story_theme,
+            "inspiration": self.story_inspiration,
+            "title": story.get("title"),
+            "introduction": story.get("introduction"),
+            "previous_part": previous_part,
+            "part": part.get("story"),
+            "next_part": next_part,
+            "image_prompt": part.get("image_prompt"),
+            "instructions": instructions or "Write it differently.",
+        }
+        logging.info(f"Regenerating the text of {part_id} ...")
+        response = self.llm.invoke_chain(
+            prompt, parser, inputs, [self.usage.callback("regenerate_part")]
+        )
+        logging.info("Part: %s", response, extra={"payload": True})
+        return response.get("story")
+
     def story_instructions(self):
         """
         Defines detailed instructions for the language model on how to generate the story.
@@ -280,6 +468,22 @@ class StoryGenerator:
         """
 
         self.story_parts = self.n_words // 200
+        self.illustrated = illustrated_parts(
+            max(self.story_parts, 1), self.image_every, self.max_images
+        )
+        if len(self.illustrated) >= self.story_parts:
+            image_parts = "for each story part"
+        elif not self.illustrated:
+            image_parts = (
+                "for no story part. The story is not illustrated and no part has an "
+                "`image_prompt` key"
+            )
+        else:
+            image_parts = (
+                "only for the story parts "
+                + ", ".join(f"part_{n}" for n in self.illustrated)
+                + ". The other parts are not illustrated and have no `image_prompt` key"
+            )
         self.instrucitons = f"""
             You are an expert storyteller and visual content creator. Your task is to generate a compelling and visually engaging story based on provided context. The output should be structured for easy integration into a web application.
 
@@ -300,7 +504,7 @@ class StoryGenerator:
 
             **IMAGE PROMPT GENERATION GUIDELINES (For Each Story Part):**
 
-            1.  **Purpose:** Generate a unique and clear image prompt for each story part, designed to guide a separate image generation model.
+            1.  **Purpose:** Generate a unique and clear image prompt {image_parts}, designed to guide a separate image generation model.
             2.  **Content Alignment:** Each image prompt MUST directly and accurately reflect the content of its corresponding story part. The visuals described in the prompt should be immediately recognizable as elements from the specific part of the narrative.
             3.  **Visual Style & Consistency:** 
                 *   **Background:** The images generated using these prompts MUST have a light and predominantly white background to facilitate the overlay of text.
@@ -345,7 +549,7 @@ class StoryGenerator:
             3.  **Story Parts:** The `story` object will be a nested structure where each key represents a story part number (e.g., `part_1`, `part_2`, etc.).
             4.  **Part Contents:** Each story part (e.g., `part_1`, `part_2`, etc.) will be a nested JSON object with the following keys:
                 *   `story`: The generated content of that particular story part.
-                *   `image_prompt`: The image prompt for that specific story part.
+                *   `image_prompt`: The image prompt for that specific story part, if it is illustrated.
 
             **Example JSON structure:**
 
@@ -0,0 +1,255 @@
+"""
+Module providing hedged requests, to cut the tail latency of slow model calls.
+
+A hedged call sends the request once, and if it has not returned after a delay set from a
+percentile of the recent latencies, sends it a second time and uses the first response.
+The other response is discarded. The share of hedged calls is capped, so a slow model is
+not sent twice the load.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from src.metrics import metrics
+from src.profiling import run_in_session
+
+metrics.describe("image_hedges_total", "Hedge image generation calls sent")
+metrics.describe("image_hedge_wins_total", "Hedge calls which returned first")
+metrics.describe("image_hedges_denied_total", "Hedge calls not sent, hedge rate cap reached")
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent successful calls.
+
+    Attributes:
+        latencies (deque): Latencies of the recent calls in seconds.
+        min_samples (int): Minimum number of latencies before percentiles are computed.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Initializes the LatencyTracker.
+
+        Args:
+            window (int, optional): Number of latencies kept. Defaults to 200.
+            min_samples (int, optional): Minimum number of latencies before percentiles are
+                computed. Defaults to 20.
+        """
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, latency: float):
+        """
+        Records the latency of a successful call.
+
+        Args:
+            latency (float): The latency in seconds.
+        """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Args:
+            percentile (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The latency at the percentile, None if there are not enough latencies.
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(round(percentile / 100 * (len(latencies) - 1)), len(latencies) - 1)
+        return latencies[index]
+
+
+class Hedger:
+    """
+    Sends a second request when the first is slower than usual.
+
+    The settings are read from the environment on each call:
+
+        - `IMAGE_HEDGING`: "1" to hedge the calls, off by default.
+        - `HEDGE_PERCENTILE` (default 95): percentile of the recent latencies after which
+          the call is hedged.
+        - `HEDGE_DEFAULT_DELAY_SECONDS` (default 20): delay used until enough latencies are known.
+        - `HEDGE_MAX_RATE` (default 0.1): maximum share of the recent calls which are hedged.
+
+    Attributes:
+        tracker (LatencyTracker): Latencies of the recent calls.
+        calls (deque): Start times of the recent calls.
+        hedges (deque): Start times of the recent hedges.
+    """
+
+    def __init__(self, window: int = 200):
+        """
+        Initializes the Hedger.
+
+        Args:
+            window (int, optional): Number of recent calls the latency percentile and the
+                hedge rate are computed on. Defaults to 200.
+        """
+        self.tracker = LatencyTracker(window=window)
+        self.calls = deque(maxlen=window)
+        self.hedges = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        """
+        Returns:
+            bool: Whether calls are hedged.
+        """
+        return os.getenv("IMAGE_HEDGING", "0").lower() in ("1", "true", "yes")
+
+    def delay(self) -> float:
+        """
+        Returns:
+            float: Seconds to wait for the first request before sending the hedge.
+        """
+        delay = self.tracker.percentile(float(os.getenv("HEDGE_PERCENTILE", 95)))
+        if delay is None:
+            delay = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", 20))
+        return delay
+
+    def start_call(self):
+        """
+        Records the start of a call, for the hedge rate.
+        """
+        with self.lock:
+            self.calls.append(time.time())
+
+    def allow_hedge(self) -> bool:
+        """
+        Checks the hedge rate cap, and records the hedge if allowed.
+
+        Returns:
+            bool: Whether the hedge may be sent.
+        """
+        max_rate = float(os.getenv("HEDGE_MAX_RATE", 0.1))
+        with self.lock:
+            oldest_call = self.calls[0]
+            recent_hedges = sum(1 for started in self.hedges if started >= oldest_call)
+            if recent_hedges + 1 > max_rate * len(self.calls):
+                metrics.inc("image_hedges_denied_total")
+                return False
+            self.hedges.append(time.time())
+        metrics.inc("image_hedges_total")
+        return True
+
+    def tracked(self, fn, *args, **kwargs):
+        """
+        Runs a call and records its latency if it succeeds.
+        """
+        started = time.time()
+        result = fn(*args, **kwargs)
+        self.tracker.record(time.time() - started)
+        return result
+
+    def submit(self, executor, fn, *args, **kwargs):
+        """
+        Submits a tracked call to the executor, in a copy of the current context.
+
+        Returns:
+            Future: The future of the call.
+        """
+        return executor.submit(
+            contextvars.copy_context().run, run_in_session, self.tracked, fn, *args, **kwargs
+        )
+
+    async def atracked(self, fn, *args, **kwargs):
+        """
+        Async version of `tracked`.
+        """
+        started = time.time()
+        result = await fn(*args, **kwargs)
+        self.tracker.record(time.time() - started)
+        return result
+
+    def call(self, executor, fn, *args, can_hedge: bool = True, on_hedge=None, **kwargs):
+        """
+        Calls `fn`, hedged when the call is slower than usual.
+
+        Args:
+            executor (Executor): Runs the requests.
+            fn (callable): The call.
+            *args: Positional arguments of the call.
+            can_hedge (bool, optional): Whether a hedge may be sent e.g. within the image budget.
+                Defaults to True.
+            on_hedge (callable, optional): Called when the hedge is sent.
+            **kwargs: Keyword arguments of the call.
+
+        Returns:
+            The result of the first request to succeed.
+
+        Raises:
+            Exception: The error of the last request to fail, if none succeeds.
+        """
+        self.start_call()
+        pending = {self.submit(executor, fn, *args, **kwargs)}
+        done, pending = wait(pending, timeout=self.delay())
+
+        if pending and can_hedge and self.allow_hedge():
+            logging.info("Image generation slower than usual, sending a hedge request")
+            if on_hedge is not None:
+                on_hedge()
+            hedge = self.submit(executor, fn, *args, **kwargs)
+            pending.add(hedge)
+        else:
+            hedge = None
+
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.inc("image_hedge_wins_total")
+                    # the other request keeps running on its thread, its result is discarded
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+            if not pending:
+                raise future.exception()
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    async def acall(self, fn, *args, can_hedge: bool = True, on_hedge=None, **kwargs):
+        """
+        Async version of `call`, `fn` is a coroutine function. The slower request is cancelled.
+        """
+        self.start_call()
+        pending = {asyncio.ensure_future(self.atracked(fn, *args, **kwargs))}
+        done, pending = await asyncio.wait(pending, timeout=self.delay())
+
+        if pending and can_hedge and self.allow_hedge():
+            logging.info("Image generation slower than usual, sending a hedge request")
+            if on_hedge is not None:
+                on_hedge()
+            hedge = asyncio.ensure_future(self.atracked(fn, *args, **kwargs))
+            pending.add(hedge)
+        else:
+            hedge = None
+
+        try:
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.inc("image_hedge_wins_total")
+                        return task.result()
+                if not pending:
+                    raise task.exception()
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+image_hedger = Hedger()
@@ -0,0 +1,224 @@
+"""
+Module providing the HTTP caching and compression of the story pages and static assets.
+
+    - Asset URLs carry a hash of the file content (`?v=<hash>`), so an asset whose file name is
+      reused e.g. `part_1.png` gets a new URL when its content changes, and the versioned URLs are
+      cached by the browsers for a year as immutable.
+    - HTML, CSS and JSON responses are compressed with brotli when the client and the server
+      support it, else with gzip. The compressible static files are compressed once at startup
+      and the compressed variant is served as is.
+    - Pages are sent with an ETag of their content and `Cache-Control: no-cache`, so a repeated
+      view is answered with `304 Not Modified` and no body.
+
+Brotli is optional: without the `brotli` package only gzip is used.
+"""
+
+import os
+import gzip
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE_TYPES = ("text/html", "text/css", "text/plain", "application/json", "application/javascript")
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".json", ".html", ".txt")
+# extensions of the precompressed variants by content encoding
+ENCODING_EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+
+def compress_min_bytes() -> int:
+    """
+    Returns:
+        int: Smallest body compressed, from `HTTP_COMPRESS_MIN_BYTES` (default 1024).
+    """
+    return int(os.getenv("HTTP_COMPRESS_MIN_BYTES", 1024))
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """
+    Picks the content encoding of a response.
+
+    Args:
+        accept_encoding (str): The `Accept-Encoding` header of the request.
+
+    Returns:
+        str: "br", "gzip" or None if the client accepts neither.
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Args:
+        body (bytes): The body of the response.
+        encoding (str): "br" or "gzip".
+
+    Returns:
+        bytes: The compressed body.
+    """
+    if encoding == "br":
+        # quality 5 compresses the story pages about as well as 11 at a fraction of the time
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def etag(body: bytes, encoding: str = None) -> str:
+    """
+    Args:
+        body (bytes): The uncompressed body of the response.
+        encoding (str, optional): Content encoding of the response, each encoding is a
+            different representation with its own tag. Defaults to None.
+
+    Returns:
+        str: The entity tag of the response, without quotes.
+    """
+    tag = hashlib.sha256(body).hexdigest()[:32]
+    return f"{tag}-{encoding}" if encoding else tag
+
+
+class AssetVersions:
+    """
+    Content hashes of the asset files, recomputed when a file changes.
+
+    Attributes:
+        max_files (int): Number of files whose hash is kept.
+        versions (OrderedDict): (mtime, size, hash) by path, least recently used first.
+    """
+
+    def __init__(self, max_files: int = 10000):
+        """
+        Initializes the AssetVersions.
+
+        Args:
+            max_files (int, optional): Number of files whose hash is kept. Defaults to 10000.
+        """
+        self.max_files = max_files
+        self.versions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def version(self, path: str) -> str:
+        """
+        Args:
+            path (str): Path to the file.
+
+        Returns:
+            str: A short hash of the content of the file, None if it does not exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.versions.get(path)
+            if cached is not None and cached[0] == key:
+                self.versions.move_to_end(path)
+                return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        version = digest.hexdigest()[:12]
+
+        with self.lock:
+            self.versions[path] = (key, version)
+            self.versions.move_to_end(path)
+            while len(self.versions) > self.max_files:
+                self.versions.popitem(last=False)
+        return version
+
+
+asset_versions = AssetVersions()
+
+
+def asset_url(path: str) -> str:
+    """
+    Adds the content hash of an asset to its path.
+
+    Args:
+        path (str): Path to the asset e.g. "static/stories/<id>/part_1.png", None for no asset.
+
+    Returns:
+        str: The path with the `v` parameter, the path as is if the file does not exist.
+    """
+    if path is None:
+        return None
+    version = asset_versions.version(path)
+    return f"{path}?v={version}" if version else path
+
+
+def precompressed_file(path: str, encoding: str) -> str:
+    """
+    Args:
+        path (str): Path to the static file.
+        encoding (str): "br" or "gzip", None for no encoding.
+
+    Returns:
+        str: Path to the compressed variant of the file, None if there is no up to date one.
+    """
+    if encoding is None:
+        return None
+    compressed = path + ENCODING_EXTENSIONS[encoding]
+    try:
+        if os.path.getmtime(compressed) >= os.path.getmtime(path):
+            return compressed
+    except OSError:
+        pass
+    return None
+
+
+def precompress_static(static_dir: str, exclude: tuple = ()) -> int:
+    """
+    Writes the gzip and brotli variants of the compressible static files which are missing or
+    older than their file.
+
+    Args:
+        static_dir (str): Directory of the static files.
+        exclude (tuple, optional): Sub directories not walked e.g. the generated images.
+            Defaults to none.
+
+    Returns:
+        int: Number of files written.
+    """
+    encodings = ["gzip"] + (["br"] if brotli is not None else [])
+    written = 0
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir:
+            dirs[:] = [name for name in dirs if name not in exclude]
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            for encoding in encodings:
+                if precompressed_file(path, encoding):
+                    continue
+                with open(path, "rb") as f:
+                    body = f.read()
+                with open(path + ENCODING_EXTENSIONS[encoding], "wb") as f:
+                    f.write(compress(body, encoding))
+                written += 1
+    if written:
+        logging.info(f"{written} compressed static files written")
+    return written
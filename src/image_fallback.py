@@ -0,0 +1,190 @@
+"""
+Module providing fallback images for story parts whose image could not be generated in time.
+
+A part can fall back to a previously generated image with a similar prompt, or to a
+placeholder rendered locally as a gradient of the story's colors.
+"""
+
+import os
+import re
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from PIL import Image
+from src.theme_generator import HEX_COLOR, color_luminance
+
+WORD = re.compile(r"[a-z]+")
+
+
+def prompt_words(prompt: str) -> frozenset:
+    """
+    Splits a prompt into the set of its lower cased words of more than 3 letters.
+
+    Args:
+        prompt (str): The image prompt.
+
+    Returns:
+        frozenset: The words of the prompt.
+    """
+    return frozenset(word for word in WORD.findall(prompt.lower()) if len(word) > 3)
+
+
+class ImageFallbackCache:
+    """
+    A bounded LRU cache of generated images, looked up by the similarity of their prompts.
+
+    Images are copied into the cache directory as the part images of a story can be
+    overwritten by the next story.
+
+    Attributes:
+        cache_dir (str): Directory where the cached images are stored.
+        max_images (int): Maximum number of cached images.
+        min_similarity (float): Minimum Jaccard similarity of the prompt words for a match.
+        entries (OrderedDict): Words of the prompt by cached image path, least recently used first.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = os.path.join("static", "images", "cache"),
+        max_images: int = None,
+        min_similarity: float = None,
+    ):
+        """
+        Initializes the ImageFallbackCache.
+
+        Args:
+            cache_dir (str, optional): Directory where the cached images are stored.
+                Defaults to "static/images/cache".
+            max_images (int, optional): Maximum number of cached images.
+                Defaults to `IMAGE_CACHE_SIZE` from the environment or 200.
+            min_similarity (float, optional): Minimum prompt similarity for a match.
+                Defaults to `IMAGE_CACHE_MIN_SIMILARITY` from the environment or 0.5.
+        """
+        self.cache_dir = cache_dir
+        self.max_images = max_images or int(os.getenv("IMAGE_CACHE_SIZE", 200))
+        self.min_similarity = min_similarity or float(
+            os.getenv("IMAGE_CACHE_MIN_SIMILARITY", 0.5)
+        )
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, prompt: str, image_file: str):
+        """
+        Adds a generated image to the cache.
+
+        Args:
+            prompt (str): The prompt the image was generated from.
+            image_file (str): Path to the generated image.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        name = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+        cached_file = os.path.join(self.cache_dir, f"{name}.png")
+        shutil.copyfile(image_file, cached_file)
+
+        with self.lock:
+            self.entries[cached_file] = prompt_words(prompt)
+            self.entries.move_to_end(cached_file)
+            while len(self.entries) > self.max_images:
+                evicted, _ = self.entries.popitem(last=False)
+                if os.path.exists(evicted):
+                    os.remove(evicted)
+
+    def find(self, prompt: str) -> str:
+        """
+        Finds the cached image with the most similar prompt.
+
+        Args:
+            prompt (str): The prompt of the image to replace.
+
+        Returns:
+            str: Path to the cached image, None if no image is similar enough.
+        """
+        words = prompt_words(prompt)
+        best_file, best_similarity = None, 0
+
+        with self.lock:
+            for cached_file, cached_words in self.entries.items():
+                union = len(words | cached_words)
+                similarity = len(words & cached_words) / union if union else 0
+                if similarity > best_similarity:
+                    best_file, best_similarity = cached_file, similarity
+            if best_similarity < self.min_similarity:
+                return None
+            self.entries.move_to_end(best_file)
+
+        logging.info(f"Similar cached image found, similarity {best_similarity:.2f}")
+        return best_file
+
+
+def render_placeholder(image_file: str, colors: list, size: tuple = (512, 512)):
+    """
+    Renders a vertical gradient from the darkest to the lightest of the given colors.
+
+    Args:
+        image_file (str): Path to the file where the placeholder should be saved.
+        colors (list): Hex color codes e.g. the palette from the image prompt.
+        size (tuple, optional): Width and height of the placeholder. Defaults to (512, 512).
+    """
+    colors = sorted(set(color.upper() for color in colors), key=color_luminance)
+    if len(colors) < 2:
+        colors = ["#D9D9D9", "#FFFFFF"]
+    top, bottom = (
+        [int(color[i : i + 2], 16) for i in (1, 3, 5)] for color in (colors[-1], colors[0])
+    )
+
+    height = size[1]
+    gradient = Image.new("RGB", (1, height))
+    for y in range(height):
+        ratio = y / max(height - 1, 1)
+        gradient.putpixel(
+            (0, y), tuple(round(t + (b - t) * ratio) for t, b in zip(top, bottom))
+        )
+    with gradient.resize(size) as placeholder:
+        placeholder.save(image_file)
+    gradient.close()
+
+
+def fallback_image(
+    prompt: str,
+    image_file: str,
+    cache: ImageFallbackCache = None,
+    colors: list = None,
+    methods: list = None,
+) -> str:
+    """
+    Creates a fallback for a part image which could not be generated.
+
+    Args:
+        prompt (str): The prompt of the image.
+        image_file (str): Path where the part image is expected.
+        cache (ImageFallbackCache, optional): Cache searched for a similar image.
+        colors (list, optional): Colors of the placeholder, the colors of the prompt are used first.
+        methods (list, optional): Fallbacks to try in order, "cache" and/or "placeholder".
+            Defaults to `IMAGE_FALLBACKS` from the environment or "cache,placeholder".
+
+    Returns:
+        str: The fallback used, "cache" or "placeholder", None if the part should be text only.
+    """
+    if methods is None:
+        methods = os.getenv("IMAGE_FALLBACKS", "cache,placeholder").split(",")
+
+    for method in (method.strip() for method in methods):
+        if method == "cache" and cache is not None:
+            cached_file = cache.find(prompt)
+            if cached_file:
+                try:
+                    shutil.copyfile(cached_file, image_file)
+                    return method
+                except OSError:
+                    # evicted by another story since it was found
+                    continue
+        elif method == "placeholder":
+            render_placeholder(image_file, HEX_COLOR.findall(prompt) or colors or [])
+            return method
+
+    return None
+
+
+image_cache = ImageFallbackCache()
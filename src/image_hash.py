@@ -0,0 +1,49 @@
+"""
+Module providing perceptual hashes of images.
+
+Unlike a hash of the file, a perceptual hash changes little when an image is re-encoded,
+resized or slightly edited, so copies of the same image can be matched by the number of
+differing bits of their hashes.
+"""
+
+from PIL import Image
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """
+    Computes the difference hash of an image: whether each pixel of a grayscale thumbnail is
+    brighter than its right neighbour.
+
+    Args:
+        image (Image.Image): The image.
+        hash_size (int, optional): Width and height of the hash, in bits. Defaults to 8 (64 bits).
+
+    Returns:
+        int: The hash.
+    """
+    with image.convert("L").resize(
+        (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+    ) as thumbnail:
+        pixels = list(thumbnail.getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """
+    Counts the bits which differ between two hashes.
+
+    Args:
+        hash_a (int): The first hash.
+        hash_b (int): The second hash.
+
+    Returns:
+        int: The number of differing bits, 0 for identical hashes.
+    """
+    return bin(hash_a ^ hash_b).count("1")
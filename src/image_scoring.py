@@ -0,0 +1,280 @@
+"""
+Module providing local scores to pick the best of several candidate images of a story part.
+
+    - Palette: how close the colors of the image are to the colors of the story.
+    - Text space: whether a corner of the image is plain enough for the text, as the image
+      prompts ask for 1/3 of a corner to be kept free.
+    - Consistency: perceptual similarity to the image of the previous part, so characters and
+      settings look the same across the story.
+
+The candidates which are not picked are kept in a cache, so the image of a part can be
+regenerated instantly with the next best candidate. They are written to disk by a background
+thread, off the path of the story.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import ImageStat
+from src.image_hash import dhash, hamming_distance
+from src.memory import release_image
+
+SCORE_WEIGHTS = {"palette": 0.4, "text_space": 0.3, "consistency": 0.3}
+# largest distance between two RGB colors
+MAX_COLOR_DISTANCE = (3 * 255**2) ** 0.5
+
+
+def hex_to_rgb(hex_color: str) -> tuple:
+    """
+    Args:
+        hex_color (str): The color as a six digit hex code e.g. "#A3B5C7".
+
+    Returns:
+        tuple: The red, green and blue components.
+    """
+    return tuple(int(hex_color[i : i + 2], 16) for i in (1, 3, 5))
+
+
+def palette_score(image, colors: list) -> float:
+    """
+    Scores how close the pixels of an image are to the nearest of the given colors.
+
+    Args:
+        image (Image.Image): The image.
+        colors (list): Hex color codes of the story.
+
+    Returns:
+        float: The score between 0 and 1, None if there are no colors to compare with.
+    """
+    if not colors:
+        return None
+    targets = [hex_to_rgb(color) for color in colors]
+    with image.convert("RGB") as rgb, rgb.resize((32, 32)) as thumbnail:
+        pixels = list(thumbnail.getdata())
+
+    distance = sum(
+        min(
+            sum((p - t) ** 2 for p, t in zip(pixel, target)) ** 0.5 for target in targets
+        )
+        for pixel in pixels
+    ) / len(pixels)
+    return 1 - distance / MAX_COLOR_DISTANCE
+
+
+def text_space_score(image, fraction: float = 1 / 3) -> float:
+    """
+    Scores how plain the plainest corner of an image is, from the spread of its brightness.
+
+    Args:
+        image (Image.Image): The image.
+        fraction (float, optional): Width and height of the corners as a fraction of the image.
+            Defaults to 1/3.
+
+    Returns:
+        float: The score between 0 and 1, 1 for a corner of a single color.
+    """
+    size = 96
+    corner = round(size * fraction)
+    with image.convert("L") as gray, gray.resize((size, size)) as thumbnail:
+        stddevs = []
+        for left, top in ((0, 0), (size - corner, 0), (0, size - corner), (size - corner, size - corner)):
+            with thumbnail.crop((left, top, left + corner, top + corner)) as region:
+                stddevs.append(ImageStat.Stat(region).stddev[0])
+    # a standard deviation of 64 (a quarter of the range) or more counts as busy
+    return max(1 - min(stddevs) / 64, 0)
+
+
+def consistency_score(image, previous_hash: int) -> float:
+    """
+    Scores the perceptual similarity of an image to the image of the previous part.
+
+    Args:
+        image (Image.Image): The image.
+        previous_hash (int): Perceptual hash of the previous image, None for the first part.
+
+    Returns:
+        float: The score between 0 and 1, None if there is no previous image.
+    """
+    if previous_hash is None:
+        return None
+    return 1 - hamming_distance(dhash(image), previous_hash) / 64
+
+
+def score_image(image, colors: list = None, previous_hash: int = None) -> dict:
+    """
+    Scores a candidate image.
+
+    Args:
+        image (Image.Image): The image.
+        colors (list, optional): Hex color codes of the story.
+        previous_hash (int, optional): Perceptual hash of the image of the previous part.
+
+    Returns:
+        dict: The score of each criterion and their weighted `total`, criteria which do not
+            apply are left out.
+    """
+    scores = {
+        "palette": palette_score(image, colors),
+        "text_space": text_space_score(image),
+        "consistency": consistency_score(image, previous_hash),
+    }
+    scores = {name: score for name, score in scores.items() if score is not None}
+    weights = sum(SCORE_WEIGHTS[name] for name in scores)
+    scores["total"] = sum(SCORE_WEIGHTS[name] * score for name, score in scores.items()) / weights
+    return scores
+
+
+def rank_images(images: list, colors: list = None, previous_hash: int = None) -> list:
+    """
+    Orders candidate images from the best to the worst.
+
+    Args:
+        images (list): The generated images, with their PIL image in `_pil_image`.
+        colors (list, optional): Hex color codes of the story.
+        previous_hash (int, optional): Perceptual hash of the image of the previous part.
+
+    Returns:
+        list: The (scores, image) pairs, best first.
+    """
+    ranked = [(score_image(image._pil_image, colors, previous_hash), image) for image in images]
+    return sorted(ranked, key=lambda ranked_image: ranked_image[0]["total"], reverse=True)
+
+
+class RunnerUpCache:
+    """
+    A bounded LRU cache of the candidate images which were not picked, by image prompt.
+
+    Attributes:
+        cache_dir (str): Directory where the images are stored.
+        max_prompts (int): Maximum number of prompts whose candidates are kept.
+        entries (OrderedDict): Image files by prompt key, best first, least recently used first.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = os.path.join("static", "images", "candidates"),
+        max_prompts: int = None,
+    ):
+        """
+        Initializes the RunnerUpCache.
+
+        Args:
+            cache_dir (str, optional): Directory where the images are stored.
+                Defaults to "static/images/candidates".
+            max_prompts (int, optional): Maximum number of prompts whose candidates are kept.
+                Defaults to `IMAGE_RUNNER_UP_CACHE_SIZE` from the environment or 100.
+        """
+        self.cache_dir = cache_dir
+        self.max_prompts = max_prompts or int(os.getenv("IMAGE_RUNNER_UP_CACHE_SIZE", 100))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # a single thread writes and deletes the files in order, so a file is never deleted
+        # or moved before it is written
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="runner-ups")
+
+    def key(self, prompt: str) -> str:
+        """
+        Returns:
+            str: The key of a prompt, also the prefix of its image files.
+        """
+        return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+    def remove(self, image_files: list):
+        """
+        Deletes the image files which are no longer cached, on the writer thread.
+        """
+        self.writer.submit(self.delete, list(image_files))
+
+    def delete(self, image_files: list):
+        """
+        Deletes image files, on the writer thread.
+        """
+        for image_file in image_files:
+            if os.path.exists(image_file):
+                os.remove(image_file)
+
+    def write(self, image_file: str, image):
+        """
+        Saves a candidate and releases it, on the writer thread.
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            image.save(image_file, include_generation_parameters=False)
+        except Exception as e:
+            logging.info(f"Runner up candidate {image_file} not saved ({e!r})")
+        finally:
+            release_image(image)
+
+    def add(self, prompt: str, images: list):
+        """
+        Keeps the candidates which were not picked for a prompt.
+
+        The images are saved and released by the writer thread, the call does not wait for them.
+
+        Args:
+            prompt (str): The image prompt.
+            images (list): The generated images, best first.
+        """
+        if not images:
+            return
+        key = self.key(prompt)
+        image_files = [
+            os.path.join(self.cache_dir, f"{key}_{n}.png") for n in range(len(images))
+        ]
+
+        with self.lock:
+            replaced = self.entries.pop(key, [])
+            self.remove(set(replaced) - set(image_files))
+            for image_file, image in zip(image_files, images):
+                self.writer.submit(self.write, image_file, image)
+            self.entries[key] = image_files
+            while len(self.entries) > self.max_prompts:
+                _, evicted = self.entries.popitem(last=False)
+                self.remove(evicted)
+
+    def pop(self, prompt: str, image_file: str) -> bool:
+        """
+        Moves the best remaining candidate of a prompt to the image file.
+
+        Args:
+            prompt (str): The image prompt.
+            image_file (str): Path where the image should be saved.
+
+        Returns:
+            bool: True if a candidate was used, False if there is none left.
+        """
+        key = self.key(prompt)
+        with self.lock:
+            image_files = self.entries.get(key)
+            if not image_files:
+                return False
+            candidate = image_files.pop(0)
+            if image_files:
+                self.entries.move_to_end(key)
+            else:
+                del self.entries[key]
+            # queued after the write of the candidate and before a new one of the same name
+            moved = self.writer.submit(self.move, candidate, image_file)
+        if not moved.result():
+            return False
+        logging.info(f"Image replaced with a runner up candidate, {len(image_files)} left")
+        return True
+
+    def move(self, candidate: str, image_file: str) -> bool:
+        """
+        Moves a candidate to the image file, on the writer thread.
+
+        Returns:
+            bool: False if the candidate could not be saved.
+        """
+        if not os.path.exists(candidate):
+            return False
+        shutil.move(candidate, image_file)
+        return True
+
+
+runner_ups = RunnerUpCache()
@@ -0,0 +1,343 @@
+"""
+Module providing a durable queue of the story jobs, to generate the stories in worker processes.
+
+The web tier enqueues a job and waits for its result, while the workers (`python -m src.worker`)
+lease the jobs, renew their lease with heartbeats while they run and store the result. A job
+whose lease expires, because its worker crashed or hung, is leased again by another worker
+until it runs out of attempts. A job failing because the models are unavailable is not retried,
+the web tier answers it with a 503 like a story generated in process.
+
+`JobQueue` is the interface of the queue. `SQLiteJobQueue` implements it on a local SQLite file
+shared by the processes of a node, a broker may implement it to spread the workers across nodes.
+"""
+
+import os
+import abc
+import json
+import time
+import uuid
+import sqlite3
+import logging
+from contextlib import closing
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# kind of the errors which are not retried, the models are unavailable
+CIRCUIT_OPEN = "circuit_open"
+
+
+class QueuedJob:
+    """
+    A job leased by a worker.
+
+    Attributes:
+        job_id (str): Id of the job.
+        kind (str): Kind of the job e.g. "story", which selects its handler.
+        payload (dict): Arguments of the job.
+        attempts (int): Number of times the job was leased, this one included.
+        max_attempts (int): Number of times the job is leased before it fails.
+    """
+
+    def __init__(self, job_id: str, kind: str, payload: dict, attempts: int, max_attempts: int):
+        self.job_id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+
+
+class JobQueue(abc.ABC):
+    """
+    Interface of a durable job queue with leases.
+    """
+
+    @abc.abstractmethod
+    def enqueue(self, kind: str, payload: dict, job_id: str = None, max_attempts: int = 3) -> str:
+        """
+        Adds a job to the queue.
+
+        Args:
+            kind (str): Kind of the job, which selects its handler.
+            payload (dict): JSON serializable arguments of the job.
+            job_id (str, optional): Id of the job. Defaults to a new random id.
+            max_attempts (int, optional): Number of times the job is leased before it fails.
+                Defaults to 3.
+
+        Returns:
+            str: The id of the job.
+        """
+
+    @abc.abstractmethod
+    def lease(self, worker_id: str, lease_seconds: float) -> QueuedJob:
+        """
+        Leases the oldest queued job, or a running job whose lease expired.
+
+        Args:
+            worker_id (str): Id of the worker.
+            lease_seconds (float): Seconds after which the job is leased again if not renewed.
+
+        Returns:
+            QueuedJob: The leased job, None if there is none.
+        """
+
+    @abc.abstractmethod
+    def heartbeat(self, job_id: str, worker_id: str, lease_seconds: float) -> bool:
+        """
+        Renews the lease of a running job.
+
+        Returns:
+            bool: False if the worker lost the lease, the job is then run by another worker.
+        """
+
+    @abc.abstractmethod
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        """
+        Stores the result of a job.
+
+        Returns:
+            bool: False if the worker lost the lease, the result is then discarded.
+        """
+
+    @abc.abstractmethod
+    def fail(
+        self,
+        job_id: str,
+        worker_id: str,
+        error: str,
+        error_kind: str = None,
+        retry: bool = True,
+        retry_after: float = None,
+    ) -> bool:
+        """
+        Records the failure of a job, which is queued again while it has attempts left.
+
+        Args:
+            job_id (str): Id of the job.
+            worker_id (str): Id of the worker holding the lease.
+            error (str): Description of the error.
+            error_kind (str, optional): Kind of the error e.g. "circuit_open". Defaults to None.
+            retry (bool, optional): Whether the job is queued again while it has attempts left,
+                False for an error another attempt would not fix. Defaults to True.
+            retry_after (float, optional): Seconds after which the client may retry the job.
+                Defaults to None.
+
+        Returns:
+            bool: False if the worker lost the lease.
+        """
+
+    @abc.abstractmethod
+    def get(self, job_id: str) -> dict:
+        """
+        Returns:
+            dict: The status, attempts, result and error of a job, None if unknown.
+        """
+
+    def wait(self, job_id: str, timeout: float, poll_seconds: float = 0.5) -> dict:
+        """
+        Waits for a job to be done or failed.
+
+        Args:
+            job_id (str): Id of the job.
+            timeout (float): Seconds to wait.
+            poll_seconds (float, optional): Seconds between two checks. Defaults to 0.5.
+
+        Returns:
+            dict: The job, from `get`.
+
+        Raises:
+            TimeoutError: If the job is not finished within the timeout.
+        """
+        timeout_at = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is not None and job["status"] in (DONE, FAILED):
+                return job
+            if time.time() >= timeout_at:
+                raise TimeoutError(f"Job {job_id} not finished after {timeout}s")
+            time.sleep(poll_seconds)
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue stored in a SQLite file, safe to share between the processes of a node.
+
+    Each operation opens its own connection, and leases are taken in an immediate transaction
+    so two workers never lease the same job.
+
+    Attributes:
+        path (str): Path to the SQLite file.
+        keep_seconds (float): Age after which finished jobs are deleted.
+    """
+
+    def __init__(self, path: str = os.path.join("jobs", "jobs.db"), keep_seconds: float = 86400):
+        """
+        Initializes the SQLiteJobQueue and creates its table.
+
+        Args:
+            path (str, optional): Path to the SQLite file. Defaults to "jobs/jobs.db".
+            keep_seconds (float, optional): Age after which finished jobs are deleted.
+                Defaults to a day.
+        """
+        self.path = path
+        self.keep_seconds = keep_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self.connect()) as db, db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    worker_id TEXT,
+                    lease_until REAL,
+                    result TEXT,
+                    error TEXT,
+                    error_kind TEXT,
+                    retry_after REAL,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            # queue files created before the error kinds were recorded
+            columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("error_kind", "TEXT"), ("retry_after", "REAL")):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Returns:
+            sqlite3.Connection: A new connection, in autocommit mode.
+        """
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, kind: str, payload: dict, job_id: str = None, max_attempts: int = 3) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with closing(self.connect()) as db:
+            db.execute(
+                "INSERT INTO jobs (id, kind, payload, status, max_attempts, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), QUEUED, max_attempts, now, now),
+            )
+        return job_id
+
+    def lease(self, worker_id: str, lease_seconds: float) -> QueuedJob:
+        now = time.time()
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self.expire(db, now)
+                row = db.execute(
+                    "SELECT id, kind, payload, attempts, max_attempts FROM jobs "
+                    "WHERE status = ? OR (status = ? AND lease_until < ?) "
+                    "ORDER BY created LIMIT 1",
+                    (QUEUED, RUNNING, now),
+                ).fetchone()
+                if row is None:
+                    db.execute("COMMIT")
+                    return None
+                job_id, kind, payload, attempts, max_attempts = row
+                db.execute(
+                    "UPDATE jobs SET status = ?, attempts = ?, worker_id = ?, lease_until = ?, "
+                    "updated = ? WHERE id = ?",
+                    (RUNNING, attempts + 1, worker_id, now + lease_seconds, now, job_id),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if attempts:
+            logging.info(f"Job {job_id} leased again by {worker_id}, attempt {attempts + 1}")
+        return QueuedJob(job_id, kind, json.loads(payload), attempts + 1, max_attempts)
+
+    def expire(self, db: sqlite3.Connection, now: float):
+        """
+        Fails the jobs whose lease expired on their last attempt, and deletes the old finished
+        jobs. Called within the lease transaction.
+        """
+        db.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? "
+            "WHERE status = ? AND lease_until < ? AND attempts >= max_attempts",
+            (FAILED, "Lease expired on the last attempt", now, RUNNING, now),
+        )
+        db.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+            (DONE, FAILED, now - self.keep_seconds),
+        )
+
+    def heartbeat(self, job_id: str, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with closing(self.connect()) as db:
+            updated = db.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ? "
+                "WHERE id = ? AND worker_id = ? AND status = ?",
+                (now + lease_seconds, now, job_id, worker_id, RUNNING),
+            ).rowcount
+        return updated == 1
+
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        with closing(self.connect()) as db:
+            updated = db.execute(
+                "UPDATE jobs SET status = ?, result = ?, lease_until = NULL, updated = ? "
+                "WHERE id = ? AND worker_id = ? AND status = ?",
+                (DONE, json.dumps(result), time.time(), job_id, worker_id, RUNNING),
+            ).rowcount
+        return updated == 1
+
+    def fail(
+        self,
+        job_id: str,
+        worker_id: str,
+        error: str,
+        error_kind: str = None,
+        retry: bool = True,
+        retry_after: float = None,
+    ) -> bool:
+        with closing(self.connect()) as db:
+            updated = db.execute(
+                "UPDATE jobs SET status = CASE WHEN ? OR attempts >= max_attempts THEN ? ELSE ? END, "
+                "error = ?, error_kind = ?, retry_after = ?, worker_id = NULL, lease_until = NULL, "
+                "updated = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                (
+                    not retry, FAILED, QUEUED, error, error_kind, retry_after, time.time(),
+                    job_id, worker_id, RUNNING,
+                ),
+            ).rowcount
+        return updated == 1
+
+    def get(self, job_id: str) -> dict:
+        with closing(self.connect()) as db:
+            row = db.execute(
+                "SELECT id, kind, status, attempts, max_attempts, worker_id, result, error, "
+                "error_kind, retry_after, created, updated FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = (
+            "id", "kind", "status", "attempts", "max_attempts", "worker_id", "result",
+            "error", "error_kind", "retry_after", "created", "updated",
+        )
+        job = dict(zip(keys, row))
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+def job_queue_from_env() -> JobQueue:
+    """
+    Creates the job queue configured by `JOB_QUEUE_PATH` (default "jobs/jobs.db").
+
+    Returns:
+        JobQueue: The job queue.
+    """
+    return SQLiteJobQueue(os.getenv("JOB_QUEUE_PATH", os.path.join("jobs", "jobs.db")))
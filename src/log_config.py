@@ -0,0 +1,203 @@
+"""
+Module configuring the application logs.
+
+Records are put on a queue by the request threads and written by a single listener thread,
+so a request never waits on the disk. The log file is rotated by size, and each record is
+written as a JSON line with the id of the job it belongs to.
+
+Large payloads (the story JSON, image prompts) are logged with `extra={"payload": True}` and
+passed as `%s` arguments, so a payload record which is not sampled is never formatted. They are
+sampled with `LOG_PAYLOAD_SAMPLE_RATE`, and every message is truncated to
+`LOG_MAX_MESSAGE_CHARS`.
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import copy
+import random
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+job_id_var = contextvars.ContextVar("job_id", default=None)
+
+listener = None
+
+
+@contextmanager
+def job_context(job_id: str):
+    """
+    Tags the records logged within the block, and the threads started from it with a copy of
+    the context, with the job id.
+
+    Args:
+        job_id (str): Id of the job.
+    """
+    token = job_id_var.set(job_id)
+    try:
+        yield
+    finally:
+        job_id_var.reset(token)
+
+
+class JobFilter(logging.Filter):
+    """
+    Adds the job id of the current context to the records, truncates long messages and samples
+    the payload records.
+
+    Runs on the thread logging the record, where the context of the job is set.
+
+    Attributes:
+        max_chars (int): Maximum length of a message, 0 for no limit.
+        payload_sample_rate (float): Share of the payload records which are logged.
+    """
+
+    def __init__(self, max_chars: int = 2000, payload_sample_rate: float = 1.0):
+        """
+        Initializes the JobFilter.
+
+        Args:
+            max_chars (int, optional): Maximum length of a message, 0 for no limit. Defaults to 2000.
+            payload_sample_rate (float, optional): Share of the payload records which are logged.
+                Defaults to 1.0.
+        """
+        super().__init__()
+        self.max_chars = max_chars
+        self.payload_sample_rate = payload_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "payload", False) and (
+            random.random() >= self.payload_sample_rate
+        ):
+            return False
+
+        record.job_id = job_id_var.get()
+        if self.max_chars:
+            message = record.getMessage()
+            if len(message) > self.max_chars:
+                record.msg = (
+                    f"{message[: self.max_chars]}... "
+                    f"[{len(message) - self.max_chars} chars truncated]"
+                )
+                record.args = None
+        return True
+
+
+class JobQueueHandler(QueueHandler):
+    """
+    Queue handler keeping the traceback of a record apart from its message.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Formats the message and the traceback of the record on the logging thread, the
+        traceback is kept in `exc_text` for the formatter of the listener.
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats the records as JSON lines.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "job_id": getattr(record, "job_id", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(log_file: str = os.path.join("logs", "logs.txt")) -> QueueListener:
+    """
+    Sends the records of the root logger through a queue to a rotating log file.
+
+    The settings are read from the environment:
+
+        - `LOG_LEVEL` (default INFO): minimum level of the records.
+        - `LOG_FORMAT` (default json): "json" for JSON lines, "text" for plain lines.
+        - `LOG_MAX_BYTES` (default 10 MB) and `LOG_BACKUP_COUNT` (default 5): size at which
+          the log file is rotated and number of rotated files kept.
+        - `LOG_MAX_MESSAGE_CHARS` (default 2000): maximum length of a message, 0 for no limit.
+        - `LOG_PAYLOAD_SAMPLE_RATE` (default 1.0): share of the payload records which are logged.
+
+    Args:
+        log_file (str, optional): Path to the log file, None to log to the standard error.
+            Defaults to "logs/logs.txt".
+
+    Returns:
+        QueueListener: The started listener, stopped at exit by `stop_logging`.
+    """
+    global listener
+    if listener is not None:
+        return listener
+
+    if log_file is None:
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        handler = RotatingFileHandler(
+            log_file,
+            maxBytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(os.getenv("LOG_BACKUP_COUNT", 5)),
+            encoding="utf-8",
+        )
+
+    if os.getenv("LOG_FORMAT", "json").lower() == "text":
+        handler.setFormatter(
+            logging.Formatter(
+                "{asctime} - {levelname} - {job_id} - {message}",
+                style="{",
+                datefmt="%Y-%m-%d %H:%M",
+            )
+        )
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = JobQueueHandler(log_queue)
+    queue_handler.addFilter(
+        JobFilter(
+            max_chars=int(os.getenv("LOG_MAX_MESSAGE_CHARS", 2000)),
+            payload_sample_rate=float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 1.0)),
+        )
+    )
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(stop_logging)
+    return listener
+
+
+def stop_logging():
+    """
+    Writes the queued records and stops the listener thread.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener.handlers[0].close()
+        listener = None
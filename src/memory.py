@@ -0,0 +1,144 @@
+"""
+Module bounding the memory used by the images of the story pipeline.
+
+A decoded image takes width x height x 3 bytes whatever the size of its file, so the images are
+opened only for as long as they are used, downsampled when a model or a local score does not
+need the full resolution, and the generated images are released once saved.
+
+The resident memory of the worker is tracked by the `memory_guard`, which sheds new stories
+once it is above `WORKER_MEMORY_LIMIT_MB` instead of letting the worker be killed.
+"""
+
+import gc
+import os
+import sys
+import logging
+import resource
+import threading
+from PIL import Image
+from src.metrics import metrics
+
+metrics.describe("worker_memory_bytes", "Resident memory of the worker")
+metrics.describe("worker_memory_peak_bytes", "Peak resident memory of the worker")
+metrics.describe("worker_memory_shed_total", "Stories rejected as the worker memory was above its limit")
+
+
+def load_thumbnail(image_file: str, max_side: int) -> Image.Image:
+    """
+    Loads an image downsampled to fit in a square, and closes its file.
+
+    JPEG images are decoded at a reduced scale, so the full resolution image is never held.
+
+    Args:
+        image_file (str): Path to the image file.
+        max_side (int): Maximum width and height of the image.
+
+    Returns:
+        Image.Image: The loaded RGB image, to be closed by the caller.
+    """
+    with Image.open(image_file) as image:
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side))
+    return image
+
+
+def release_image(image):
+    """
+    Closes the decoded image held by a generated image once it is saved.
+
+    Args:
+        image (GeneratedImage): The generated image, not usable afterwards.
+    """
+    state = vars(image)
+    # Vertex AI images decode lazily to `_loaded_image`, the fake images hold `_pil_image`
+    for name in ("_loaded_image", "_pil_image"):
+        pil_image = state.get(name)
+        if pil_image is not None:
+            pil_image.close()
+            setattr(image, name, None)
+    if "_image_bytes" in state:
+        image._image_bytes = None
+
+
+class MemoryGuard:
+    """
+    Tracks the resident memory of the worker and checks it against a ceiling.
+
+    The ceiling is read from the environment on each check:
+
+        - `WORKER_MEMORY_LIMIT_MB`: memory above which new stories are rejected, 0 (the default)
+          for no limit.
+
+    Attributes:
+        peak (int): Highest resident memory seen, in bytes.
+    """
+
+    def __init__(self):
+        """
+        Initializes the MemoryGuard.
+        """
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def limit(self) -> int:
+        """
+        Returns:
+            int: The ceiling in bytes, 0 for no limit.
+        """
+        return int(float(os.getenv("WORKER_MEMORY_LIMIT_MB", 0)) * 1024 * 1024)
+
+    def rss(self) -> int:
+        """
+        Reads the resident memory of the worker.
+
+        Returns:
+            int: The resident memory in bytes. The peak where the current value is not
+                available (outside Linux).
+        """
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # reported in bytes on macOS and in KB elsewhere
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def track(self) -> int:
+        """
+        Updates the memory gauges.
+
+        Returns:
+            int: The resident memory in bytes.
+        """
+        rss = self.rss()
+        with self.lock:
+            self.peak = max(self.peak, rss)
+            peak = self.peak
+        metrics.set("worker_memory_bytes", rss)
+        metrics.set("worker_memory_peak_bytes", peak)
+        return rss
+
+    def exceeded(self) -> bool:
+        """
+        Checks whether the worker is above its memory ceiling, after collecting the garbage.
+
+        Returns:
+            bool: True if a new story should be rejected.
+        """
+        limit = self.limit()
+        rss = self.track()
+        if not limit or rss <= limit:
+            return False
+        gc.collect()
+        rss = self.track()
+        if rss <= limit:
+            return False
+        metrics.inc("worker_memory_shed_total")
+        logging.info(
+            f"Worker memory {rss / 2**20:.0f} MB above the limit of {limit / 2**20:.0f} MB"
+        )
+        return True
+
+
+memory_guard = MemoryGuard()
@@ -0,0 +1,80 @@
+"""
+Module providing in-process counters and gauges exposed in the Prometheus text format.
+"""
+
+import threading
+
+
+class MetricsRegistry:
+    """
+    A thread safe registry of counters and gauges.
+
+    Attributes:
+        counters (dict): Current value of each counter.
+        gauges (dict): Current value of each gauge.
+        descriptions (dict): Help text of each metric.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty MetricsRegistry.
+        """
+        self.counters = {}
+        self.gauges = {}
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name: str, description: str):
+        """
+        Sets the help text of a metric.
+
+        Args:
+            name (str): Name of the metric.
+            description (str): Help text of the metric.
+        """
+        self.descriptions[name] = description
+
+    def inc(self, name: str, value: float = 1):
+        """
+        Increments a counter.
+
+        Args:
+            name (str): Name of the counter.
+            value (float, optional): Amount to add. Defaults to 1.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        """
+        Sets the value of a gauge.
+
+        Args:
+            name (str): Name of the gauge.
+            value (float): Value of the gauge.
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def render(self) -> str:
+        """
+        Renders all the metrics in the Prometheus text format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        lines = []
+        with self.lock:
+            metrics = [(name, "counter", value) for name, value in self.counters.items()]
+            metrics += [(name, "gauge", value) for name, value in self.gauges.items()]
+
+        for name, kind, value in sorted(metrics):
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
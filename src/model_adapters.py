@@ -0,0 +1,360 @@
+"""
+Module providing adapters around the three model roles used to generate a story.
+
+    - Text: the language model used in LangChain `prompt | llm | parser` chains.
+    - Vision to text: the multimodal model describing images and improving prompts.
+    - Image generation: the vision model generating the part images.
+
+Each adapter offers a blocking and an async method. The async methods use the providers'
+async APIs where available (`ainvoke`, `generate_content_async`) and run the call on a thread
+otherwise. Adapters are shared between stories, one per backend and model name.
+
+The provider of the models is selected with `MODEL_BACKEND`:
+
+    - `google` (default): Gemini and Imagen models through `langchain_google_genai`,
+      `google.generativeai` and `vertexai`.
+    - `fake`: the local deterministic models of `src.fake_models`, for offline testing.
+
+The provider libraries are imported when an adapter is created, so the fake backend runs
+without them.
+
+The calls of each adapter go through the circuit breaker of its endpoint. While the breaker is
+open, the calls are routed to the alternate model set in `MODEL_FALLBACKS`, or fail fast with
+`CircuitOpen`.
+"""
+
+import os
+import asyncio
+import logging
+import contextvars
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from src.circuit_breaker import CircuitBreaker
+from src.profiling import run_in_session
+from src.metrics import metrics
+
+metrics.describe("model_fallbacks_total", "Model calls routed to the alternate model of an open endpoint")
+
+BACKENDS = ("google", "fake")
+
+
+def model_backend() -> str:
+    """
+    Returns:
+        str: The backend selected with `MODEL_BACKEND` from the environment, "google" by default.
+
+    Raises:
+        ValueError: If the backend is unknown.
+    """
+    backend = os.getenv("MODEL_BACKEND", "google").strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown MODEL_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}"
+        )
+    return backend
+
+
+def fallback_model(model_name: str) -> str:
+    """
+    Finds the alternate of a model in `MODEL_FALLBACKS` from the environment, a comma separated
+    list of `model=alternate` pairs e.g. "gemini-1.5-pro=gemini-1.5-flash".
+
+    Args:
+        model_name (str): Name of the model.
+
+    Returns:
+        str: Name of the alternate model, None if it has none.
+    """
+    for pair in os.getenv("MODEL_FALLBACKS", "").split(","):
+        model, _, alternate = pair.partition("=")
+        if model.strip() and (model.strip() == model_name) and alternate.strip():
+            return alternate.strip()
+    return None
+
+
+class ModelAdapter:
+    """
+    Base of the adapters, routing the calls through the circuit breaker of the endpoint.
+
+    Attributes:
+        role (str): Name of the role, in the name of the breakers.
+        slow_seconds (tuple): Environment variable and default of the latency above which a
+            call counts as slow for the breaker.
+        model_name (str): Name of the model.
+        backend (str): Provider of the model.
+        fallback_name (str): Name of the alternate model used while the breaker is open.
+        breaker (CircuitBreaker): Breaker of the endpoint.
+    """
+
+    role = "model"
+    slow_seconds = ("MODEL_SLOW_SECONDS", 60)
+
+    def __init__(self, model_name: str, backend: str = "google", fallback_name: str = None):
+        """
+        Initializes the ModelAdapter.
+
+        Args:
+            model_name (str): Name of the model.
+            backend (str, optional): Provider of the model. Defaults to "google".
+            fallback_name (str, optional): Name of the alternate model. Defaults to None.
+        """
+        self.model_name = model_name
+        self.backend = backend
+        self.fallback_name = fallback_name
+        self.breaker = CircuitBreaker(
+            f"{self.role}:{model_name}", float(os.getenv(*self.slow_seconds))
+        )
+
+    def route(self):
+        """
+        Picks the adapter serving the next call.
+
+        Returns:
+            ModelAdapter: This adapter, or the adapter of the alternate model while the breaker
+                of this one is open. Calls to an open breaker raise `CircuitOpen`.
+        """
+        if self.breaker.available() or not self.fallback_name:
+            return self
+        fallback = shared_model(type(self), self.fallback_name, self.backend)
+        if not fallback.breaker.available():
+            return self
+        logging.info(f"{self.breaker.name} unavailable, calling {self.fallback_name}")
+        metrics.inc("model_fallbacks_total")
+        return fallback
+
+
+class TextModel(ModelAdapter):
+    """
+    Adapter for the text role, running `prompt | llm | parser` chains.
+
+    Attributes:
+        llm: LangChain wrapper around the language model.
+    """
+
+    role = "text"
+    slow_seconds = ("TEXT_MODEL_SLOW_SECONDS", 60)
+
+    def __init__(self, model_name: str, backend: str = "google", fallback_name: str = None):
+        """
+        Initializes the TextModel.
+
+        Args:
+            model_name (str): Name of the language model.
+            backend (str, optional): Provider of the model. Defaults to "google".
+            fallback_name (str, optional): Name of the alternate model. Defaults to None.
+        """
+        super().__init__(model_name, backend, fallback_name)
+        if backend == "fake":
+            from src.fake_models import FakeLLM
+
+            self.llm = FakeLLM(model_name=model_name or "fake")
+        else:
+            from langchain_google_genai import GoogleGenerativeAI
+
+            self.llm = GoogleGenerativeAI(model=model_name)
+
+    def invoke_chain(self, prompt, parser, inputs: dict, callbacks: list = None):
+        """
+        Runs the prompt through the language model and parses the output.
+
+        Args:
+            prompt (PromptTemplate): The prompt template.
+            parser: The output parser.
+            inputs (dict): Values of the prompt input variables.
+            callbacks (list, optional): LangChain callback handlers. Defaults to None.
+
+        Returns:
+            The parsed output.
+        """
+        # the output is parsed outside of the breaker, a malformed output is not an endpoint failure
+        model = self.route()
+        text = model.breaker.call(
+            (prompt | model.llm).invoke, inputs, config={"callbacks": callbacks or []}
+        )
+        return parser.invoke(text)
+
+    async def ainvoke_chain(self, prompt, parser, inputs: dict, callbacks: list = None):
+        """
+        Async version of `invoke_chain`.
+        """
+        model = self.route()
+        text = await model.breaker.acall(
+            (prompt | model.llm).ainvoke, inputs, config={"callbacks": callbacks or []}
+        )
+        return parser.invoke(text)
+
+
+class VisionTextModel(ModelAdapter):
+    """
+    Adapter for the vision to text role, generating text from text and image contents.
+
+    Attributes:
+        model (genai.GenerativeModel): The multimodal model, or its fake.
+    """
+
+    role = "vision_text"
+    slow_seconds = ("VISION_TEXT_MODEL_SLOW_SECONDS", 60)
+
+    def __init__(self, model_name: str, backend: str = "google", fallback_name: str = None):
+        """
+        Initializes the VisionTextModel.
+
+        Args:
+            model_name (str): Name of the multimodal model.
+            backend (str, optional): Provider of the model. Defaults to "google".
+            fallback_name (str, optional): Name of the alternate model. Defaults to None.
+        """
+        super().__init__(model_name, backend, fallback_name)
+        if backend == "fake":
+            from src.fake_models import FakeVisionTextModel
+
+            self.model = FakeVisionTextModel(model_name or "fake")
+        else:
+            import google.generativeai as genai
+
+            genai.configure()
+            self.model = genai.GenerativeModel(model_name)
+
+    def generate_content(self, contents):
+        """
+        Generates text from the contents.
+
+        Args:
+            contents: A prompt, or a list of prompts and PIL images.
+
+        Returns:
+            The response, with the generated `text` and its `usage_metadata`.
+        """
+        model = self.route()
+        return model.breaker.call(model.model.generate_content, contents)
+
+    async def agenerate_content(self, contents):
+        """
+        Async version of `generate_content`.
+        """
+        model = self.route()
+        return await model.breaker.acall(model.model.generate_content_async, contents)
+
+
+class ImageModel(ModelAdapter):
+    """
+    Adapter for the image generation role.
+
+    Attributes:
+        model (ImageGenerationModel): The image generation model, or its fake.
+        executor (ThreadPoolExecutor): Threads running the calls of `agenerate_images`, sized by
+            `IMAGE_MODEL_THREADS` from the environment (default 32).
+    """
+
+    role = "image"
+    slow_seconds = ("IMAGE_MODEL_SLOW_SECONDS", 90)
+
+    def __init__(self, model_name: str, backend: str = "google", fallback_name: str = None):
+        """
+        Initializes the ImageModel.
+
+        Args:
+            model_name (str): Name of the image generation model.
+            backend (str, optional): Provider of the model. Defaults to "google".
+            fallback_name (str, optional): Name of the alternate model. Defaults to None.
+        """
+        super().__init__(model_name, backend, fallback_name)
+        if backend == "fake":
+            from src.fake_models import FakeImageGenerationModel
+
+            self.model = FakeImageGenerationModel(model_name or "fake")
+        else:
+            from vertexai.vision_models import ImageGenerationModel
+
+            self.model = ImageGenerationModel.from_pretrained(model_name)
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("IMAGE_MODEL_THREADS", 32)),
+            thread_name_prefix="image-model",
+        )
+
+    def generate_images(self, prompt: str, number_of_images: int = 1) -> list:
+        """
+        Generates images from the prompt.
+
+        Args:
+            prompt (str): The image prompt.
+            number_of_images (int, optional): Number of images to generate. Defaults to 1.
+
+        Returns:
+            list: The generated images, empty or shorter when images are filtered by the model.
+        """
+        model = self.route()
+        return model.breaker.call(model.images, prompt, number_of_images)
+
+    def images(self, prompt: str, number_of_images: int) -> list:
+        """
+        Calls the image generation model.
+        """
+        return list(
+            self.model.generate_images(prompt=prompt, number_of_images=number_of_images)
+        )
+
+    async def agenerate_images(self, prompt: str, number_of_images: int = 1) -> list:
+        """
+        Async version of `generate_images`, the model has no async API so the call runs on a thread,
+        in a copy of the current context.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            contextvars.copy_context().run,
+            run_in_session,
+            self.generate_images,
+            prompt,
+            number_of_images,
+        )
+
+
+@lru_cache(maxsize=None)
+def shared_model(adapter: type, model_name: str, backend: str):
+    """
+    Creates an adapter once per backend and model name, with the alternate of the model from
+    `fallback_model`. A model has a single adapter and breaker, whether it is called directly or
+    as the alternate of another model.
+
+    Args:
+        adapter (type): The adapter class.
+        model_name (str): Name of the model.
+        backend (str): Provider of the model.
+
+    Returns:
+        The shared adapter.
+    """
+    return adapter(model_name, backend, fallback_model(model_name))
+
+
+def get_text_model(model_name: str) -> TextModel:
+    """
+    Args:
+        model_name (str): Name of the language model.
+
+    Returns:
+        TextModel: The shared adapter for the model on the selected backend.
+    """
+    return shared_model(TextModel, model_name, model_backend())
+
+
+def get_vision_text_model(model_name: str) -> VisionTextModel:
+    """
+    Args:
+        model_name (str): Name of the multimodal model.
+
+    Returns:
+        VisionTextModel: The shared adapter for the model on the selected backend.
+    """
+    return shared_model(VisionTextModel, model_name, model_backend())
+
+
+def get_image_model(model_name: str) -> ImageModel:
+    """
+    Args:
+        model_name (str): Name of the image generation model.
+
+    Returns:
+        ImageModel: The shared adapter for the model on the selected backend.
+    """
+    return shared_model(ImageModel, model_name, model_backend())
@@ -0,0 +1,298 @@
+"""
+Module providing an on demand sampling profiler of the story jobs.
+
+While a job is profiled, a background thread samples the stacks of the threads working on it
+every few milliseconds with `sys._current_frames`. Samples are taken on the wall clock, so the
+time waiting on the model endpoints shows up next to the local work (chain execution, JSON
+parsing, image encoding). The threads of the executors join the profile of the job when they
+run a call in its context with `run_in_session`.
+
+The profile is saved in the speedscope format (https://www.speedscope.app), one profile per
+thread, and linked from the usage record of the job.
+
+A request is profiled when it carries the `X-Profile` header with the value of
+`PROFILE_TOKEN`, or at random with the probability `PROFILE_SAMPLE_RATE`. The profiles are only
+served with the token, so they cannot be read while `PROFILE_TOKEN` is not set.
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from src.metrics import metrics
+
+metrics.describe("profiled_jobs_total", "Story jobs profiled")
+
+PROFILE_DIR = "profiles"
+
+session_var = contextvars.ContextVar("profile_session", default=None)
+
+
+def should_profile(token: str = None) -> bool:
+    """
+    Decides whether a request is profiled.
+
+    Args:
+        token (str, optional): Value of the `X-Profile` header of the request.
+
+    Returns:
+        bool: True if the token matches `PROFILE_TOKEN`, or the request is sampled with
+            `PROFILE_SAMPLE_RATE` (default 0).
+    """
+    if token_valid(token):
+        return True
+    return random.random() < float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+
+
+def token_valid(token: str) -> bool:
+    """
+    Args:
+        token (str): The token given by the client.
+
+    Returns:
+        bool: Whether the token matches `PROFILE_TOKEN`, always False if it is not set.
+    """
+    expected = os.getenv("PROFILE_TOKEN")
+    # compared as bytes, the strings of `compare_digest` must be ASCII
+    return bool(expected and token) and hmac.compare_digest(
+        token.encode("utf-8"), expected.encode("utf-8")
+    )
+
+
+def profile_path(job_id: str, profile_dir: str = PROFILE_DIR) -> str:
+    """
+    Args:
+        job_id (str): Id of the job.
+        profile_dir (str, optional): Directory of the profiles. Defaults to "profiles".
+
+    Returns:
+        str: Path to the profile of the job, None if the id is not a safe file name.
+    """
+    if not job_id or not job_id.replace("-", "").replace("_", "").isalnum():
+        return None
+    return os.path.join(profile_dir, f"{job_id}.speedscope.json")
+
+
+class ProfileSession:
+    """
+    The samples of a profiled job.
+
+    Attributes:
+        job_id (str): Id of the job.
+        threads (dict): Names of the threads working on the job, by thread id.
+        samples (dict): Number of samples of each stack, by thread name. A stack is a tuple of
+            (function, file, line) frames from the root to the leaf.
+        started (float): Time the profile started.
+        stopped (bool): Whether sampling ended, the samples are then final.
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.threads = {}
+        self.samples = {}
+        self.started = time.time()
+        self.stopped = False
+        # held while the samples are recorded or serialized
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def thread(self):
+        """
+        Samples the current thread within the block.
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] = threading.current_thread().name
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads.pop(ident, None)
+
+    def sample(self, frames: dict):
+        """
+        Records the stacks of the threads of the job.
+
+        Args:
+            frames (dict): Current frame by thread id, from `sys._current_frames`.
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            for ident, name in self.threads.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples.setdefault(name, Counter())[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        Ends sampling, waiting for a sample being recorded by the sampler thread.
+        """
+        with self.lock:
+            self.stopped = True
+
+    def speedscope(self, interval: float) -> dict:
+        """
+        Args:
+            interval (float): Seconds between two samples, the weight of a sample.
+
+        Returns:
+            dict: The profile in the speedscope file format.
+        """
+        frames, index = [], {}
+        profiles = []
+        with self.lock:
+            samples = {name: Counter(stacks) for name, stacks in self.samples.items()}
+        for name, stacks in samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.most_common():
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                samples.append([index[frame] for frame in stack])
+                weights.append(round(count * interval, 6))
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": round(sum(weights), 6),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"Story job {self.job_id}",
+            "exporter": "GenAI-story-teller",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class Sampler:
+    """
+    Samples the stacks of the profiled jobs on a background thread, running while any job is
+    profiled.
+
+    Attributes:
+        interval (float): Seconds between two samples, from `PROFILE_INTERVAL_MS` (default 5).
+        sessions (set): The sessions being profiled.
+    """
+
+    def __init__(self):
+        self.interval = float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, session: ProfileSession):
+        """
+        Starts sampling a session, and the sampler thread if it is not running.
+        """
+        with self.lock:
+            self.sessions.add(session)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+                self.thread.start()
+
+    def remove(self, session: ProfileSession):
+        """
+        Stops sampling a session.
+        """
+        with self.lock:
+            self.sessions.discard(session)
+
+    def run(self):
+        while True:
+            with self.lock:
+                sessions = list(self.sessions)
+                if not sessions:
+                    self.thread = None
+                    return
+            frames = sys._current_frames()
+            for session in sessions:
+                session.sample(frames)
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+@contextmanager
+def profile_job(job_id: str, enabled: bool = True, profile_dir: str = PROFILE_DIR):
+    """
+    Profiles the block and the calls run in its context with `run_in_session`, and saves the
+    profile when the block exits.
+
+    Args:
+        job_id (str): Id of the job.
+        enabled (bool, optional): Whether the job is profiled. Defaults to True.
+        profile_dir (str, optional): Directory of the profiles. Defaults to "profiles".
+
+    Yields:
+        ProfileSession: The session, None if the job is not profiled.
+    """
+    if not enabled:
+        yield None
+        return
+
+    session = ProfileSession(job_id)
+    token = session_var.set(session)
+    sampler.add(session)
+    try:
+        with session.thread():
+            yield session
+    finally:
+        sampler.remove(session)
+        session.stop()
+        session_var.reset(token)
+        save_profile(session, profile_dir)
+
+
+def save_profile(session: ProfileSession, profile_dir: str = PROFILE_DIR) -> str:
+    """
+    Saves the profile of a session.
+
+    Returns:
+        str: Path to the profile.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    path = profile_path(session.job_id, profile_dir)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(session.speedscope(sampler.interval), f)
+    metrics.inc("profiled_jobs_total")
+    logging.info(
+        f"Job profiled for {time.time() - session.started:.1f}s, profile saved to {path}"
+    )
+    return path
+
+
+def run_in_session(fn, *args, **kwargs):
+    """
+    Runs a call, sampling the current thread if the context belongs to a profiled job.
+
+    Used by the executors, with the context of the job copied to their threads.
+    """
+    session = session_var.get()
+    if session is None:
+        return fn(*args, **kwargs)
+    with session.thread():
+        return fn(*args, **kwargs)
@@ -0,0 +1,313 @@
+"""
+Module providing the admission control and scheduling of the story jobs of an instance.
+
+A story's cost grows with its number of parts, so jobs are admitted against a budget of
+concurrent cost instead of one slot per request. Waiting jobs are ordered by weighted fair
+queueing: each client's jobs get finish tags advancing with their cost, so short jobs and
+clients with few jobs go first and a client submitting many long stories cannot starve the
+others. When the queue is full the job is shed with an estimate of when to retry.
+"""
+
+import os
+import math
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from src.metrics import metrics
+from src.memory import memory_guard
+
+metrics.describe("scheduler_running_cost", "Cost of the story jobs running")
+metrics.describe("scheduler_queued_cost", "Cost of the story jobs waiting")
+metrics.describe("scheduler_shed_total", "Story jobs rejected by the scheduler")
+metrics.describe("scheduler_wait_seconds_total", "Time story jobs waited to be admitted")
+
+
+def estimate_cost(
+    n_words: int,
+    from_image: bool = False,
+    max_words: int = 2000,
+    n_languages: int = 0,
+    max_images: int = None,
+    image_every: int = 1,
+) -> int:
+    """
+    Estimates the cost of a story as its number of model calls.
+
+    Args:
+        n_words (int): The requested number of words.
+        from_image (bool, optional): Whether the story is generated from an image, which costs
+            a call to describe it. Defaults to False.
+        max_words (int, optional): Most words of a story. Defaults to 2000.
+        n_languages (int, optional): Number of languages the story is translated into, which
+            costs a call per part and one for the title in each language. Defaults to 0.
+        max_images (int, optional): Most images of the story. Defaults to None (no limit).
+        image_every (int, optional): Every k-th part is illustrated. Defaults to 1.
+
+    Returns:
+        int: The story text and theme calls, plus an image and a palette call per illustrated
+            part.
+    """
+    parts = max(min(n_words, max_words) // 200, 1)
+    images = len(range(1, parts + 1, max(image_every, 1)))
+    if max_images is not None:
+        images = min(images, max(max_images, 0))
+    return 2 + 2 * images + (1 if from_image else 0) + n_languages * (parts + 1)
+
+
+def trusted_proxy() -> bool:
+    """
+    Returns:
+        bool: Whether the `X-Client-Id` and `X-Forwarded-For` headers identify the client, from
+            `TRUSTED_PROXY` (default off). Only a proxy in front of the app sets them reliably,
+            otherwise a client could send a new id with each request to get a new fair share.
+    """
+    return os.getenv("TRUSTED_PROXY", "0").lower() in ("1", "true", "yes")
+
+
+class SchedulerFull(Exception):
+    """
+    The job was shed as the instance is saturated.
+
+    Attributes:
+        retry_after (int): Seconds after which the client should retry.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many stories in progress, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    """
+    A job waiting for or holding a share of the cost budget.
+
+    Attributes:
+        client (str): Id of the client which submitted the job.
+        cost (int): Cost of the job, capped at the budget.
+        finish_tag (float): Virtual finish time of the job, the jobs are admitted in its order.
+        admitted (threading.Event): Set when the job may run.
+        future (asyncio.Future): Resolved when the job may run, for async waiters.
+    """
+
+    def __init__(self, client: str, cost: int, finish_tag: float, loop=None):
+        self.client = client
+        self.cost = cost
+        self.finish_tag = finish_tag
+        self.admitted = threading.Event()
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.queued_at = time.time()
+        self.started_at = None
+
+    def admit(self):
+        """
+        Lets the waiting job run.
+        """
+        self.started_at = time.time()
+        self.admitted.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(
+                lambda: self.future.done() or self.future.set_result(True)
+            )
+
+
+class StoryScheduler:
+    """
+    Admits the story jobs of an instance within a budget of concurrent cost.
+
+    The settings are read from the environment when the scheduler is created:
+
+        - `SCHEDULER_MAX_COST` (default 40): cost of the jobs running at once.
+        - `SCHEDULER_MAX_QUEUED_COST` (default 120): cost of the jobs waiting, beyond which
+          new jobs are shed.
+        - `SCHEDULER_MAX_WAIT_SECONDS` (default 60): jobs expected to wait longer are shed.
+
+    Attributes:
+        max_cost (int): Cost of the jobs running at once.
+        max_queued_cost (int): Cost of the jobs waiting.
+        max_wait (float): Longest expected wait before a job is shed.
+        running_cost (int): Cost of the running jobs.
+        queued_cost (int): Cost of the waiting jobs.
+        queue (list): Heap of the waiting jobs by finish tag.
+        virtual_time (float): Finish tag of the last admitted job.
+        client_tags (dict): Finish tag of the last job of each client.
+        seconds_per_cost (float): Moving average of the run time of a unit of cost.
+    """
+
+    def __init__(self, max_cost: int = None, max_queued_cost: int = None, max_wait: float = None):
+        """
+        Initializes the StoryScheduler.
+
+        Args:
+            max_cost (int, optional): Defaults to `SCHEDULER_MAX_COST` or 40.
+            max_queued_cost (int, optional): Defaults to `SCHEDULER_MAX_QUEUED_COST` or 120.
+            max_wait (float, optional): Defaults to `SCHEDULER_MAX_WAIT_SECONDS` or 60.
+        """
+        self.max_cost = max_cost or int(os.getenv("SCHEDULER_MAX_COST", 40))
+        self.max_queued_cost = max_queued_cost or int(
+            os.getenv("SCHEDULER_MAX_QUEUED_COST", 120)
+        )
+        self.max_wait = max_wait or float(os.getenv("SCHEDULER_MAX_WAIT_SECONDS", 60))
+        self.running_cost = 0
+        self.queued_cost = 0
+        self.queue = []
+        self.virtual_time = 0.0
+        self.client_tags = {}
+        self.seconds_per_cost = 5.0
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def expected_wait(self, cost_ahead: int) -> float:
+        """
+        Args:
+            cost_ahead (int): Cost of the jobs to run before the job.
+
+        Returns:
+            float: Expected seconds before the job is admitted.
+        """
+        return cost_ahead * self.seconds_per_cost / self.max_cost
+
+    def submit(self, client: str, cost: int, weight: float = 1.0, loop=None) -> Job:
+        """
+        Queues a job and admits it if the budget allows.
+
+        Args:
+            client (str): Id of the client.
+            cost (int): Estimated cost of the job.
+            weight (float, optional): Share of the client, a client of weight 2 gets twice the
+                throughput of a client of weight 1. Defaults to 1.0.
+            loop (asyncio.AbstractEventLoop, optional): Loop of an async waiter.
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            SchedulerFull: If the job is shed, or the worker is above its memory limit.
+        """
+        cost = min(max(cost, 1), self.max_cost)
+        if memory_guard.exceeded():
+            metrics.inc("scheduler_shed_total")
+            raise SchedulerFull(max(math.ceil(self.expected_wait(self.running_cost)), 1))
+        with self.lock:
+            cost_ahead = self.queued_cost + max(self.running_cost + cost - self.max_cost, 0)
+            if self.queue or (self.running_cost + cost > self.max_cost):
+                wait = self.expected_wait(cost_ahead)
+                if (self.queued_cost + cost > self.max_queued_cost) or (wait > self.max_wait):
+                    metrics.inc("scheduler_shed_total")
+                    retry_after = max(math.ceil(self.expected_wait(cost_ahead + cost)), 1)
+                    logging.info(
+                        f"Story job of {client} shed, cost {cost}, queued cost {self.queued_cost}"
+                    )
+                    raise SchedulerFull(retry_after)
+
+            finish_tag = max(self.virtual_time, self.client_tags.get(client, 0)) + cost / weight
+            self.client_tags[client] = finish_tag
+            job = Job(client, cost, finish_tag, loop)
+            heapq.heappush(self.queue, (finish_tag, next(self.sequence), job))
+            self.queued_cost += cost
+            self.dispatch()
+        return job
+
+    def dispatch(self):
+        """
+        Admits the waiting jobs in order of finish tag while they fit in the budget.
+        Called with the lock held.
+        """
+        while self.queue and (self.running_cost + self.queue[0][2].cost <= self.max_cost):
+            _, _, job = heapq.heappop(self.queue)
+            self.queued_cost -= job.cost
+            self.running_cost += job.cost
+            self.virtual_time = job.finish_tag
+            job.admit()
+        # forget the clients whose tags are behind the virtual time
+        if len(self.client_tags) > 1000:
+            self.client_tags = {
+                client: tag for client, tag in self.client_tags.items() if tag > self.virtual_time
+            }
+        metrics.set("scheduler_running_cost", self.running_cost)
+        metrics.set("scheduler_queued_cost", self.queued_cost)
+
+    def cancel(self, job: Job) -> bool:
+        """
+        Removes a waiting job from the queue.
+
+        Returns:
+            bool: True if the job was removed, False if it was admitted meanwhile.
+        """
+        with self.lock:
+            if job.admitted.is_set():
+                return False
+            self.queue = [entry for entry in self.queue if entry[2] is not job]
+            heapq.heapify(self.queue)
+            self.queued_cost -= job.cost
+            self.dispatch()
+        return True
+
+    def release(self, job: Job):
+        """
+        Returns the cost of a finished job to the budget and admits the next jobs.
+        """
+        with self.lock:
+            self.running_cost -= job.cost
+            seconds = time.time() - job.started_at
+            self.seconds_per_cost = 0.9 * self.seconds_per_cost + 0.1 * seconds / job.cost
+            self.dispatch()
+
+    def wait_time(self, job: Job):
+        """
+        Records how long an admitted job waited.
+        """
+        wait = job.started_at - job.queued_at
+        metrics.inc("scheduler_wait_seconds_total", wait)
+        if wait > 1:
+            logging.info(f"Story job admitted after {wait:.1f}s, cost {job.cost}")
+
+    @contextmanager
+    def admit(self, client: str, cost: int, weight: float = 1.0):
+        """
+        Runs the block once the job is admitted.
+
+        Args:
+            client (str): Id of the client.
+            cost (int): Estimated cost of the job.
+            weight (float, optional): Share of the client. Defaults to 1.0.
+
+        Raises:
+            SchedulerFull: If the job is shed, or not admitted within `max_wait`.
+        """
+        job = self.submit(client, cost, weight)
+        if not job.admitted.wait(timeout=self.max_wait) and self.cancel(job):
+            metrics.inc("scheduler_shed_total")
+            raise SchedulerFull(max(math.ceil(self.expected_wait(self.queued_cost)), 1))
+        self.wait_time(job)
+        try:
+            yield job
+        finally:
+            self.release(job)
+
+    @asynccontextmanager
+    async def aadmit(self, client: str, cost: int, weight: float = 1.0):
+        """
+        Async version of `admit`, waiting on the event loop.
+        """
+        job = self.submit(client, cost, weight, loop=asyncio.get_running_loop())
+        try:
+            await asyncio.wait_for(asyncio.shield(job.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if self.cancel(job):
+                metrics.inc("scheduler_shed_total")
+                raise SchedulerFull(max(math.ceil(self.expected_wait(self.queued_cost)), 1))
+        except asyncio.CancelledError:
+            if not self.cancel(job):
+                self.release(job)
+            raise
+        self.wait_time(job)
+        try:
+            yield job
+        finally:
+            self.release(job)
+
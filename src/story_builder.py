@@ -1,17 +1,405 @@
 """
 This module provides functionality to generate a story, including text and images, based on a given context or image.
 It uses several helper classes to generate the story text, images, themes, and finally formats it to html.
+
+`build_story` runs the model calls on threads, `abuild_story` is the async variant generating
+the part images concurrently on the event loop. `regenerate_part` regenerates the text or the
+image of a single part of a saved story. A story can be translated into other languages while
+its images are generated, the translations reuse its images and theme.
+
+The number of images of a story is set apart from its number of parts by `image_density`: a
+long story can illustrate only every k-th part, or a few parts spread over the story, and the
+other parts are rendered as text only.
 """
 
 import os
+import time
+import asyncio
 import logging
-from PIL import Image
-from src.gen_story import StoryGenerator
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from src.gen_story import StoryGenerator, illustrated_parts
 from src.story_image import StoryImageGen
 from src.format_story import FormatStory
-from src.theme_generator import StoryThemeGenerator
+from src.theme_generator import StoryThemeGenerator, HEX_COLOR
+from src.image_fallback import image_cache, fallback_image
+from src.image_hash import dhash
+from src.image_scoring import runner_ups
+from src.memory import load_thumbnail, release_image
+from src.usage import StoryUsage
+from src.metrics import metrics
+from src.circuit_breaker import CircuitOpen
+from src.profiling import run_in_session
+from src.translate import StoryTranslator
+from src.http_cache import asset_url
 
 MAX_WORDS = 2000
+# the image to text model does not need more than this resolution to describe an upload
+CONTEXT_IMAGE_MAX_SIDE = 1536
+
+metrics.describe(
+    "story_image_fallbacks_total", "Story parts rendered with a fallback image or text only"
+)
+
+
+def run_until(executor, timeout_at: float, fn, *args, **kwargs):
+    """
+    Runs a function on the executor and waits for its result until the deadline.
+
+    The function keeps running in the background when the deadline passes, its result is discarded.
+    It runs in a copy of the current context, so its records are logged with the job id.
+
+    Args:
+        executor (ThreadPoolExecutor): The executor running the function.
+        timeout_at (float): Time (as returned by `time.time()`) until which the result is awaited.
+        fn (callable): The function to run.
+        *args: Positional arguments of the function.
+        **kwargs: Keyword arguments of the function.
+
+    Returns:
+        The result of the function.
+
+    Raises:
+        TimeoutError: If the deadline passes before the function returns.
+    """
+    if time.time() >= timeout_at:
+        raise TimeoutError("deadline passed")
+    return executor.submit(
+        contextvars.copy_context().run, run_in_session, fn, *args, **kwargs
+    ).result(
+        timeout=timeout_at - time.time()
+    )
+
+
+def story_deadlines(deadline: float = None, part_deadline: float = None) -> tuple:
+    """
+    Resolves the deadlines of a story starting now.
+
+    Args:
+        deadline (float, optional): Seconds allowed for the story. Defaults to
+            `STORY_DEADLINE_SECONDS` from the environment or 150.
+        part_deadline (float, optional): Seconds allowed for the image of a part. Defaults to
+            `PART_DEADLINE_SECONDS` from the environment or 60.
+
+    Returns:
+        tuple: The time at which the story is due and the seconds allowed per part.
+    """
+    if deadline is None:
+        deadline = float(os.getenv("STORY_DEADLINE_SECONDS", 150))
+    if part_deadline is None:
+        part_deadline = float(os.getenv("PART_DEADLINE_SECONDS", 60))
+    return time.time() + deadline, part_deadline
+
+
+def image_density(max_images: int = None, image_every: int = None) -> tuple:
+    """
+    Resolves how many parts of a story are illustrated.
+
+    Args:
+        max_images (int, optional): Most images of a story, 0 for a text only story. Defaults
+            to `IMAGES_PER_STORY` from the environment or no limit.
+        image_every (int, optional): Every k-th part is illustrated. Defaults to
+            `IMAGE_EVERY_K` from the environment or 1.
+
+    Returns:
+        tuple: The most images of the story (None for no limit) and the step between two
+            illustrated parts.
+    """
+    if max_images is None and os.getenv("IMAGES_PER_STORY"):
+        max_images = int(os.getenv("IMAGES_PER_STORY"))
+    if image_every is None:
+        image_every = int(os.getenv("IMAGE_EVERY_K", 1))
+    return max_images, max(image_every, 1)
+
+
+def parse_image_density(images: str = None, image_every: str = None) -> tuple:
+    """
+    Parses the image density requested for a story.
+
+    Args:
+        images (str, optional): Most images of the story e.g. "3", "0" for text only.
+        image_every (str, optional): Every k-th part is illustrated e.g. "2".
+
+    Returns:
+        tuple: The most images and the step between two illustrated parts, None for a value
+            not requested.
+
+    Raises:
+        ValueError: If a value is not a number or out of range.
+    """
+    max_images = int(images) if images not in (None, "") else None
+    step = int(image_every) if image_every not in (None, "") else None
+    if (max_images is not None) and max_images < 0:
+        raise ValueError("images must be 0 or more")
+    if (step is not None) and step < 1:
+        raise ValueError("image_every must be 1 or more")
+    return max_images, step
+
+
+def new_story_generator(
+    story_theme: str,
+    story_inspiration: str,
+    n_words: int,
+    usage: StoryUsage,
+    max_images: int = None,
+    image_every: int = None,
+) -> StoryGenerator:
+    """
+    Creates the story generator, with fewer illustrated parts when the image budget cannot cover
+    the images asked for.
+
+    Args:
+        story_theme (str): The theme of the story.
+        story_inspiration (str): The inspiration for the story.
+        n_words (int): The desired number of words for the story.
+        usage (StoryUsage): Records the model usage of the story and holds its budget.
+        max_images (int, optional): Most images of the story, see `image_density`.
+        image_every (int, optional): Every k-th part is illustrated, see `image_density`.
+
+    Returns:
+        StoryGenerator: The story generator.
+    """
+    max_images, image_every = image_density(max_images, image_every)
+    # every image needs at least one image call, fewer images keep the story within budget
+    budget = usage.image_calls_left()
+    if budget is not None:
+        n_images = len(illustrated_parts(max(n_words // 200, 1), image_every, max_images))
+        if budget < n_images:
+            usage.record_degradation(f"story limited to {budget} images by image budget")
+            max_images = budget
+
+    return StoryGenerator(
+        story_theme=story_theme,
+        story_inspiration=story_inspiration,
+        n_words=n_words,
+        usage=usage,
+        image_every=image_every,
+        max_images=max_images,
+    )
+
+
+def illustrate_story(story: dict, generator: StoryGenerator) -> list:
+    """
+    Keeps the image prompts of the parts to illustrate only, the model may return more parts or
+    prompts than it was asked for.
+
+    Args:
+        story (dict): The generated story, its other parts lose their `image_prompt`.
+        generator (StoryGenerator): The generator of the story, for its image density.
+
+    Returns:
+        list: The (id, part) pairs of the illustrated parts.
+    """
+    story_parts = list(story.get("story").items())
+    illustrated = illustrated_parts(
+        len(story_parts), generator.image_every, generator.max_images
+    )
+    for n_part, (id, story_part) in enumerate(story_parts, start=1):
+        if n_part not in illustrated:
+            story_part.pop("image_prompt", None)
+    illustrated = [
+        (id, story_part) for id, story_part in story_parts if story_part.get("image_prompt")
+    ]
+    logging.info(f"{len(illustrated)} of {len(story_parts)} story parts illustrated")
+    return illustrated
+
+
+def story_colors(story: dict) -> list:
+    """
+    Args:
+        story (dict): The generated story.
+
+    Returns:
+        list: The hex colors suggested in the style and theme of the story.
+    """
+    return HEX_COLOR.findall(
+        " ".join(str(value) for value in story.get("style", {}).values())
+        + str(story.get("theme"))
+    )
+
+
+def fallback_part(
+    id: str, image_prompt: str, image_file: str, usage: StoryUsage, colors: list, error
+) -> bool:
+    """
+    Creates the fallback image of a part whose image could not be generated.
+
+    Args:
+        id (str): Id of the part e.g. "part_1".
+        image_prompt (str): The prompt of the image.
+        image_file (str): Path where the part image is expected.
+        usage (StoryUsage): Records the degradation.
+        colors (list): Colors of the story for the placeholder.
+        error (Exception): Why the image was not generated.
+
+    Returns:
+        bool: True if a fallback image was saved, False if the part is rendered as text only.
+    """
+    fallback = fallback_image(image_prompt, image_file, cache=image_cache, colors=colors)
+    logging.info(
+        f"Image for {id} not generated ({error!r}), fallback: {fallback or 'text only'}"
+    )
+    usage.record_degradation(f"{id} image: {fallback or 'text only'}")
+    metrics.inc("story_image_fallbacks_total")
+    return fallback is not None
+
+
+def theme_failure(error) -> str:
+    """
+    Args:
+        error (Exception): Why the story theme was not generated by the model.
+
+    Returns:
+        str: The reason recorded with the degradation.
+    """
+    if isinstance(error, CircuitOpen):
+        return "theme model unavailable"
+    if isinstance(error, TimeoutError):
+        return "story deadline"
+    return "theme model error"
+
+
+def format_story(story: dict, story_theme: dict, image_files: dict, page_dir: str = None) -> str:
+    """
+    Formats the story into HTML.
+
+    Args:
+        story (dict): The generated story.
+        story_theme (dict): The theme with the `BackgroundColor`, `FontColor` and `FontFamily` keys.
+        image_files (dict): Image path by part id, parts without an image are rendered as text only.
+        page_dir (str, optional): Directory of the HTML file when the story is saved as a file,
+            the image paths are then relative to it. Defaults to None, for the pages of the app.
+
+    Returns:
+        str: An HTML string representing the story.
+    """
+    logging.info(story_theme)
+    story_formmater = story_formatter(story_theme, image_prefix="" if page_dir else "../")
+    story_formmater.add_title(title=story.get("title"))
+    story_formmater.add_introduction(introduction=story.get("introduction"))
+    for id in story.get("story"):
+        story_formmater.add_part(
+            **part_format_args(story, story_theme, image_files, id, page_dir)
+        )
+
+    story_formmater.compile_story()
+
+    return story_formmater.get_story()
+
+
+def format_part(story: dict, story_theme: dict, image_files: dict, part_id: str) -> str:
+    """
+    Formats a single part of the story into HTML, to replace it in the page of the story.
+
+    Args:
+        See `format_story`.
+        part_id (str): Id of the part e.g. "part_1".
+
+    Returns:
+        str: An HTML string representing the part.
+    """
+    return story_formatter(story_theme).format_part(
+        **part_format_args(story, story_theme, image_files, part_id)
+    )
+
+
+def story_formatter(story_theme: dict, image_prefix: str = "../") -> FormatStory:
+    """
+    Args:
+        story_theme (dict): The theme with the `BackgroundColor`, `FontColor` and `FontFamily` keys.
+        image_prefix (str, optional): Prefix of the image paths. Defaults to "../".
+
+    Returns:
+        FormatStory: The formatter of the story.
+    """
+    return FormatStory(
+        background_color=story_theme.get("BackgroundColor"),
+        font_color=story_theme.get("FontColor"),
+        font_family=story_theme.get("FontFamily"),
+        image_prefix=image_prefix,
+    )
+
+
+def image_url(image_file: str, page_dir: str = None) -> str:
+    """
+    Args:
+        image_file (str): Path to the image, None for no image.
+        page_dir (str, optional): Directory of the HTML file the URL is relative to. Defaults to
+            None, for a path relative to the app root.
+
+    Returns:
+        str: The versioned URL of the image, see `asset_url`.
+    """
+    url = asset_url(image_file)
+    if url is None or page_dir is None:
+        return url
+    return os.path.relpath(image_file, page_dir).replace(os.sep, "/") + url[len(image_file):]
+
+
+def part_format_args(
+    story: dict, story_theme: dict, image_files: dict, part_id: str, page_dir: str = None
+) -> dict:
+    """
+    Returns:
+        dict: The arguments of `FormatStory.add_part` for a part of the story.
+    """
+    story_part_clean = story.get("story")[part_id].get("story").encode("utf-8", "ignore")
+    story_part_clean = story_part_clean.decode()
+    # the images alternate sides from one illustrated part to the next, text only parts between
+    # them do not break the alternation
+    illustrated = [id for id in story.get("story") if image_files.get(id)]
+    image_left = (illustrated.index(part_id) % 2 == 1) if part_id in illustrated else None
+    # the URL of the image changes with its content, so the image can be cached as immutable
+    return dict(
+        image_path=image_url(image_files.get(part_id), page_dir),
+        story=story_part_clean,
+        section=int(part_id.split("_")[1]),
+        back_color=story_theme.get("BackgroundColor"),
+        font_color=story_theme.get("FontColor"),
+        image_left=image_left,
+    )
+
+
+def story_record(
+    story: dict,
+    story_theme: dict,
+    image_files: dict,
+    image_dir: str,
+    colors: list,
+    generator: StoryGenerator,
+    variants: dict = None,
+) -> dict:
+    """
+    Collects what is needed to regenerate a part of the story later without the other parts.
+
+    Args:
+        story (dict): The generated story.
+        story_theme (dict): The chosen theme.
+        image_files (dict): Image path by part id.
+        image_dir (str): Directory of the part images.
+        colors (list): Colors of the story.
+        generator (StoryGenerator): The generator of the story, for its options.
+        variants (dict, optional): The translations of the story by language key.
+
+    Returns:
+        dict: The record of the story, saved by `StoryStore`.
+    """
+    return {
+        "story": story,
+        "theme": story_theme,
+        "image_files": image_files,
+        "image_dir": image_dir,
+        "colors": colors,
+        "options": {
+            "story_theme": generator.story_theme,
+            "story_inspiration": generator.story_inspiration,
+            "n_words": generator.n_words,
+            "image_every": generator.image_every,
+            "max_images": generator.max_images,
+        },
+        "revisions": {},
+        "variants": variants or {},
+    }
 
 
 def build_story(
@@ -20,6 +408,14 @@ def build_story(
     story_theme: str = "General",
     story_inspiration: str = "General",
     n_words: int = 200,
+    image_dir: str = os.path.join("static", "images"),
+    usage: StoryUsage = None,
+    deadline: float = None,
+    part_deadline: float = None,
+    record: dict = None,
+    languages: list = None,
+    max_images: int = None,
+    image_every: int = None,
 ):
     """
     Builds a story by generating text, images, and formatting it into HTML.
@@ -30,6 +426,24 @@ def build_story(
         story_theme (str, optional): The theme of the story. Defaults to "General".
         story_inspiration (str, optional): The inspiration for the story. Defaults to "General".
         n_words (int, optional): The desired number of words for the story. Defaults to 200.
+        image_dir (str, optional): Directory where the generated part images are saved.
+            Defaults to "static/images".
+        usage (StoryUsage, optional): Records the model usage of the story and holds its budget.
+            Defaults to a new `StoryUsage` with the budget configured in the environment.
+        deadline (float, optional): Seconds after which the story is returned with fallbacks for the
+            parts whose image is not generated yet. Defaults to `STORY_DEADLINE_SECONDS` from the
+            environment or 150.
+        part_deadline (float, optional): Seconds allowed to generate the image of a single part.
+            Defaults to `PART_DEADLINE_SECONDS` from the environment or 60.
+        record (dict, optional): Filled with the story JSON, theme, image files and options, to
+            save the story and regenerate its parts with `regenerate_part`. Defaults to None.
+        languages (list, optional): Languages the story is translated into while its images are
+            generated, the translations are added to the `variants` of the record. Defaults to
+            None.
+        max_images (int, optional): Most images of the story, spread over its parts, 0 for a
+            text only story. Defaults to `IMAGES_PER_STORY` from the environment or no limit.
+        image_every (int, optional): Every k-th part of the story is illustrated. Defaults to
+            `IMAGE_EVERY_K` from the environment or 1.
 
     Returns:
         str: An HTML string representing the generated story.
@@ -37,59 +451,374 @@ def build_story(
 
     if n_words > MAX_WORDS:
         n_words = MAX_WORDS
-    generator = StoryGenerator(
-        story_theme=story_theme, story_inspiration=story_inspiration, n_words=n_words
-    )
+    if usage is None:
+        usage = StoryUsage()
+    story_deadline, part_deadline = story_deadlines(deadline, part_deadline)
 
+    generator = new_story_generator(
+        story_theme, story_inspiration, n_words, usage, max_images, image_every
+    )
     if image_file:
-        img = Image.open(image_file)
-        generator.set_image_context(img=img)
+        with load_thumbnail(image_file, CONTEXT_IMAGE_MAX_SIDE) as img:
+            generator.set_image_context(img=img)
     else:
         generator.set_context(context=context)
     story = generator.generate_response()
 
-    current_story_theme = ""
-    for key, value in story.get("style").items():
-        current_story_theme = current_story_theme + f"\n{key}: {value},"
-    story_generator = StoryImageGen()
-    theme_generator = StoryThemeGenerator(story_theme=story.get("theme"))
-
-    # Generate Images
-    for id, story_part in story.get("story").items():
-        story_generator.generate_image(image_prompt=story_part.get("image_prompt"))
-        image_file_path = os.path.join("static", "images", f"{id}.png")
-        story_generator.save_image(image_file=image_file_path)
-        theme_generator.extract_image_theme(image_file=image_file_path)
-        logging.info(f"Image saved for {id}")
-
-    story_theme = theme_generator.get_story_theme()
-    logging.info(story_theme)
-    logging.info(story_theme is None)
+    story_generator = StoryImageGen(usage=usage)
+    theme_generator = StoryThemeGenerator(story_theme=story.get("theme"), usage=usage)
+    story_parts = illustrate_story(story, generator)
+    colors = story_colors(story)
+    os.makedirs(image_dir, exist_ok=True)
 
-    logging.info(story_theme)
-    story_formmater = FormatStory(
-        background_color=story_theme.get("BackgroundColor"),
-        font_color=story_theme.get("FontColor"),
-        font_family=story_theme.get("FontFamily"),
+    translator = StoryTranslator(usage=usage) if (languages and record is not None) else None
+
+    # model calls run on the executor so a slow call can be abandoned at its deadline
+    executor = ThreadPoolExecutor(max_workers=len(story_parts) + 2 + (translator is not None))
+    translation = None
+    if translator is not None:
+        translation = executor.submit(
+            contextvars.copy_context().run,
+            run_in_session,
+            translator.translate,
+            story,
+            languages,
+            timeout_at=story_deadline,
+        )
+    image_files = {}
+    # perceptual hash of the last generated image, to pick consistent candidates
+    previous_hash = None
+    try:
+        # Generate Images
+        for n_part, (id, story_part) in enumerate(story_parts, start=1):
+            # keep one image call in the budget for each of the remaining illustrated parts
+            max_calls = usage.image_calls_left()
+            if max_calls is not None:
+                max_calls -= len(story_parts) - n_part
+
+            image_prompt = story_part.get("image_prompt")
+            image_file_path = os.path.join(image_dir, f"{id}.png")
+            part_deadline_at = min(time.time() + part_deadline, story_deadline)
+            try:
+                image = run_until(
+                    executor,
+                    part_deadline_at,
+                    story_generator.generate_image,
+                    image_prompt=image_prompt,
+                    max_calls=max_calls,
+                    deadline=part_deadline_at,
+                    colors=colors,
+                    previous_hash=previous_hash,
+                )
+                story_generator.save_image(image_file=image_file_path, image=image)
+                if story_generator.n_candidates > 1:
+                    previous_hash = dhash(image._pil_image)
+                release_image(image)
+                image_cache.add(image_prompt, image_file_path)
+                generated = True
+                logging.info(f"Image saved for {id}")
+            except Exception as e:
+                if not fallback_part(id, image_prompt, image_file_path, usage, colors, e):
+                    continue
+                generated = False
+
+            image_files[id] = image_file_path
+            if generated and not usage.tokens_exhausted():
+                try:
+                    run_until(
+                        executor,
+                        story_deadline,
+                        theme_generator.extract_image_theme,
+                        image_file=image_file_path,
+                    )
+                    continue
+                except Exception as e:
+                    logging.info(f"Palette for {id} extracted locally ({e!r})")
+            theme_generator.extract_local_palette(image_file=image_file_path)
+
+        if usage.tokens_exhausted():
+            usage.record_degradation("local theming, token budget")
+            story_theme = theme_generator.get_local_theme()
+        else:
+            try:
+                story_theme = run_until(
+                    executor, story_deadline, theme_generator.get_story_theme
+                )
+            except Exception as e:
+                logging.info(f"Story theme generated locally ({e!r})")
+                usage.record_degradation(f"local theming, {theme_failure(e)}")
+                story_theme = None
+            story_theme = story_theme or theme_generator.get_local_theme()
+
+        variants = {}
+        if translation is not None:
+            try:
+                variants = translation.result(timeout=max(story_deadline - time.time(), 0) + 1)
+            except Exception as e:
+                logging.info(f"Story not translated ({e!r})")
+                usage.record_degradation("story not translated")
+    finally:
+        executor.shutdown(wait=False)
+
+    html_story = format_story(story, story_theme, image_files)
+    if record is not None:
+        record.update(
+            story_record(story, story_theme, image_files, image_dir, colors, generator, variants)
+        )
+    usage.finish()
+
+    return html_story
+
+
+async def abuild_story(
+    image_file: str = None,
+    context: str = None,
+    story_theme: str = "General",
+    story_inspiration: str = "General",
+    n_words: int = 200,
+    image_dir: str = os.path.join("static", "images"),
+    usage: StoryUsage = None,
+    deadline: float = None,
+    part_deadline: float = None,
+    record: dict = None,
+    languages: list = None,
+    max_images: int = None,
+    image_every: int = None,
+):
+    """
+    Async version of `build_story`, the images of all the parts are generated concurrently.
+
+    The image budget is split evenly between the illustrated parts, and a part whose deadline
+    passes is cancelled instead of being left running. As the parts do not wait for each other,
+    the candidate images are not scored on their consistency with the previous part.
+
+    Args:
+        See `build_story`.
+
+    Returns:
+        str: An HTML string representing the generated story.
+    """
+
+    if n_words > MAX_WORDS:
+        n_words = MAX_WORDS
+    if usage is None:
+        usage = StoryUsage()
+    story_deadline, part_deadline = story_deadlines(deadline, part_deadline)
+
+    generator = new_story_generator(
+        story_theme, story_inspiration, n_words, usage, max_images, image_every
     )
-    story_formmater.add_title(title=story.get("title"))
-    story_formmater.add_introduction(introduction=story.get("introduction"))
-    for id, story_part in story.get("story").items():
-        idx = int(id.split("_")[1])
-        image_file_path = os.path.join("static", "images", f"{id}.png")
+    if image_file:
+        with await asyncio.to_thread(
+            load_thumbnail, image_file, CONTEXT_IMAGE_MAX_SIDE
+        ) as img:
+            await generator.aset_image_context(img=img)
+    else:
+        generator.set_context(context=context)
+    story = await generator.agenerate_response()
 
-        story_part_clean = story_part.get("story").encode("utf-8", "ignore")
-        story_part_clean = story_part_clean.decode()
-        story_formmater.add_part(
-            image_path=image_file_path,
-            story=story_part_clean,
-            section=idx,
-            back_color=story_theme.get("BackgroundColor"),
-            font_color=story_theme.get("FontColor"),
+    story_generator = StoryImageGen(usage=usage)
+    theme_generator = StoryThemeGenerator(story_theme=story.get("theme"), usage=usage)
+    story_parts = illustrate_story(story, generator)
+    colors = story_colors(story)
+    os.makedirs(image_dir, exist_ok=True)
+
+    translation = None
+    if languages and record is not None:
+        translation = asyncio.ensure_future(
+            StoryTranslator(usage=usage).atranslate(story, languages, timeout_at=story_deadline)
         )
 
-    story_formmater.compile_story()
+    calls_left = usage.image_calls_left()
+    image_files = {}
+
+    async def generate_part(n_part: int, id: str, story_part: dict):
+        max_calls = None
+        if calls_left is not None:
+            max_calls = calls_left // len(story_parts) + (
+                n_part <= calls_left % len(story_parts)
+            )
+
+        image_prompt = story_part.get("image_prompt")
+        image_file_path = os.path.join(image_dir, f"{id}.png")
+        part_deadline_at = min(time.time() + part_deadline, story_deadline)
+        try:
+            # no `previous_hash`, the image of the previous part is generated at the same time
+            image = await asyncio.wait_for(
+                story_generator.agenerate_image(
+                    image_prompt=image_prompt,
+                    max_calls=max_calls,
+                    deadline=part_deadline_at,
+                    colors=colors,
+                ),
+                timeout=part_deadline_at - time.time(),
+            )
+            await asyncio.to_thread(
+                story_generator.save_image, image_file=image_file_path, image=image
+            )
+            release_image(image)
+            await asyncio.to_thread(image_cache.add, image_prompt, image_file_path)
+            generated = True
+            logging.info(f"Image saved for {id}")
+        except Exception as e:
+            if not await asyncio.to_thread(
+                fallback_part, id, image_prompt, image_file_path, usage, colors, e
+            ):
+                return
+            generated = False
+
+        image_files[id] = image_file_path
+        if generated and not usage.tokens_exhausted():
+            try:
+                await asyncio.wait_for(
+                    theme_generator.aextract_image_theme(image_file=image_file_path),
+                    timeout=story_deadline - time.time(),
+                )
+                return
+            except Exception as e:
+                logging.info(f"Palette for {id} extracted locally ({e!r})")
+        await asyncio.to_thread(
+            theme_generator.extract_local_palette, image_file=image_file_path
+        )
+
+    await asyncio.gather(
+        *(
+            generate_part(n_part, id, story_part)
+            for n_part, (id, story_part) in enumerate(story_parts, start=1)
+        )
+    )
 
-    html_story = story_formmater.get_story()
+    if usage.tokens_exhausted():
+        usage.record_degradation("local theming, token budget")
+        story_theme = theme_generator.get_local_theme()
+    else:
+        try:
+            story_theme = await asyncio.wait_for(
+                theme_generator.aget_story_theme(), timeout=story_deadline - time.time()
+            )
+        except Exception as e:
+            logging.info(f"Story theme generated locally ({e!r})")
+            usage.record_degradation(f"local theming, {theme_failure(e)}")
+            story_theme = None
+        story_theme = story_theme or theme_generator.get_local_theme()
+
+    variants = {}
+    if translation is not None:
+        try:
+            variants = await translation
+        except Exception as e:
+            logging.info(f"Story not translated ({e!r})")
+            usage.record_degradation("story not translated")
+
+    html_story = format_story(story, story_theme, image_files)
+    if record is not None:
+        record.update(
+            story_record(story, story_theme, image_files, image_dir, colors, generator, variants)
+        )
+    usage.finish()
 
     return html_story
+
+
+def regenerate_part(
+    record: dict,
+    part_id: str,
+    target: str,
+    instructions: str = None,
+    usage: StoryUsage = None,
+    deadline: float = None,
+) -> str:
+    """
+    Regenerates the text or the image of a single part of a saved story.
+
+    The other parts, their images and the theme of the story are kept, so this takes a single
+    model call. A new image reuses the prompt of the part, with its character details, and is
+    taken from the runner up candidates of that prompt when there are some left.
+
+    Args:
+        record (dict): The record of the story from `build_story`, updated in place.
+        part_id (str): Id of the part e.g. "part_2".
+        target (str): "text" or "image".
+        instructions (str, optional): What the reader wants changed in the text. Defaults to None.
+        usage (StoryUsage, optional): Records the model usage. Defaults to a new `StoryUsage`.
+        deadline (float, optional): Seconds allowed for the image. Defaults to
+            `PART_DEADLINE_SECONDS` from the environment or 60.
+
+    Returns:
+        str: An HTML string representing the regenerated part.
+
+    Raises:
+        KeyError: If the story has no such part.
+        ValueError: If the target is not "text" or "image", or the image of a part which is
+            not illustrated is regenerated.
+    """
+    if usage is None:
+        usage = StoryUsage()
+    story = record["story"]
+    part = story["story"][part_id]
+
+    if target == "text":
+        generator = StoryGenerator(usage=usage, **record["options"])
+        part["story"] = generator.regenerate_part(story, part_id, instructions)
+        # the translations of the part are out of date, they are translated again when rendered
+        for variant in record.get("variants", {}).values():
+            variant.get("story", {}).pop(part_id, None)
+    elif target == "image":
+        if not part.get("image_prompt"):
+            raise ValueError(f"{part_id} is not illustrated")
+        record["image_files"][part_id] = regenerate_part_image(record, part_id, usage, deadline)
+    else:
+        raise ValueError(f"Unknown part target {target!r}")
+
+    usage.finish()
+    return format_part(story, record["theme"], record["image_files"], part_id)
+
+
+def regenerate_part_image(
+    record: dict, part_id: str, usage: StoryUsage, deadline: float = None
+) -> str:
+    """
+    Replaces the image of a part, under a new file name so the pages do not show a cached copy.
+
+    Returns:
+        str: Path to the new image.
+    """
+    image_prompt = record["story"]["story"][part_id].get("image_prompt")
+    revision = record["revisions"].get(part_id, 0) + 1
+    image_file_path = os.path.join(record["image_dir"], f"{part_id}_r{revision}.png")
+    os.makedirs(record["image_dir"], exist_ok=True)
+
+    if not runner_ups.pop(image_prompt, image_file_path):
+        _, part_deadline = story_deadlines(part_deadline=deadline)
+        story_generator = StoryImageGen(usage=usage)
+        previous_hash = None
+        # the nearest earlier illustrated part, the parts between may be text only
+        part_ids = list(record["story"]["story"])
+        previous_file = next(
+            (
+                record["image_files"][id]
+                for id in reversed(part_ids[: part_ids.index(part_id)])
+                if record["image_files"].get(id)
+            ),
+            None,
+        )
+        if (story_generator.n_candidates > 1) and previous_file and os.path.exists(previous_file):
+            with load_thumbnail(previous_file, CONTEXT_IMAGE_MAX_SIDE) as img:
+                previous_hash = dhash(img)
+        image = story_generator.generate_image(
+            image_prompt=image_prompt,
+            max_calls=usage.image_calls_left(),
+            deadline=time.time() + part_deadline,
+            colors=record["colors"],
+            previous_hash=previous_hash,
+        )
+        story_generator.save_image(image_file=image_file_path, image=image)
+        release_image(image)
+    image_cache.add(image_prompt, image_file_path)
+
+    replaced = record["image_files"].get(part_id)
+    if replaced and (replaced != image_file_path) and os.path.exists(replaced):
+        os.remove(replaced)
+    record["revisions"][part_id] = revision
+    logging.info(f"Image of {part_id} regenerated, revision {revision}")
+    return image_file_path
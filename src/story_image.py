@@ -4,9 +4,17 @@ It includes functionalities to handle retries, improve prompts, and save generat
 """
 
 import os
+import time
 import logging
-import google.generativeai as genai
-from vertexai.vision_models import ImageGenerationModel
+from src.usage import StoryUsage
+from src.model_adapters import get_vision_text_model, get_image_model
+from src.hedging import image_hedger
+from src.image_scoring import rank_images, runner_ups
+from src.theme_generator import HEX_COLOR
+from src.circuit_breaker import CircuitOpen
+
+# most images the model generates in a call
+MAX_CANDIDATES = 4
 
 
 class StoryImageGen:
@@ -17,65 +25,276 @@ class StoryImageGen:
     It also handles retries and saves the generated images.
     """
 
-    def __init__(self):
+    def __init__(self, usage: StoryUsage = None, n_candidates: int = None):
         """
         Initializes the StoryImageGen object.
 
-        Configures the generative AI and sets up the language and vision models using environment variables.
-        It also initializes the number of retries to 1.
+        Sets up the language and vision models using environment variables.
+
+        Args:
+            usage (StoryUsage, optional): Records the image generation calls and the tokens used
+                to improve prompts. Defaults to a new `StoryUsage`.
+            n_candidates (int, optional): Number of images requested in each call, the best is
+                picked by local scores. Defaults to `IMAGE_CANDIDATES` from the environment or 1.
         """
-        genai.configure()
-        self.language_model = genai.GenerativeModel(os.getenv("IMAGE_TO_TEXT_MODEL"))
-        self.model = ImageGenerationModel.from_pretrained(os.getenv("VISION_MODEL"))
-        self.n_retries = 1
+        self.language_model = get_vision_text_model(os.getenv("IMAGE_TO_TEXT_MODEL"))
+        self.model = get_image_model(os.getenv("VISION_MODEL"))
+        self.usage = usage or StoryUsage()
+        self.n_candidates = min(
+            max(n_candidates or int(os.getenv("IMAGE_CANDIDATES", 1)), 1), MAX_CANDIDATES
+        )
 
-    def generate_image(self, image_prompt):
+    def generate_image(
+        self,
+        image_prompt,
+        max_calls: int = None,
+        deadline: float = None,
+        colors: list = None,
+        previous_hash: int = None,
+    ):
         """
         Generates an image based on the provided text prompt.
 
         This method attempts to generate an image using the vision model.
         If the generation fails, it retries up to 6 times, potentially improving the prompt
         using the language model after the first two retries.
+        The prompt is not improved once the token budget of the story is used up.
+        The retry state is kept per call, so parts can be generated from different threads.
+        When hedging is enabled, a call slower than usual is sent a second time within the budget.
+        When several candidates are requested, the best is picked with `select_image`.
 
         Args:
             image_prompt (str): The text prompt to use for image generation.
+            max_calls (int, optional): Maximum number of calls, retries included, allowed by the
+                image budget of the story. Defaults to None (no limit).
+            deadline (float, optional): Time (as returned by `time.time()`) after which failed calls
+                are not retried. Defaults to None (no deadline).
+            colors (list, optional): Hex colors of the story, to score the candidates.
+            previous_hash (int, optional): Perceptual hash of the image of the previous part,
+                to score the candidates.
+
+        Returns:
+            GeneratedImage: The generated image.
 
         Raises:
              Exception: If image generation fails after maximum retries.
         """
 
-        self.prompt = image_prompt
-        while self.n_retries <= 6:
-            logging.info(f"Image generation for the story, try {self.n_retries}")
+        prompt = image_prompt
+        n_retries = 1
+        hedges = []
+        while True:
+            logging.info(f"Image generation for the story, try {n_retries}")
             try:
-                self.image = self.model.generate_images(prompt=self.prompt)[0]
-                self.n_retries = 1
-                break
+                self.usage.record_image_call(retry=n_retries > 1)
+                if image_hedger.enabled():
+                    images = image_hedger.call(
+                        self.model.executor,
+                        self.model.generate_images,
+                        prompt=prompt,
+                        number_of_images=self.n_candidates,
+                        can_hedge=self.can_hedge(n_retries + len(hedges), max_calls),
+                        on_hedge=lambda: hedges.append(self.usage.record_image_call()),
+                    )
+                else:
+                    images = self.model.generate_images(
+                        prompt=prompt, number_of_images=self.n_candidates
+                    )
+                return self.select_image(images, image_prompt, colors, previous_hash)
             except Exception as e:
-                self.n_retries += 1
-                logging.info(
-                    f"Error generating image: {e}, trying again, try: {self.n_retries}"
+                n_retries += 1
+                action = self.retry_action(
+                    e, n_retries, self.calls_left(max_calls, hedges), deadline
                 )
-                if self.n_retries <= 2:
-                    continue
-                elif (self.n_retries > 2) and (self.n_retries <= 5):
-                    logging.info(
-                        f"Error generating image: {e}, trying with improved prompt, try: {self.n_retries}"
+                if action == "raise":
+                    raise e
+                if action == "improve":
+                    prompt = self.improve_prompt(prompt)
+
+    async def agenerate_image(
+        self,
+        image_prompt,
+        max_calls: int = None,
+        deadline: float = None,
+        colors: list = None,
+        previous_hash: int = None,
+    ):
+        """
+        Async version of `generate_image`.
+        """
+        prompt = image_prompt
+        n_retries = 1
+        hedges = []
+        while True:
+            logging.info(f"Image generation for the story, try {n_retries}")
+            try:
+                self.usage.record_image_call(retry=n_retries > 1)
+                if image_hedger.enabled():
+                    images = await image_hedger.acall(
+                        self.model.agenerate_images,
+                        prompt=prompt,
+                        number_of_images=self.n_candidates,
+                        can_hedge=self.can_hedge(n_retries + len(hedges), max_calls),
+                        on_hedge=lambda: hedges.append(self.usage.record_image_call()),
                     )
-                    self.improve_prompt()
-                    continue
                 else:
+                    images = await self.model.agenerate_images(
+                        prompt=prompt, number_of_images=self.n_candidates
+                    )
+                return self.select_image(images, image_prompt, colors, previous_hash)
+            except Exception as e:
+                n_retries += 1
+                action = self.retry_action(
+                    e, n_retries, self.calls_left(max_calls, hedges), deadline
+                )
+                if action == "raise":
                     raise e
+                if action == "improve":
+                    prompt = await self.aimprove_prompt(prompt)
+
+    def select_image(
+        self, images: list, image_prompt: str, colors: list = None, previous_hash: int = None
+    ):
+        """
+        Picks the best of the generated images and keeps the others as runners up.
+
+        Args:
+            images (list): The generated images.
+            image_prompt (str): The original prompt of the part, the key of the runners up.
+            colors (list, optional): Hex colors of the story, the colors of the prompt are used first.
+            previous_hash (int, optional): Perceptual hash of the image of the previous part.
+
+        Returns:
+            GeneratedImage: The best image.
+
+        Raises:
+            IndexError: If no image was generated e.g. all were filtered by the model.
+        """
+        if len(images) <= 1:
+            return images[0]
+
+        ranked = rank_images(images, HEX_COLOR.findall(image_prompt) or colors, previous_hash)
+        logging.info(
+            "Candidate image scores: "
+            + ", ".join(f"{scores['total']:.3f}" for scores, _ in ranked)
+        )
+        runner_ups.add(image_prompt, [image for _, image in ranked[1:]])
+        return ranked[0][1]
+
+    def can_hedge(self, n_calls: int, max_calls: int = None) -> bool:
+        """
+        Args:
+            n_calls (int): Number of calls made for the image, the current call included.
+            max_calls (int, optional): Maximum number of calls allowed by the image budget.
 
-    def improve_prompt(self):
+        Returns:
+            bool: Whether a hedge call fits in the image budget.
+        """
+        return (max_calls is None) or (n_calls < max_calls)
+
+    def calls_left(self, max_calls: int, hedges: list) -> int:
+        """
+        Args:
+            max_calls (int): Maximum number of calls allowed by the image budget, None for no limit.
+            hedges (list): The hedge calls sent for the image.
+
+        Returns:
+            int: Maximum number of calls, hedges excluded, None for no limit.
+        """
+        return None if max_calls is None else max_calls - len(hedges)
+
+    def retry_action(
+        self, error, n_retries: int, max_calls: int = None, deadline: float = None
+    ) -> str:
+        """
+        Decides how to continue after a failed image generation call.
+
+        Args:
+            error (Exception): The error of the failed call.
+            n_retries (int): Number of the next try.
+            max_calls (int, optional): Maximum number of calls allowed by the image budget.
+            deadline (float, optional): Time after which failed calls are not retried.
+
+        Returns:
+            str: "retry" to try again with the same prompt, "improve" to try again with an
+                improved prompt or "raise" to give up.
+        """
+        if isinstance(error, CircuitOpen):
+            logging.info(f"Image generation failed fast: {error}")
+            self.usage.record_degradation("image model unavailable")
+            return "raise"
+        logging.info(f"Error generating image: {error}, trying again, try: {n_retries}")
+        if (max_calls is not None) and (n_retries > max_calls):
+            logging.info(f"Image budget of {max_calls} calls used up")
+            self.usage.record_degradation("image retries stopped by budget")
+            return "raise"
+        if (deadline is not None) and (time.time() >= deadline):
+            logging.info("Image deadline passed, not retrying")
+            return "raise"
+        if n_retries <= 2:
+            return "retry"
+        elif (n_retries > 2) and (n_retries <= 5):
+            logging.info(
+                f"Error generating image: {error}, trying with improved prompt, try: {n_retries}"
+            )
+            if self.usage.tokens_exhausted():
+                self.usage.record_degradation("prompt not improved, token budget")
+                return "retry"
+            return "improve"
+        else:
+            return "raise"
+
+    def improve_prompt(self, prompt):
         """
         Improves the image generation prompt using the language model.
 
         This method generates a new prompt based on the original prompt to avoid generating images
         that violate responsible AI policies, include inappropriate content, or are unsuccessful.
         It logs both the original and improved prompts.
+
+        Args:
+            prompt (str): The prompt which failed to generate an image.
+
+        Returns:
+            str: The improved prompt, the original prompt if the language model is unavailable.
         """
-        prompt_to_lang_model = f"""
+        logging.info("ORIGINAL_PROMPT: %s", prompt, extra={"payload": True})
+        try:
+            response = self.language_model.generate_content(self.improve_prompt_text(prompt))
+        except CircuitOpen as e:
+            logging.info(f"Prompt not improved: {e}")
+            return prompt
+        self.usage.record_response("improve_prompt", response)
+        logging.info("IMPROVED_PROMPT: %s", response.text, extra={"payload": True})
+        return response.text
+
+    async def aimprove_prompt(self, prompt):
+        """
+        Async version of `improve_prompt`.
+        """
+        logging.info("ORIGINAL_PROMPT: %s", prompt, extra={"payload": True})
+        try:
+            response = await self.language_model.agenerate_content(
+                self.improve_prompt_text(prompt)
+            )
+        except CircuitOpen as e:
+            logging.info(f"Prompt not improved: {e}")
+            return prompt
+        self.usage.record_response("improve_prompt", response)
+        logging.info("IMPROVED_PROMPT: %s", response.text, extra={"payload": True})
+        return response.text
+
+    def improve_prompt_text(self, prompt) -> str:
+        """
+        Builds the request to the language model to rephrase a failed image prompt.
+
+        Args:
+            prompt (str): The prompt which failed to generate an image.
+
+        Returns:
+            str: The request to the language model.
+        """
+        return f"""
             You are an professional Generative AI developer who writes prompts for vision models
             to generate the images, original prompt is provided in ORIGINAL_IMAGE_PROMPT which is not 
             able to generate the image, model is not able to generate the image. Improve the original
@@ -91,20 +310,17 @@ class StoryImageGen:
             In output only provide the prompt as plain text
 
             ORIGINAL_IMAGE_PROMPT:
-            {self.prompt}
+            {prompt}
         """
 
-        logging.info(f"ORIGINAL_PROMPT: {self.prompt}")
-        self.prompt = self.language_model.generate_content(prompt_to_lang_model).text
-        logging.info(f"IMPROVED_PROMPT: {self.prompt}")
-
-    def save_image(self, image_file):
+    def save_image(self, image_file, image):
         """
         Saves the generated image to the specified file.
 
         Args:
             image_file (str): The path to the file where the image should be saved.
+            image (GeneratedImage): The image to save.
         """
         with open(image_file, "wb") as f:
             filename = f.name
-            self.image.save(filename, include_generation_parameters=False)
+            image.save(filename, include_generation_parameters=False)
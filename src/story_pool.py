@@ -0,0 +1,333 @@
+"""
+Module providing a pool of stories pre-generated for the most requested story options.
+
+Most stories are requested without a context, with the default theme and inspiration. The
+requests are counted per (theme, inspiration, number of words) bucket, and while the instance
+is idle a background thread generates finished stories for the hottest buckets. A request of a
+hot bucket is then served from the pool in milliseconds instead of running the pipeline.
+
+Pooled stories expire after a TTL, and a story is never served twice to the same client.
+"""
+
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+from collections import deque
+from src.metrics import metrics
+from src.scheduler import estimate_cost
+from src.story_builder import image_density, MAX_WORDS
+
+metrics.describe("story_pool_hits_total", "Story requests served from the pool")
+metrics.describe("story_pool_misses_total", "Story requests of a pooled bucket not served from the pool")
+metrics.describe("story_pool_generated_total", "Stories pre-generated for the pool")
+metrics.describe("story_pool_expired_total", "Pooled stories dropped after their TTL")
+metrics.describe("story_pool_stories", "Stories in the pool")
+
+
+def bucket_key(story_theme: str, story_inspiration: str, n_words: int) -> tuple:
+    """
+    Args:
+        story_theme (str): The theme of the story.
+        story_inspiration (str): The inspiration for the story.
+        n_words (int): The requested number of words.
+
+    Returns:
+        tuple: The bucket of the request, the theme and inspiration are normalized and the
+            number of words is clamped like `build_story` does.
+    """
+    return (
+        " ".join((story_theme or "").lower().split()),
+        " ".join((story_inspiration or "").lower().split()),
+        min(n_words, MAX_WORDS),
+    )
+
+
+class PooledStory:
+    """
+    A pre-generated story.
+
+    Attributes:
+        story_id (str): Id of the story, also the name of the directory of its images.
+        html (str): The HTML of the story.
+        image_dir (str): Directory of the images of the story.
+        created (float): Time the story was generated.
+        clients (set): Clients the story was served to.
+    """
+
+    def __init__(self, story_id: str, html: str, image_dir: str):
+        self.story_id = story_id
+        self.html = html
+        self.image_dir = image_dir
+        self.created = time.time()
+        self.clients = set()
+
+
+class StoryPool:
+    """
+    Counts the story requests per bucket and keeps pre-generated stories for the hot buckets.
+
+    The settings are read from the environment when the pool is created:
+
+        - `STORY_POOL`: "1" to pre-generate stories, off by default.
+        - `STORY_POOL_SIZE` (default 3): stories kept per bucket.
+        - `STORY_POOL_MAX_BUCKETS` (default 10): number of hot buckets which are pooled.
+        - `STORY_POOL_MIN_REQUESTS` (default 3): requests in the window for a bucket to be hot.
+        - `STORY_POOL_WINDOW_SECONDS` (default 3600): window the requests are counted in.
+        - `STORY_POOL_TTL_SECONDS` (default 3600): age after which a pooled story is dropped.
+        - `STORY_POOL_MAX_SERVES` (default 3): distinct clients a pooled story is served to.
+        - `STORY_POOL_INTERVAL_SECONDS` (default 5): how often the warmer looks for idle capacity.
+
+    Attributes:
+        scheduler (StoryScheduler): Scheduler of the story jobs, stories are pre-generated only
+            while nothing is queued and its running cost leaves room for them.
+        generate (callable): Generates the HTML of a story from the theme, inspiration, number
+            of words and image directory.
+        pool_dir (str): Directory of the images of the pooled stories.
+        requests (dict): Request times per bucket, within the window.
+        options (dict): Theme, inspiration and number of words of the last request of each
+            bucket, as the client gave them, the stories of the bucket are generated with them.
+        stories (dict): Pooled stories per bucket, oldest first.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        generate,
+        pool_dir: str = os.path.join("static", "images", "pool"),
+    ):
+        """
+        Initializes the StoryPool.
+
+        Args:
+            scheduler (StoryScheduler): Scheduler of the story jobs.
+            generate (callable): Generates the HTML of a story, called with `story_theme`,
+                `story_inspiration`, `n_words` and `image_dir`.
+            pool_dir (str, optional): Directory of the images of the pooled stories.
+                Defaults to "static/images/pool".
+        """
+        self.scheduler = scheduler
+        self.generate = generate
+        self.pool_dir = pool_dir
+        self.enabled = os.getenv("STORY_POOL", "0").lower() in ("1", "true", "yes")
+        self.size = int(os.getenv("STORY_POOL_SIZE", 3))
+        self.max_buckets = int(os.getenv("STORY_POOL_MAX_BUCKETS", 10))
+        self.min_requests = int(os.getenv("STORY_POOL_MIN_REQUESTS", 3))
+        self.window = float(os.getenv("STORY_POOL_WINDOW_SECONDS", 3600))
+        self.ttl = float(os.getenv("STORY_POOL_TTL_SECONDS", 3600))
+        self.max_serves = int(os.getenv("STORY_POOL_MAX_SERVES", 3))
+        self.interval = float(os.getenv("STORY_POOL_INTERVAL_SECONDS", 5))
+        self.requests = {}
+        self.options = {}
+        self.stories = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def record(self, key: tuple, options: dict = None):
+        """
+        Counts a request of a bucket.
+
+        Args:
+            key (tuple): The bucket, from `bucket_key`.
+            options (dict, optional): The `story_theme`, `story_inspiration` and `n_words` of the
+                request. Defaults to the values of the key.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            self.requests.setdefault(key, deque()).append(now)
+            if options is not None:
+                self.options[key] = options
+            self.forget(now)
+
+    def forget(self, now: float):
+        """
+        Drops the requests older than the window. Called with the lock held.
+        """
+        for key in list(self.requests):
+            times = self.requests[key]
+            while times and times[0] < now - self.window:
+                times.popleft()
+            if not times:
+                del self.requests[key]
+                self.options.pop(key, None)
+
+    def hot_buckets(self) -> list:
+        """
+        Returns:
+            list: The hot buckets, the most requested first.
+        """
+        with self.lock:
+            self.forget(time.time())
+            counts = [(len(times), key) for key, times in self.requests.items()]
+        counts = [(count, key) for count, key in counts if count >= self.min_requests]
+        counts.sort(key=lambda bucket: bucket[0], reverse=True)
+        return [key for _, key in counts[: self.max_buckets]]
+
+    def take(self, key: tuple, client: str) -> str:
+        """
+        Serves a pooled story of a bucket the client has not seen yet.
+
+        Args:
+            key (tuple): The bucket, from `bucket_key`.
+            client (str): Id of the client.
+
+        Returns:
+            str: The HTML of the story, None if the pool has no story for the client.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.expire()
+            for story in self.stories.get(key, []):
+                if client not in story.clients:
+                    story.clients.add(client)
+                    if len(story.clients) >= self.max_serves:
+                        # the story stays on disk until it expires, for the clients which have it
+                        self.stories[key].remove(story)
+                    break
+            else:
+                story = None
+            self.update_gauge()
+
+        if story is None:
+            metrics.inc("story_pool_misses_total")
+            return None
+        metrics.inc("story_pool_hits_total")
+        logging.info(f"Story {story.story_id} served from the pool")
+        return story.html
+
+    def expire(self):
+        """
+        Drops the stories older than the TTL and deletes their images. Called with the lock held.
+        """
+        expired_before = time.time() - self.ttl
+        for key in list(self.stories):
+            fresh = []
+            for story in self.stories[key]:
+                if story.created < expired_before:
+                    metrics.inc("story_pool_expired_total")
+                    shutil.rmtree(story.image_dir, ignore_errors=True)
+                else:
+                    fresh.append(story)
+            if fresh:
+                self.stories[key] = fresh
+            else:
+                del self.stories[key]
+
+    def remove_served(self):
+        """
+        Deletes the images of the stories which left the pool once served to enough clients,
+        when they are older than the TTL. Called with the lock held.
+        """
+        if not os.path.isdir(self.pool_dir):
+            return
+        expired_before = time.time() - self.ttl
+        pooled = {story.story_id for stories in self.stories.values() for story in stories}
+        for story_id in os.listdir(self.pool_dir):
+            image_dir = os.path.join(self.pool_dir, story_id)
+            if (story_id not in pooled) and (os.path.getmtime(image_dir) < expired_before):
+                shutil.rmtree(image_dir, ignore_errors=True)
+
+    def update_gauge(self):
+        """
+        Sets the gauge of the number of pooled stories. Called with the lock held.
+        """
+        metrics.set(
+            "story_pool_stories", sum(len(stories) for stories in self.stories.values())
+        )
+
+    def next_bucket(self) -> tuple:
+        """
+        Picks the hot bucket with the fewest pooled stories, the most requested first.
+
+        Returns:
+            tuple: The bucket, None if the pools of all the hot buckets are full.
+        """
+        hot = self.hot_buckets()
+        with self.lock:
+            self.expire()
+            self.remove_served()
+            self.update_gauge()
+            missing = [(self.size - len(self.stories.get(key, [])), key) for key in hot]
+        missing = [(n, key) for n, key in missing if n > 0]
+        if not missing:
+            return None
+        # stable sort keeps the most requested first among equally empty pools
+        missing.sort(key=lambda bucket: bucket[0], reverse=True)
+        return missing[0][1]
+
+    def idle(self, cost: int) -> bool:
+        """
+        Args:
+            cost (int): Estimated cost of the story to pre-generate.
+
+        Returns:
+            bool: Whether the scheduler has room for the story with nothing waiting.
+        """
+        scheduler = self.scheduler
+        with scheduler.lock:
+            return (not scheduler.queue) and (
+                scheduler.running_cost + cost <= scheduler.max_cost // 2
+            )
+
+    def warm(self, key: tuple, cost: int):
+        """
+        Pre-generates a story of a bucket and adds it to the pool.
+
+        Args:
+            key (tuple): The bucket, from `bucket_key`.
+            cost (int): Estimated cost of the story.
+        """
+        story_theme, story_inspiration, n_words = key
+        with self.lock:
+            options = self.options.get(key) or dict(
+                story_theme=story_theme, story_inspiration=story_inspiration, n_words=n_words
+            )
+        story_id = uuid.uuid4().hex
+        image_dir = os.path.join(self.pool_dir, story_id)
+        logging.info(f"Pre-generating story {story_id} for {key}")
+        try:
+            # a low weight puts the pool behind the clients if they arrive meanwhile
+            with self.scheduler.admit("story-pool", cost, weight=0.25):
+                html = self.generate(image_dir=image_dir, **options)
+        except Exception:
+            shutil.rmtree(image_dir, ignore_errors=True)
+            raise
+
+        with self.lock:
+            self.stories.setdefault(key, []).append(PooledStory(story_id, html, image_dir))
+            self.update_gauge()
+        metrics.inc("story_pool_generated_total")
+
+    def run(self):
+        """
+        Pre-generates stories for the hot buckets while the instance is idle, until the process exits.
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                key = self.next_bucket()
+                if key is None:
+                    continue
+                images, every = image_density()
+                cost = estimate_cost(key[2], max_images=images, image_every=every)
+                if self.idle(cost):
+                    self.warm(key, cost)
+            except Exception as e:
+                logging.info(f"Story pre-generation failed ({e!r})")
+
+    def start(self):
+        """
+        Starts the warmer thread if the pool is enabled.
+        """
+        if not self.enabled or self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name="story-pool", daemon=True
+        )
+        self.thread.start()
+        logging.info("Story pool warmer started")
@@ -0,0 +1,157 @@
+"""
+Module persisting the generated stories, so a single part can be regenerated later.
+
+Each story is kept in its own directory under `static/stories/<story_id>`, with the images of
+its parts and a `story.json` record holding the story JSON, the chosen theme, the image file of
+each part and the options it was generated with. Regenerating a part reads the record, calls
+the model once for that part and writes the record back, the other parts are left untouched.
+"""
+
+import os
+import time
+import json
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+STORY_RECORD = "story.json"
+
+
+class StoryStore:
+    """
+    Directories and records of the generated stories.
+
+    Attributes:
+        store_dir (str): Directory of the stories.
+        keep_seconds (float): Age after which a story is deleted, from `STORY_KEEP_SECONDS`
+            (default a day).
+        expire_interval (float): Minimum seconds between two scans for expired stories, from
+            `STORY_EXPIRE_INTERVAL_SECONDS` (default a minute).
+    """
+
+    def __init__(self, store_dir: str = os.path.join("static", "stories"), keep_seconds: float = None):
+        """
+        Initializes the StoryStore.
+
+        Args:
+            store_dir (str, optional): Directory of the stories. Defaults to "static/stories".
+            keep_seconds (float, optional): Age after which a story is deleted. Defaults to
+                `STORY_KEEP_SECONDS` from the environment or a day.
+        """
+        self.store_dir = store_dir
+        self.keep_seconds = keep_seconds or float(os.getenv("STORY_KEEP_SECONDS", 86400))
+        self.expire_interval = float(os.getenv("STORY_EXPIRE_INTERVAL_SECONDS", 60))
+        # time.monotonic() after which the next save scans for expired stories
+        self.next_expire = 0.0
+        # [lock, number of threads holding or waiting for it] by story id
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def story_dir(self, story_id: str) -> str:
+        """
+        Args:
+            story_id (str): Id of the story, the id of the job which generated it.
+
+        Returns:
+            str: Directory of the story and of its images, None if the id is not a safe name.
+        """
+        if not story_id or not story_id.replace("-", "").replace("_", "").isalnum():
+            return None
+        return os.path.join(self.store_dir, story_id)
+
+    def save(self, story_id: str, record: dict):
+        """
+        Writes the record of a story, replacing the previous one atomically, and deletes the
+        expired stories at most once every `expire_interval` seconds.
+
+        Args:
+            story_id (str): Id of the story.
+            record (dict): The story JSON, theme, image files and options of the story.
+        """
+        story_dir = self.story_dir(story_id)
+        os.makedirs(story_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=story_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, os.path.join(story_dir, STORY_RECORD))
+        self.expire_due()
+
+    def load(self, story_id: str) -> dict:
+        """
+        Args:
+            story_id (str): Id of the story.
+
+        Returns:
+            dict: The record of the story, None if it is unknown or expired.
+        """
+        story_dir = self.story_dir(story_id)
+        if story_dir is None:
+            return None
+        try:
+            with open(os.path.join(story_dir, STORY_RECORD), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def edit(self, story_id: str):
+        """
+        Serializes the changes to a story within this process, so two regenerations of the same
+        story do not overwrite each other's record.
+
+        Args:
+            story_id (str): Id of the story.
+
+        Yields:
+            dict: The record of the story, None if it is unknown, saved when the block exits
+                without error.
+        """
+        with self.lock:
+            entry = self.locks.setdefault(story_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                record = self.load(story_id)
+                yield record
+                if record is not None:
+                    self.save(story_id, record)
+        finally:
+            # the lock is dropped once no thread holds or waits for it
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self.locks.pop(story_id, None)
+
+    def expire_due(self):
+        """
+        Deletes the expired stories if the last scan is older than `expire_interval`, so saving a
+        story does not list the whole store each time.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_expire:
+                return
+            self.next_expire = now + self.expire_interval
+        self.expire()
+
+    def expire(self):
+        """
+        Deletes the stories older than `keep_seconds`.
+        """
+        if not os.path.isdir(self.store_dir):
+            return
+        oldest = time.time() - self.keep_seconds
+        for story_id in os.listdir(self.store_dir):
+            story_dir = os.path.join(self.store_dir, story_id)
+            try:
+                expired = os.path.getmtime(story_dir) < oldest
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(story_dir, ignore_errors=True)
+                logging.info(f"Story {story_id} expired")
+
+
+story_store = StoryStore()
@@ -3,14 +3,35 @@ Module for generating a story theme based on an image and a text description of
 """
 
 import os
+import re
+import json
 import base64
-import google.generativeai as genai
-from PIL import Image
-from langchain_google_genai import GoogleGenerativeAI
+import asyncio
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from pydantic import BaseModel, Field
 from langchain_core.exceptions import OutputParserException
+from src.usage import StoryUsage
+from src.model_adapters import get_text_model, get_vision_text_model
+from src.memory import load_thumbnail
+
+HEX_COLOR = re.compile(r"#[0-9a-fA-F]{6}\b")
+# the palette does not need more than a small version of the image
+PALETTE_IMAGE_MAX_SIDE = 512
+
+
+def color_luminance(hex_color: str) -> float:
+    """
+    Computes the relative luminance of a color.
+
+    Args:
+        hex_color (str): The color as a six digit hex code e.g. "#A3B5C7".
+
+    Returns:
+        float: The luminance between 0 (black) and 1 (white).
+    """
+    red, green, blue = (int(hex_color[i : i + 2], 16) / 255 for i in (1, 3, 5))
+    return 0.2126 * red + 0.7152 * green + 0.0722 * blue
 
 
 class StoryTheme(BaseModel):
@@ -42,26 +63,27 @@ class StoryThemeGenerator:
     It then uses this palette, along with the story context, to generate a unified theme including background color, font color, and font family.
 
     Attributes:
-        image_to_text_model (genai.GenerativeModel): Google Generative AI model for image-to-text tasks.
-        llm (GoogleGenerativeAI): Langchain wrapper for Google's generative AI model.
+        image_to_text_model (VisionTextModel): Google Generative AI model for image-to-text tasks.
+        llm (TextModel): Language model generating the final theme.
         proposed_theme (str): A string describing the theme or context of the story.
         themes (list): A list of extracted color palettes (JSON strings).
+        usage (StoryUsage): Records the tokens used by the model calls.
     """
 
-    def __init__(self, story_theme):
+    def __init__(self, story_theme, usage: StoryUsage = None):
         """
         Initializes the StoryThemeGenerator with a story context.
 
         Args:
             story_theme (str): A string describing the theme or context of the story.
+            usage (StoryUsage, optional): Records the tokens used by the model calls.
+                Defaults to a new `StoryUsage`.
         """
-        genai.configure()
-        self.image_to_text_model = genai.GenerativeModel(
-            os.getenv("IMAGE_TO_TEXT_MODEL")
-        )
-        self.llm = GoogleGenerativeAI(model=os.getenv("IMAGE_TO_TEXT_MODEL"))
+        self.image_to_text_model = get_vision_text_model(os.getenv("IMAGE_TO_TEXT_MODEL"))
+        self.llm = get_text_model(os.getenv("IMAGE_TO_TEXT_MODEL"))
         self.proposed_theme = story_theme
         self.themes = []
+        self.usage = usage or StoryUsage()
 
     def extract_image_theme(self, image_file) -> str:
         """
@@ -76,7 +98,36 @@ class StoryThemeGenerator:
         Returns:
             None
         """
-        self.image = Image.open(image_file)
+        with load_thumbnail(image_file, PALETTE_IMAGE_MAX_SIDE) as image:
+            response = self.image_to_text_model.generate_content(
+                self.palette_prompt(image)
+            )
+        self.usage.record_response("extract_image_theme", response)
+        self.themes.append(response.text)
+
+    async def aextract_image_theme(self, image_file):
+        """
+        Async version of `extract_image_theme`.
+        """
+        with await asyncio.to_thread(
+            load_thumbnail, image_file, PALETTE_IMAGE_MAX_SIDE
+        ) as image:
+            response = await self.image_to_text_model.agenerate_content(
+                self.palette_prompt(image)
+            )
+        self.usage.record_response("extract_image_theme", response)
+        self.themes.append(response.text)
+
+    def palette_prompt(self, image) -> list:
+        """
+        Builds the prompt asking the image to text model for the color palette of an image.
+
+        Args:
+            image (Image.Image): The image, downsampled.
+
+        Returns:
+            list: The prompt and the image.
+        """
 
         prompt = """
             You are an expert in web design, color theory, and user experience. Your task is to analyze a provided image and extract a harmonious color palette suitable for a webpage displaying that image alongside text content.
@@ -125,10 +176,55 @@ class StoryThemeGenerator:
 
         """
 
-        self.image_prompt = [prompt, self.image]
+        return [prompt, image]
+
+    def extract_local_palette(self, image_file):
+        """
+        Extracts a four color palette from an image file without calling a model.
+
+        The image is quantized to four colors which are ordered from dark to light and
+        added to the themes list in the same JSON format as `extract_image_theme`.
+
+        Args:
+            image_file (str): Path to the image file.
+        """
+        with load_thumbnail(image_file, 128) as image, image.quantize(colors=4) as quantized:
+            palette = quantized.getpalette()
+            colors = [
+                "#{:02X}{:02X}{:02X}".format(*palette[idx * 3 : idx * 3 + 3])
+                for _, idx in sorted(quantized.getcolors(), reverse=True)
+            ]
+
+        colors = sorted(colors, key=color_luminance)
+        colors = colors + [colors[-1]] * (4 - len(colors))
         self.themes.append(
-            self.image_to_text_model.generate_content(self.image_prompt).text
+            json.dumps(dict(zip(["first", "second", "third", "fourth"], colors)))
+        )
+
+    def get_local_theme(self, font_family: str = "Georgia") -> dict:
+        """
+        Generates a light story theme from the extracted color palettes without calling a model.
+
+        The lightest extracted color is used as background and the darkest as font color.
+
+        Args:
+            font_family (str, optional): Font to be used to present the story. Defaults to "Georgia".
+
+        Returns:
+            dict: The theme with the `BackgroundColor`, `FontColor` and `FontFamily` keys.
+        """
+        colors = sorted(
+            {color.upper() for theme in self.themes for color in HEX_COLOR.findall(theme)},
+            key=color_luminance,
         )
+        if len(colors) < 2:
+            colors = ["#333333", "#FFFFFF"]
+
+        return {
+            "BackgroundColor": colors[-1],
+            "FontColor": colors[0],
+            "FontFamily": font_family,
+        }
 
     def get_story_theme(self):
         """
@@ -144,6 +240,59 @@ class StoryThemeGenerator:
         Raises:
             OutputParserException: if the output is not in the format we expected.
         """
+        n_retry = 0
+
+        while n_retry < 3:
+            try:
+                self.response = self.llm.invoke_chain(*self.theme_chain())
+            except OutputParserException as e:
+                n_retry += 1
+                continue
+
+            if self.is_theme(self.response):
+                return self.response
+            n_retry += 1
+
+    async def aget_story_theme(self):
+        """
+        Async version of `get_story_theme`.
+        """
+        n_retry = 0
+
+        while n_retry < 3:
+            try:
+                self.response = await self.llm.ainvoke_chain(*self.theme_chain())
+            except OutputParserException as e:
+                n_retry += 1
+                continue
+
+            if self.is_theme(self.response):
+                return self.response
+            n_retry += 1
+
+    def is_theme(self, response) -> bool:
+        """
+        Checks that the parsed response of the language model contains all the theme keys.
+
+        Args:
+            response: The parsed response.
+
+        Returns:
+            bool: True if the response is a complete theme.
+        """
+        return isinstance(response, dict) and (
+            ("BackgroundColor" in response.keys())
+            & ("FontColor" in response.keys())
+            & ("FontFamily" in response.keys())
+        )
+
+    def theme_chain(self) -> tuple:
+        """
+        Builds the prompt, parser, inputs and callbacks of the theme generation chain.
+
+        Returns:
+            tuple: The arguments of `TextModel.invoke_chain`.
+        """
         themes = "\n, ".join(self.themes)
 
         prompt = """
@@ -208,32 +357,17 @@ class StoryThemeGenerator:
 
         """
 
-        n_retry = 0
-
-        while n_retry < 3:
-            try:
-                # Set up a parser + inject instructions into the prompt template.
-                parser = JsonOutputParser(pydantic_object=StoryTheme)
-                self.prompt = PromptTemplate(
-                    template=prompt,
-                    input_variables=["theme_context", "color_pallete"],
-                    partial_variables={
-                        "format_instructions": parser.get_format_instructions()
-                    },
-                )
-
-                chain = self.prompt | self.llm | parser
-                self.response = chain.invoke(
-                    {"theme_context": self.proposed_theme, "color_pallete": themes}
-                )
-
-                if (
-                    ("BackgroundColor" in self.response.keys())
-                    & ("FontColor" in self.response.keys())
-                    & ("FontFamily" in self.response.keys())
-                ):
-                    return self.response
+        # Set up a parser + inject instructions into the prompt template.
+        parser = JsonOutputParser(pydantic_object=StoryTheme)
+        self.prompt = PromptTemplate(
+            template=prompt,
+            input_variables=["theme_context", "color_pallete"],
+            partial_variables={"format_instructions": parser.get_format_instructions()},
+        )
 
-            except OutputParserException as e:
-                n_retry += 1
-                continue
+        return (
+            self.prompt,
+            parser,
+            {"theme_context": self.proposed_theme, "color_pallete": themes},
+            [self.usage.callback("get_story_theme")],
+        )
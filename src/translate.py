@@ -0,0 +1,326 @@
+"""
+Module translating the generated stories, to serve a story in several languages from a single
+generation.
+
+Only the text is translated: the title and introduction in one call, and the text of each part
+in its own call, all of them concurrently. The images, palettes and theme of the story are
+reused by every language, so a language costs a few cheap text calls instead of a new story.
+The translations are kept as variants of the story JSON, rendered like the story itself.
+"""
+
+import os
+import re
+import copy
+import json
+import time
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+from src.usage import StoryUsage
+from src.model_adapters import get_text_model
+from src.profiling import run_in_session
+
+LANGUAGE = re.compile(r"^[A-Za-z][A-Za-z \-]{1,39}$")
+# key of the title and introduction call
+HEAD = "head"
+
+
+def parse_languages(value) -> list:
+    """
+    Parses the languages requested for a story.
+
+    Args:
+        value (str | list): Comma separated language names e.g. "French, German", or a list.
+
+    Returns:
+        list: The distinct language names, at most `STORY_MAX_LANGUAGES` (default 5).
+
+    Raises:
+        ValueError: If a language name is not valid or too many languages are requested.
+    """
+    if not value:
+        return []
+    names = value.split(",") if isinstance(value, str) else value
+    languages = []
+    for name in names:
+        name = " ".join(str(name).split())
+        if not name:
+            continue
+        if not LANGUAGE.match(name):
+            raise ValueError(f"Unknown language {name!r}")
+        if variant_key(name) not in map(variant_key, languages):
+            languages.append(name)
+    max_languages = int(os.getenv("STORY_MAX_LANGUAGES", 5))
+    if len(languages) > max_languages:
+        raise ValueError(f"At most {max_languages} languages can be requested")
+    return languages
+
+
+def variant_key(language: str) -> str:
+    """
+    Returns:
+        str: The key of the variant of a language, e.g. "french".
+    """
+    return language.strip().lower()
+
+
+def translation_calls(story: dict, variant: dict = None) -> list:
+    """
+    Lists the texts of a story which are not translated in a variant yet.
+
+    Args:
+        story (dict): The generated story.
+        variant (dict, optional): The variant already translated, None if there is none.
+
+    Returns:
+        list: (key, texts) of each call, the key is "head" or the id of a part.
+    """
+    variant = variant or {}
+    calls = []
+    if "title" not in variant:
+        calls.append(
+            (HEAD, {"title": story.get("title"), "introduction": story.get("introduction")})
+        )
+    for id, story_part in story.get("story").items():
+        if id not in variant.get("story", {}):
+            calls.append((id, {"story": story_part.get("story")}))
+    return calls
+
+
+class StoryTranslator:
+    """
+    Translates the text of the stories with the language model.
+
+    Attributes:
+        llm (TextModel): The language model.
+        usage (StoryUsage): Records the tokens used by the translation calls.
+        max_workers (int): Most translation calls made at once, from `TRANSLATION_MAX_WORKERS`
+            (default 8).
+    """
+
+    def __init__(self, usage: StoryUsage = None):
+        """
+        Initializes the StoryTranslator.
+
+        Args:
+            usage (StoryUsage, optional): Records the tokens used by the translation calls.
+                Defaults to a new `StoryUsage`.
+        """
+        self.llm = get_text_model(os.getenv("LANGUAGE_MODEL"))
+        self.usage = usage or StoryUsage()
+        self.max_workers = int(os.getenv("TRANSLATION_MAX_WORKERS", 8))
+
+    def translation_chain(self, texts: dict, language: str, title: str) -> tuple:
+        """
+        Builds the prompt, parser, inputs and callbacks of a translation call.
+
+        Returns:
+            tuple: The arguments of `TextModel.invoke_chain`.
+        """
+        parser = JsonOutputParser()
+        prompt = PromptTemplate(
+            template="""
+                Translate the values of the JSON object in TEXTS_TO_TRANSLATE into {language}.
+                - Return a JSON object with the same keys and the translated values.
+                - Keep the tone, the names of the characters and the meaning of the story.
+                - The texts are from the story titled "{title}".
+
+                {format_instructions}
+
+                TARGET_LANGUAGE: {language}
+
+                TEXTS_TO_TRANSLATE:
+                {texts}
+            """,
+            input_variables=["language", "title", "texts"],
+            partial_variables={"format_instructions": parser.get_format_instructions()},
+        )
+        inputs = {
+            "language": language,
+            "title": title,
+            "texts": json.dumps(texts, ensure_ascii=False),
+        }
+        return prompt, parser, inputs, [self.usage.callback("translate")]
+
+    def translate_texts(self, texts: dict, language: str, title: str = None) -> dict:
+        """
+        Translates a few texts in one call.
+
+        Args:
+            texts (dict): The texts by key.
+            language (str): The target language.
+            title (str, optional): Title of the story, as context. Defaults to None.
+
+        Returns:
+            dict: The translated texts by key, a text missing from the answer is kept as is.
+        """
+        translated = self.llm.invoke_chain(*self.translation_chain(texts, language, title))
+        return self.checked(texts, translated, language)
+
+    async def atranslate_texts(self, texts: dict, language: str, title: str = None) -> dict:
+        """
+        Async version of `translate_texts`.
+        """
+        translated = await self.llm.ainvoke_chain(
+            *self.translation_chain(texts, language, title)
+        )
+        return self.checked(texts, translated, language)
+
+    def checked(self, texts: dict, translated, language: str) -> dict:
+        """
+        Keeps the source of the texts the model did not translate.
+        """
+        translated = translated if isinstance(translated, dict) else {}
+        result = {}
+        for key, text in texts.items():
+            value = translated.get(key)
+            if not isinstance(value, str) or not value.strip():
+                logging.info(f"{key} not translated into {language}, kept as is")
+                value = text
+            result[key] = value
+        return result
+
+    def translate(
+        self, story: dict, languages: list, variants: dict = None, timeout_at: float = None
+    ) -> dict:
+        """
+        Translates a story into several languages, all the calls running concurrently.
+
+        Only the texts missing from the existing variants are translated. The texts whose
+        translation fails are left out of the variants, to be translated again later.
+
+        Args:
+            story (dict): The generated story.
+            languages (list): The target languages.
+            variants (dict, optional): The existing variants by key, from `variant_key`.
+                Defaults to None.
+            timeout_at (float, optional): Time (as returned by `time.time()`) after which the
+                translations not done are abandoned. Defaults to None (no deadline).
+
+        Returns:
+            dict: The variants of the story by key, the translated title, introduction and parts
+                of the story. The parts whose translation failed are missing.
+        """
+        variants = variants or {}
+        calls = [
+            (language, key, texts)
+            for language in languages
+            for key, texts in translation_calls(story, variants.get(variant_key(language)))
+        ]
+        if not calls:
+            return {variant_key(language): variants[variant_key(language)] for language in languages}
+
+        # the part images are generated meanwhile, the calls are bounded so they do not starve them
+        executor = ThreadPoolExecutor(max_workers=min(len(calls), self.max_workers))
+        try:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    run_in_session,
+                    self.translate_texts,
+                    texts,
+                    language,
+                    story.get("title"),
+                )
+                for language, key, texts in calls
+            ]
+            results = []
+            for future in futures:
+                try:
+                    timeout = None if timeout_at is None else max(timeout_at - time.time(), 0)
+                    results.append(future.result(timeout=timeout))
+                except Exception as e:
+                    results.append(e)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self.merge(story, languages, variants, calls, results)
+
+    async def atranslate(
+        self, story: dict, languages: list, variants: dict = None, timeout_at: float = None
+    ) -> dict:
+        """
+        Async version of `translate`.
+        """
+        variants = variants or {}
+        calls = [
+            (language, key, texts)
+            for language in languages
+            for key, texts in translation_calls(story, variants.get(variant_key(language)))
+        ]
+        tasks = [
+            asyncio.ensure_future(self.atranslate_texts(texts, language, story.get("title")))
+            for language, key, texts in calls
+        ]
+        if tasks:
+            timeout = None if timeout_at is None else max(timeout_at - time.time(), 0)
+            await asyncio.wait(tasks, timeout=timeout)
+        results = []
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                results.append(TimeoutError("translation deadline passed"))
+            else:
+                results.append(task.exception() or task.result())
+        return self.merge(story, languages, variants, calls, results)
+
+    def merge(
+        self, story: dict, languages: list, variants: dict, calls: list, results: list
+    ) -> dict:
+        """
+        Builds the variants of the story from the translated texts.
+
+        Returns:
+            dict: The variants by key.
+        """
+        failed = set()
+        translated = {}
+        for (language, key, _), result in zip(calls, results):
+            if isinstance(result, Exception):
+                logging.info(f"Translation of {key} into {language} failed ({result!r})")
+                failed.add(variant_key(language))
+                continue
+            translated[(variant_key(language), key)] = result
+
+        merged = {}
+        for language in languages:
+            key = variant_key(language)
+            variant = copy.deepcopy(variants.get(key)) or {"language": language, "story": {}}
+            head = translated.get((key, HEAD))
+            if head is not None:
+                variant.update(head)
+            for id, story_part in story.get("story").items():
+                part = translated.get((key, id))
+                if part is not None:
+                    variant["story"][id] = dict(story_part, story=part["story"])
+            # keep the order of the parts of the story
+            variant["story"] = {
+                id: variant["story"][id] for id in story.get("story") if id in variant["story"]
+            }
+            if key in failed:
+                self.usage.record_degradation(f"{language} translation incomplete")
+            merged[key] = variant
+        return merged
+
+
+def variant_story(story: dict, variant: dict) -> dict:
+    """
+    Builds the story JSON of a language, to render it with the images and theme of the story.
+
+    Args:
+        story (dict): The generated story.
+        variant (dict): The variant of the language.
+
+    Returns:
+        dict: The story with the translated texts, the texts not translated yet are kept as is.
+    """
+    translated = dict(story)
+    translated["title"] = variant.get("title", story.get("title"))
+    translated["introduction"] = variant.get("introduction", story.get("introduction"))
+    translated["story"] = {
+        id: variant.get("story", {}).get(id, story_part)
+        for id, story_part in story.get("story").items()
+    }
+    return translated
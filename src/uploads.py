@@ -0,0 +1,171 @@
+"""
+Module providing the storage of the images uploaded to generate a story.
+
+Uploads are streamed to disk in chunks while being hashed, so the memory used does not depend
+on the size of the image. Files are stored under the SHA-256 of their content, which is also
+the opaque image id given back to the client: uploading the same image twice stores it once.
+"""
+
+import os
+import re
+import hashlib
+import logging
+import tempfile
+from src.metrics import metrics
+
+metrics.describe("uploads_total", "Images uploaded")
+metrics.describe("uploads_deduplicated_total", "Uploaded images which were already stored")
+metrics.describe("upload_bytes_total", "Bytes of the uploaded images")
+
+# file signatures of the accepted image types, by extension
+IMAGE_SIGNATURES = {
+    "png": (b"\x89PNG\r\n\x1a\n",),
+    "jpg": (b"\xff\xd8\xff",),
+    "gif": (b"GIF87a", b"GIF89a"),
+    "webp": (b"RIFF",),
+}
+IMAGE_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadError(ValueError):
+    """
+    Base class of the errors of rejected uploads.
+    """
+
+
+class UnsupportedImageType(UploadError):
+    """
+    The uploaded file is not a PNG, JPEG, GIF or WebP image.
+    """
+
+
+class UploadTooLarge(UploadError):
+    """
+    The uploaded file is larger than the size limit.
+    """
+
+
+def image_type(header: bytes) -> str:
+    """
+    Detects the type of an image from its first bytes.
+
+    Args:
+        header (bytes): At least the first 12 bytes of the file.
+
+    Returns:
+        str: The extension of the image type, None if the type is not accepted.
+    """
+    for ext, signatures in IMAGE_SIGNATURES.items():
+        if header.startswith(signatures):
+            if ext == "webp" and header[8:12] != b"WEBP":
+                continue
+            return ext
+    return None
+
+
+class UploadStore:
+    """
+    Content addressed storage of the uploaded images.
+
+    Attributes:
+        upload_dir (str): Directory where the images are stored.
+        chunk_size (int): Number of bytes read from the upload at once.
+        file_mode (int): Permissions of the stored images, from `UPLOAD_FILE_MODE` (octal,
+            default 644) so a static file server or worker running as another user can read them.
+    """
+
+    def __init__(
+        self,
+        upload_dir: str = os.path.join("static", "uploads"),
+        chunk_size: int = 64 * 1024,
+        file_mode: int = None,
+    ):
+        """
+        Initializes the UploadStore.
+
+        Args:
+            upload_dir (str, optional): Directory where the images are stored.
+                Defaults to "static/uploads".
+            chunk_size (int, optional): Number of bytes read from the upload at once. Defaults to 64 KB.
+            file_mode (int, optional): Permissions of the stored images. Defaults to
+                `UPLOAD_FILE_MODE` from the environment or 0o644.
+        """
+        self.upload_dir = upload_dir
+        self.chunk_size = chunk_size
+        self.file_mode = file_mode or int(os.getenv("UPLOAD_FILE_MODE", "644"), 8)
+
+    def save(self, stream, max_bytes: int = None) -> str:
+        """
+        Streams an uploaded image to disk.
+
+        Args:
+            stream: File like object with the content of the upload.
+            max_bytes (int, optional): Maximum size of the image. Defaults to None (no limit).
+
+        Returns:
+            str: The image id.
+
+        Raises:
+            UnsupportedImageType: If the file is not an accepted image type.
+            UploadTooLarge: If the file is larger than `max_bytes`.
+        """
+        header = stream.read(self.chunk_size)
+        ext = image_type(header)
+        if ext is None:
+            raise UnsupportedImageType("Only PNG, JPEG, GIF and WebP images are accepted")
+
+        os.makedirs(self.upload_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(
+            dir=self.upload_dir, prefix=".upload-", delete=False
+        ) as f:
+            try:
+                chunk = header
+                while chunk:
+                    size += len(chunk)
+                    if (max_bytes is not None) and (size > max_bytes):
+                        raise UploadTooLarge(f"Image larger than {max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+                    chunk = stream.read(self.chunk_size)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+
+        image_id = digest.hexdigest()
+        image_file = os.path.join(self.upload_dir, f"{image_id}.{ext}")
+        metrics.inc("uploads_total")
+        metrics.inc("upload_bytes_total", size)
+        if os.path.exists(image_file):
+            os.remove(f.name)
+            metrics.inc("uploads_deduplicated_total")
+            logging.info(f"Uploaded image {image_id} already stored")
+        else:
+            # the temporary file is only readable by its owner
+            os.chmod(f.name, self.file_mode)
+            os.replace(f.name, image_file)
+            logging.info(f"Uploaded image {image_id} stored, {size} bytes")
+        return image_id
+
+    def path(self, image_id: str) -> str:
+        """
+        Finds the stored image of an image id.
+
+        Args:
+            image_id (str): The image id returned by `save`.
+
+        Returns:
+            str: Path to the image, None if the id is invalid or unknown.
+        """
+        if not image_id or not IMAGE_ID.match(image_id):
+            return None
+        for ext in IMAGE_SIGNATURES:
+            image_file = os.path.join(self.upload_dir, f"{image_id}.{ext}")
+            if os.path.exists(image_file):
+                return image_file
+        return None
+
+
+upload_store = UploadStore()
@@ -0,0 +1,360 @@
+"""
+Module for accounting the model usage of each story and enforcing per story budgets.
+
+Every model call made while generating a story is recorded on a `StoryUsage` object: the
+input and output tokens of the language model calls, the image generation calls including
+retries and the wall time of the story. Finished stories are collected by the `usage_registry`
+which keeps the aggregate totals and the usage of the most recent jobs.
+"""
+
+import os
+import time
+import threading
+from collections import deque, OrderedDict
+from langchain_core.callbacks import BaseCallbackHandler
+from src.metrics import metrics
+
+metrics.describe("story_input_tokens_total", "Input tokens sent to the language models")
+metrics.describe("story_output_tokens_total", "Output tokens generated by the language models")
+metrics.describe("story_model_calls_total", "Language model calls")
+metrics.describe("story_image_calls_total", "Image generation calls")
+metrics.describe("story_image_retries_total", "Image generation calls which were retries")
+metrics.describe("story_jobs_total", "Stories generated")
+metrics.describe("story_wall_seconds_total", "Wall time spent generating stories")
+
+
+class StoryBudget:
+    """
+    Limits on the model usage of a single story, a limit of 0 means unlimited.
+
+    Attributes:
+        max_tokens (int): Maximum input plus output tokens of the language model calls.
+        max_image_calls (int): Maximum number of image generation calls, retries included.
+    """
+
+    def __init__(self, max_tokens: int = 0, max_image_calls: int = 0):
+        """
+        Initializes the StoryBudget.
+
+        Args:
+            max_tokens (int, optional): Maximum tokens for the story. Defaults to 0 (unlimited).
+            max_image_calls (int, optional): Maximum image generation calls. Defaults to 0 (unlimited).
+        """
+        self.max_tokens = max_tokens
+        self.max_image_calls = max_image_calls
+
+    @classmethod
+    def from_env(cls):
+        """
+        Creates the budget from the `STORY_TOKEN_BUDGET` and `STORY_IMAGE_CALL_BUDGET`
+        environment variables.
+
+        Returns:
+            StoryBudget: The configured budget.
+        """
+        return cls(
+            max_tokens=int(os.getenv("STORY_TOKEN_BUDGET", 0)),
+            max_image_calls=int(os.getenv("STORY_IMAGE_CALL_BUDGET", 0)),
+        )
+
+
+class StoryUsage:
+    """
+    Records the model usage of a single story.
+
+    Attributes:
+        budget (StoryBudget): The budget of the story.
+        input_tokens (int): Input tokens of all the language model calls.
+        output_tokens (int): Output tokens of all the language model calls.
+        calls (dict): Number of calls and tokens per model call name.
+        image_calls (int): Number of image generation calls.
+        image_retries (int): Number of image generation calls which were retries.
+        wall_time (float): Seconds taken by the story, set by `finish`.
+        degraded (list): Descriptions of the degradations applied to stay within the budget.
+        profile (str): URL of the profile of the story, None if it was not profiled.
+    """
+
+    def __init__(self, budget: StoryBudget = None):
+        """
+        Initializes the StoryUsage and starts the wall clock.
+
+        Args:
+            budget (StoryBudget, optional): The budget of the story. Defaults to the budget
+                configured in the environment.
+        """
+        self.budget = budget or StoryBudget.from_env()
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.calls = {}
+        self.image_calls = 0
+        self.image_retries = 0
+        self.started = time.time()
+        self.wall_time = None
+        self.degraded = []
+        self.profile = None
+        self.lock = threading.Lock()
+
+    @property
+    def total_tokens(self) -> int:
+        """
+        Returns:
+            int: Input plus output tokens.
+        """
+        return self.input_tokens + self.output_tokens
+
+    def record_tokens(self, call: str, input_tokens: int, output_tokens: int):
+        """
+        Records a language model call.
+
+        Args:
+            call (str): Name of the call e.g. `generate_response`.
+            input_tokens (int): Tokens sent to the model.
+            output_tokens (int): Tokens generated by the model.
+        """
+        with self.lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            stats = self.calls.setdefault(
+                call, {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+            )
+            stats["calls"] += 1
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+
+        metrics.inc("story_model_calls_total")
+        metrics.inc("story_input_tokens_total", input_tokens)
+        metrics.inc("story_output_tokens_total", output_tokens)
+
+    def record_response(self, call: str, response):
+        """
+        Records a call from the `usage_metadata` of a `google.generativeai` response.
+
+        Args:
+            call (str): Name of the call e.g. `set_image_context`.
+            response: The response returned by `generate_content`.
+        """
+        usage_metadata = getattr(response, "usage_metadata", None)
+        self.record_tokens(
+            call,
+            getattr(usage_metadata, "prompt_token_count", 0) or 0,
+            getattr(usage_metadata, "candidates_token_count", 0) or 0,
+        )
+
+    def record_image_call(self, retry: bool = False):
+        """
+        Records an image generation call.
+
+        Args:
+            retry (bool, optional): Whether the call retries a failed call. Defaults to False.
+        """
+        with self.lock:
+            self.image_calls += 1
+            if retry:
+                self.image_retries += 1
+
+        metrics.inc("story_image_calls_total")
+        if retry:
+            metrics.inc("story_image_retries_total")
+
+    def record_degradation(self, description: str):
+        """
+        Records a degradation applied to keep the story within its budget.
+
+        Args:
+            description (str): What was degraded.
+        """
+        with self.lock:
+            self.degraded.append(description)
+
+    def tokens_exhausted(self) -> bool:
+        """
+        Returns:
+            bool: True if the token budget is used up.
+        """
+        return bool(self.budget.max_tokens) and (
+            self.total_tokens >= self.budget.max_tokens
+        )
+
+    def image_calls_left(self):
+        """
+        Returns:
+            int: Number of image generation calls left in the budget, None if unlimited.
+        """
+        if not self.budget.max_image_calls:
+            return None
+        return max(self.budget.max_image_calls - self.image_calls, 0)
+
+    def callback(self, call: str):
+        """
+        Creates a LangChain callback handler recording the calls made by a chain.
+
+        Args:
+            call (str): Name of the call e.g. `generate_response`.
+
+        Returns:
+            UsageCallbackHandler: The callback handler to pass to `chain.invoke`.
+        """
+        return UsageCallbackHandler(self, call)
+
+    def finish(self):
+        """
+        Stops the wall clock of the story.
+        """
+        self.wall_time = time.time() - self.started
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: The usage as a JSON serializable dictionary.
+        """
+        with self.lock:
+            return {
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": self.total_tokens,
+                "calls": {call: dict(stats) for call, stats in self.calls.items()},
+                "image_calls": self.image_calls,
+                "image_retries": self.image_retries,
+                "wall_time": (
+                    round(self.wall_time, 3) if self.wall_time is not None else None
+                ),
+                "degraded": list(self.degraded),
+                "profile": self.profile,
+                "budget": {
+                    "max_tokens": self.budget.max_tokens,
+                    "max_image_calls": self.budget.max_image_calls,
+                },
+            }
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler recording the token usage of the language model calls.
+    """
+
+    def __init__(self, usage: StoryUsage, call: str):
+        """
+        Initializes the UsageCallbackHandler.
+
+        Args:
+            usage (StoryUsage): Where the calls are recorded.
+            call (str): Name of the call e.g. `generate_response`.
+        """
+        self.usage = usage
+        self.call = call
+
+    def on_llm_end(self, response, **kwargs):
+        """
+        Records the token usage reported in the generation info of the response.
+
+        Args:
+            response (LLMResult): The result of the language model call.
+        """
+        input_tokens, output_tokens = 0, 0
+        for generations in response.generations:
+            if not generations:
+                continue
+            usage_metadata = (generations[0].generation_info or {}).get(
+                "usage_metadata"
+            ) or {}
+            input_tokens += usage_metadata.get(
+                "prompt_token_count", usage_metadata.get("promptTokenCount", 0)
+            )
+            output_tokens += usage_metadata.get(
+                "candidates_token_count", usage_metadata.get("candidatesTokenCount", 0)
+            )
+        self.usage.record_tokens(self.call, input_tokens, output_tokens)
+
+
+class UsageRegistry:
+    """
+    Collects the usage of finished jobs and aggregates it.
+
+    Attributes:
+        jobs (OrderedDict): Usage of the most recent jobs by job id.
+        totals (dict): Aggregate usage of all the jobs.
+    """
+
+    def __init__(self, max_jobs: int = 500):
+        """
+        Initializes the UsageRegistry.
+
+        Args:
+            max_jobs (int, optional): Number of recent jobs kept. Defaults to 500.
+        """
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.totals = {
+            "jobs": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "image_calls": 0,
+            "image_retries": 0,
+            "wall_time": 0.0,
+            "degraded_jobs": 0,
+        }
+        self.lock = threading.Lock()
+
+    def record(self, job_id: str, usage: StoryUsage) -> dict:
+        """
+        Records the usage of a finished job.
+
+        Args:
+            job_id (str): Identifier of the job.
+            usage (StoryUsage): The usage of the job, or its `to_dict` for a job run by a worker.
+
+        Returns:
+            dict: The recorded job usage.
+        """
+        if isinstance(usage, dict):
+            record = dict(usage)
+        else:
+            if usage.wall_time is None:
+                usage.finish()
+            record = usage.to_dict()
+        record["job_id"] = job_id
+
+        with self.lock:
+            self.jobs[job_id] = record
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+            self.totals["jobs"] += 1
+            self.totals["input_tokens"] += record["input_tokens"]
+            self.totals["output_tokens"] += record["output_tokens"]
+            self.totals["image_calls"] += record["image_calls"]
+            self.totals["image_retries"] += record["image_retries"]
+            self.totals["wall_time"] += record["wall_time"]
+            if record["degraded"]:
+                self.totals["degraded_jobs"] += 1
+
+        metrics.inc("story_jobs_total")
+        metrics.inc("story_wall_seconds_total", record["wall_time"])
+        return record
+
+    def get(self, job_id: str) -> dict:
+        """
+        Args:
+            job_id (str): Identifier of the job.
+
+        Returns:
+            dict: The usage of the job, None if it is unknown.
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def summary(self, recent: int = 20) -> dict:
+        """
+        Args:
+            recent (int, optional): Number of recent jobs to include. Defaults to 20.
+
+        Returns:
+            dict: The aggregate usage and the usage of the most recent jobs.
+        """
+        with self.lock:
+            return {
+                "totals": dict(self.totals),
+                "recent": list(deque(self.jobs.values(), maxlen=recent)),
+            }
+
+
+usage_registry = UsageRegistry()
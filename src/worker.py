@@ -0,0 +1,266 @@
+"""
+Command line entry point of the story generation workers.
+
+Runs `build_story` for the jobs of the job queue in several processes, so the generation scales
+across the cores of a node independently of the web tier. Each process runs a few jobs at once
+on threads, renews the lease of its jobs with heartbeats and stores their result in the queue.
+A process which dies is restarted, and its jobs are leased again once their lease expires.
+
+The web tier enqueues its stories instead of generating them when `JOB_QUEUE=1`, both must use
+the same `JOB_QUEUE_PATH`.
+
+Usage:
+    python -m src.worker --processes 4 --threads 2
+"""
+
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+import multiprocessing
+from src.story_builder import build_story
+from src.usage import StoryUsage
+from src.log_config import setup_logging, job_context
+from src.job_queue import job_queue_from_env, CIRCUIT_OPEN
+from src.circuit_breaker import CircuitOpen
+from src.profiling import profile_job
+from src.story_store import story_store
+
+
+def run_story(job) -> dict:
+    """
+    Generates the story of a job.
+
+    Args:
+        job (QueuedJob): The job, its payload holds the arguments of `build_story`, whether the
+            job is profiled and whether the story is saved in the story store.
+
+    Returns:
+        dict: The HTML of the story and its usage.
+    """
+    payload = dict(job.payload)
+    # the directories of the story store are deleted once expired, like the stories of the web tier
+    payload.setdefault("image_dir", story_store.story_dir(job.job_id))
+    profile = payload.pop("profile", False)
+    record = {} if payload.pop("persist", False) else None
+    usage = StoryUsage()
+    with profile_job(job.job_id, profile):
+        story = build_story(usage=usage, record=record, **payload)
+    if record is not None:
+        story_store.save(job.job_id, record)
+    if profile:
+        usage.profile = f"/profiles/{job.job_id}"
+    return {"story": story, "usage": usage.to_dict()}
+
+
+HANDLERS = {"story": run_story}
+
+# errors another attempt would not fix, the job fails at once with their kind
+NOT_RETRIED = {CircuitOpen: CIRCUIT_OPEN}
+
+
+class Heartbeat:
+    """
+    Renews the lease of a running job on a background thread.
+
+    Attributes:
+        lost (bool): Whether the lease was lost, another worker then runs the job.
+    """
+
+    def __init__(self, job_queue, job_id: str, worker_id: str, lease_seconds: float):
+        """
+        Initializes and starts the Heartbeat.
+
+        Args:
+            job_queue (JobQueue): The job queue.
+            job_id (str): Id of the job.
+            worker_id (str): Id of the worker holding the lease.
+            lease_seconds (float): Duration of the lease, renewed every third of it.
+        """
+        self.job_queue = job_queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                if not self.job_queue.heartbeat(self.job_id, self.worker_id, self.lease_seconds):
+                    self.lost = True
+                    logging.info(f"Lease of job {self.job_id} lost")
+                    return
+            except Exception as e:
+                logging.info(f"Heartbeat of job {self.job_id} failed ({e!r})")
+
+    def stop(self):
+        """
+        Stops renewing the lease.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_job(job_queue, job, worker_id: str, lease_seconds: float):
+    """
+    Runs a leased job and stores its result or error.
+
+    Args:
+        job_queue (JobQueue): The job queue.
+        job (QueuedJob): The leased job.
+        worker_id (str): Id of the worker holding the lease.
+        lease_seconds (float): Duration of the lease.
+    """
+    with job_context(job.job_id):
+        logging.info(f"Job {job.job_id} started, attempt {job.attempts}/{job.max_attempts}")
+        heartbeat = Heartbeat(job_queue, job.job_id, worker_id, lease_seconds)
+        started = time.time()
+        try:
+            result = HANDLERS[job.kind](job)
+        except tuple(NOT_RETRIED) as e:
+            heartbeat.stop()
+            logging.info(f"Job {job.job_id} failed, not retried ({e!r})")
+            job_queue.fail(
+                job.job_id,
+                worker_id,
+                repr(e),
+                error_kind=next(
+                    kind for error, kind in NOT_RETRIED.items() if isinstance(e, error)
+                ),
+                retry=False,
+                retry_after=e.retry_after,
+            )
+            return
+        except Exception as e:
+            heartbeat.stop()
+            logging.exception(f"Job {job.job_id} failed")
+            job_queue.fail(job.job_id, worker_id, repr(e))
+            return
+        heartbeat.stop()
+        if job_queue.complete(job.job_id, worker_id, result):
+            logging.info(f"Job {job.job_id} done in {time.time() - started:.1f}s")
+        else:
+            logging.info(f"Job {job.job_id} done after its lease was lost, result discarded")
+
+
+def work(worker_id: str, lease_seconds: float, poll_seconds: float, stop: threading.Event):
+    """
+    Leases and runs jobs until stopped.
+
+    Args:
+        worker_id (str): Id of the worker.
+        lease_seconds (float): Duration of the leases.
+        poll_seconds (float): Seconds to wait when the queue is empty.
+        stop (threading.Event): Set to stop after the running job.
+    """
+    job_queue = job_queue_from_env()
+    while not stop.is_set():
+        try:
+            job = job_queue.lease(worker_id, lease_seconds)
+        except Exception as e:
+            logging.info(f"Worker {worker_id} could not lease a job ({e!r})")
+            job = None
+        if job is None:
+            stop.wait(poll_seconds)
+            continue
+        run_job(job_queue, job, worker_id, lease_seconds)
+
+
+def worker_process(n_process: int, threads: int, lease_seconds: float, poll_seconds: float):
+    """
+    Runs the worker threads of a process.
+
+    Args:
+        n_process (int): Number of the process.
+        threads (int): Number of jobs run at once by the process.
+        lease_seconds (float): Duration of the leases.
+        poll_seconds (float): Seconds to wait when the queue is empty.
+    """
+    setup_logging(log_file=None)
+    stop = threading.Event()
+    workers = [
+        threading.Thread(
+            target=work,
+            args=(f"{socket.gethostname()}-{os.getpid()}-{n}", lease_seconds, poll_seconds, stop),
+            name=f"worker-{n_process}-{n}",
+        )
+        for n in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop.set()
+
+
+def main(argv=None):
+    """
+    Parses the command line arguments and runs the worker processes, restarting those which die.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to `sys.argv`.
+    """
+    parser = argparse.ArgumentParser(description="Generate the stories of the job queue.")
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=2, help="Number of jobs run at once by each process"
+    )
+    parser.add_argument(
+        "--lease", type=float, default=60, help="Seconds after which a job of a dead worker is retried"
+    )
+    parser.add_argument(
+        "--poll", type=float, default=1, help="Seconds to wait when the queue is empty"
+    )
+    args = parser.parse_args(argv)
+
+    # the spawned processes inherit the environment
+    if "K_REVISION" not in os.environ:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+
+    setup_logging(log_file=None)
+    # the queue file is created once before the processes start
+    job_queue_from_env()
+    # spawned processes do not inherit the logging thread or the model clients of this one
+    context = multiprocessing.get_context("spawn")
+
+    def start(n_process: int) -> multiprocessing.Process:
+        process = context.Process(
+            target=worker_process,
+            args=(n_process, args.threads, args.lease, args.poll),
+            name=f"worker-{n_process}",
+        )
+        process.start()
+        return process
+
+    processes = [start(n) for n in range(args.processes)]
+    logging.info(f"{args.processes} worker processes started, {args.threads} jobs each")
+    try:
+        while True:
+            for n, process in enumerate(processes):
+                process.join(timeout=1 / len(processes))
+                if not process.is_alive():
+                    logging.info(
+                        f"Worker process {process.pid} exited with {process.exitcode}, restarting"
+                    )
+                    processes[n] = start(n)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
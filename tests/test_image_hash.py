@@ -0,0 +1,34 @@
+from PIL import Image, ImageOps
+from src.image_hash import dhash, hamming_distance
+
+
+def gradient(width: int = 256, height: int = 128) -> Image.Image:
+    """
+    Returns:
+        Image.Image: An image brighter towards its right, with a dark square.
+    """
+    image = Image.linear_gradient("L").rotate(90, expand=True).resize((width, height))
+    image.paste(0, (width // 4, height // 4, width // 2, height // 2))
+    return image.convert("RGB")
+
+
+def test_hamming_distance():
+    assert hamming_distance(0b1011, 0b1011) == 0
+    assert hamming_distance(0b1011, 0b0001) == 2
+    assert hamming_distance(0, 2**64 - 1) == 64
+
+
+def test_dhash_of_a_copy_is_close():
+    image = gradient()
+    assert dhash(image) == dhash(image.copy())
+    assert hamming_distance(dhash(image), dhash(image.resize((100, 50)))) <= 4
+    assert hamming_distance(dhash(image), dhash(image.convert("L"))) <= 4
+
+
+def test_dhash_of_another_image_is_far():
+    image = gradient()
+    assert hamming_distance(dhash(image), dhash(ImageOps.mirror(image))) > 32
+
+
+def test_dhash_size():
+    assert dhash(gradient(), hash_size=4) < 2**16
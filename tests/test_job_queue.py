@@ -0,0 +1,84 @@
+import time
+import pytest
+from src.job_queue import SQLiteJobQueue, QUEUED, RUNNING, DONE, FAILED, CIRCUIT_OPEN
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return SQLiteJobQueue(str(tmp_path / "jobs.db"))
+
+
+def test_lease_takes_the_oldest_job_once(job_queue):
+    first = job_queue.enqueue("story", {"n": 1})
+    job_queue.enqueue("story", {"n": 2})
+
+    job = job_queue.lease("worker-a", 60)
+    assert job.job_id == first
+    assert job.payload == {"n": 1}
+    assert job.attempts == 1
+    assert job_queue.get(first)["status"] == RUNNING
+
+    assert job_queue.lease("worker-b", 60).job_id != first
+    assert job_queue.lease("worker-c", 60) is None
+
+
+def test_expired_lease_is_leased_again(job_queue):
+    job_id = job_queue.enqueue("story", {})
+    job_queue.lease("worker-a", 0.01)
+    time.sleep(0.05)
+
+    job = job_queue.lease("worker-b", 60)
+    assert job.job_id == job_id
+    assert job.attempts == 2
+    # the first worker lost its lease and can neither renew nor finish the job
+    assert not job_queue.heartbeat(job_id, "worker-a", 60)
+    assert not job_queue.complete(job_id, "worker-a", {"story": "late"})
+    assert job_queue.complete(job_id, "worker-b", {"story": "done"})
+    assert job_queue.get(job_id)["status"] == DONE
+    assert job_queue.get(job_id)["result"] == {"story": "done"}
+
+
+def test_heartbeat_extends_the_lease(job_queue):
+    job_id = job_queue.enqueue("story", {})
+    job_queue.lease("worker-a", 0.05)
+    assert job_queue.heartbeat(job_id, "worker-a", 60)
+    time.sleep(0.1)
+
+    assert job_queue.lease("worker-b", 60) is None
+    assert job_queue.get(job_id)["worker_id"] == "worker-a"
+
+
+def test_lease_expired_on_last_attempt_fails_the_job(job_queue):
+    job_id = job_queue.enqueue("story", {}, max_attempts=1)
+    job_queue.lease("worker-a", 0.01)
+    time.sleep(0.05)
+
+    assert job_queue.lease("worker-b", 60) is None
+    job = job_queue.get(job_id)
+    assert job["status"] == FAILED
+    assert job["error"] == "Lease expired on the last attempt"
+
+
+def test_failed_job_is_retried_until_its_last_attempt(job_queue):
+    job_id = job_queue.enqueue("story", {}, max_attempts=2)
+    job_queue.lease("worker-a", 60)
+    assert job_queue.fail(job_id, "worker-a", "boom")
+    assert job_queue.get(job_id)["status"] == QUEUED
+
+    job_queue.lease("worker-b", 60)
+    assert job_queue.fail(job_id, "worker-b", "boom again")
+    assert job_queue.get(job_id)["status"] == FAILED
+
+
+def test_failure_not_retried(job_queue):
+    job_id = job_queue.enqueue("story", {})
+    job_queue.lease("worker-a", 60)
+    assert job_queue.fail(
+        job_id, "worker-a", "models down", error_kind=CIRCUIT_OPEN, retry=False, retry_after=30
+    )
+
+    job = job_queue.get(job_id)
+    assert job["status"] == FAILED
+    assert job["error_kind"] == CIRCUIT_OPEN
+    assert job["retry_after"] == 30
+    assert job_queue.lease("worker-b", 60) is None
@@ -0,0 +1,23 @@
+from src.profiling import token_valid
+
+
+def test_token_not_set(monkeypatch):
+    monkeypatch.delenv("PROFILE_TOKEN", raising=False)
+    assert not token_valid("secret")
+    assert not token_valid("")
+
+
+def test_token(monkeypatch):
+    monkeypatch.setenv("PROFILE_TOKEN", "secret")
+    assert token_valid("secret")
+    assert not token_valid("secreT")
+    assert not token_valid("")
+    assert not token_valid(None)
+
+
+def test_non_ascii_token(monkeypatch):
+    monkeypatch.setenv("PROFILE_TOKEN", "secret")
+    assert not token_valid("sécret")
+    monkeypatch.setenv("PROFILE_TOKEN", "clé")
+    assert token_valid("clé")
+    assert not token_valid("cle")
@@ -0,0 +1,88 @@
+import pytest
+from src.scheduler import StoryScheduler, SchedulerFull
+
+
+def admitted_order(scheduler, running, jobs):
+    """
+    Releases the running job and each admitted job in turn, and returns the order in which the
+    waiting jobs were admitted.
+    """
+    order = []
+    scheduler.release(running)
+    waiting = list(jobs)
+    while waiting:
+        job = next(job for job in waiting if job.admitted.is_set())
+        waiting.remove(job)
+        order.append(job)
+        scheduler.release(job)
+    return order
+
+
+def test_cost_is_capped_at_the_budget():
+    scheduler = StoryScheduler(max_cost=4, max_queued_cost=10, max_wait=1000)
+    job = scheduler.submit("a", 100)
+    assert job.cost == 4
+    assert job.admitted.is_set()
+
+
+def test_jobs_wait_for_the_budget():
+    scheduler = StoryScheduler(max_cost=4, max_queued_cost=10, max_wait=1000)
+    first = scheduler.submit("a", 3)
+    second = scheduler.submit("b", 2)
+    assert first.admitted.is_set()
+    assert not second.admitted.is_set()
+    assert scheduler.queued_cost == 2
+
+    scheduler.release(first)
+    assert second.admitted.is_set()
+    assert scheduler.running_cost == 2
+
+
+def test_busy_client_does_not_starve_the_others():
+    scheduler = StoryScheduler(max_cost=1, max_queued_cost=100, max_wait=1000)
+    running = scheduler.submit("a", 1)
+    a_jobs = [scheduler.submit("a", 1) for _ in range(3)]
+    b_job = scheduler.submit("b", 1)
+
+    order = admitted_order(scheduler, running, a_jobs + [b_job])
+    assert order == [a_jobs[0], b_job, a_jobs[1], a_jobs[2]]
+
+
+def test_weight_is_the_share_of_a_client():
+    scheduler = StoryScheduler(max_cost=1, max_queued_cost=100, max_wait=1000)
+    running = scheduler.submit("a", 1)
+    a_jobs = [scheduler.submit("a", 1) for _ in range(2)]
+    b_jobs = [scheduler.submit("b", 1, weight=2) for _ in range(2)]
+
+    order = admitted_order(scheduler, running, a_jobs + b_jobs)
+    assert order == [b_jobs[0], a_jobs[0], b_jobs[1], a_jobs[1]]
+
+
+def test_job_is_shed_when_the_queue_is_full():
+    scheduler = StoryScheduler(max_cost=2, max_queued_cost=2, max_wait=1000)
+    scheduler.submit("a", 2)
+    scheduler.submit("b", 2)
+
+    with pytest.raises(SchedulerFull) as shed:
+        scheduler.submit("c", 1)
+    assert shed.value.retry_after >= 1
+    assert scheduler.queued_cost == 2
+
+
+def test_job_is_shed_when_the_wait_is_too_long():
+    scheduler = StoryScheduler(max_cost=2, max_queued_cost=100, max_wait=1)
+    scheduler.submit("a", 2)
+
+    with pytest.raises(SchedulerFull):
+        scheduler.submit("b", 2)
+    assert scheduler.queued_cost == 0
+
+
+def test_cancelled_job_leaves_the_queue():
+    scheduler = StoryScheduler(max_cost=1, max_queued_cost=100, max_wait=1000)
+    running = scheduler.submit("a", 1)
+    waiting = scheduler.submit("b", 1)
+
+    assert scheduler.cancel(waiting)
+    assert scheduler.queued_cost == 0
+    assert not scheduler.cancel(running)
@@ -0,0 +1,21 @@
+import pytest
+from src.story_builder import parse_image_density
+
+
+def test_image_density_not_requested():
+    assert parse_image_density() == (None, None)
+    assert parse_image_density("", "") == (None, None)
+
+
+def test_image_density():
+    assert parse_image_density("3", "2") == (3, 2)
+    assert parse_image_density("0", None) == (0, None)
+    assert parse_image_density(None, "1") == (None, 1)
+
+
+@pytest.mark.parametrize(
+    "images, image_every", [("-1", None), (None, "0"), ("three", None), (None, "2.5")]
+)
+def test_invalid_image_density(images, image_every):
+    with pytest.raises(ValueError):
+        parse_image_density(images, image_every)
@@ -0,0 +1,13 @@
+from src.story_builder import MAX_WORDS
+from src.story_pool import bucket_key
+
+
+def test_bucket_key_normalizes_the_request():
+    assert bucket_key("Old  Town ", "A Cat", 500) == bucket_key("old town", " a  cat", 500)
+    assert bucket_key(None, None, 500) == ("", "", 500)
+
+
+def test_bucket_key_clamps_the_words():
+    assert bucket_key("sea", "", MAX_WORDS + 1000) == ("sea", "", MAX_WORDS)
+    assert bucket_key("sea", "", MAX_WORDS + 1000) == bucket_key("sea", "", MAX_WORDS)
+    assert bucket_key("sea", "", 300) != bucket_key("sea", "", 400)
@@ -0,0 +1,28 @@
+import pytest
+from src.translate import parse_languages
+
+
+def test_no_languages():
+    assert parse_languages(None) == []
+    assert parse_languages("") == []
+    assert parse_languages(" , ") == []
+
+
+def test_languages_are_distinct_and_normalized():
+    assert parse_languages("French,  german , french, Old   Norse") == [
+        "French", "german", "Old Norse"
+    ]
+    assert parse_languages(["Spanish", " spanish "]) == ["Spanish"]
+
+
+@pytest.mark.parametrize("value", ["Fr3nch", "German; DROP TABLE", "E", "a" * 41])
+def test_invalid_language(value):
+    with pytest.raises(ValueError):
+        parse_languages(value)
+
+
+def test_too_many_languages(monkeypatch):
+    monkeypatch.setenv("STORY_MAX_LANGUAGES", "2")
+    assert parse_languages("French, German") == ["French", "German"]
+    with pytest.raises(ValueError):
+        parse_languages("French, German, Italian")